@@ -1,6 +1,57 @@
+import anydbm
+import contextlib
+import dumbdbm
 import json
+import logging
+import os
+import shutil
+
+import serializers
+from file_lock import FileLock
+
+__all__ = ['AbstractBackend', 'AbstractEventBackend', 'WholeStoreAdapter', 'as_event_backend',
+           'FileBackend', 'DbmBackend', 'LazyEvents', 'ConflictError', 'event_version']
+
+
+class ConflictError(Exception):
+    """Raised by `commit_changes` when events changed in the store since they
+    were read. `current` maps their ids to what's stored now (None if deleted)."""
+
+    def __init__(self, current):
+        super(ConflictError, self).__init__('Changed since they were read: %s' % ', '.join(sorted(current)))
+        self.current = current
+
+
+def event_version(event):
+    """The version of a stored event: None if there's no event, 0 if it was
+    stored before events had versions."""
+    if event is None:
+        return None
+    return event.get('version', 0)
+
+
+def check_versions(stored, changes):
+    """
+    Compare-and-swap check shared by the backends' `commit_changes`:
+    `stored(event_id)` returns the event in the store right now.
+
+    Raises a ConflictError if any event's stored version isn't the expected one.
+    Otherwise returns the changes to write, as event id -> event with its new
+    version (None to delete it).
+    """
+    current = dict((event_id, stored(event_id)) for event_id in changes)
+    conflicts = dict((event_id, event) for event_id, event in current.items()
+                     if event_version(event) != changes[event_id][0])
+    if conflicts:
+        raise ConflictError(conflicts)
+
+    writes = {}
+    for event_id, (expected_version, event) in changes.items():
+        if event is not None:
+            event = dict(event, version=(expected_version or 0) + 1)
+        writes[event_id] = event
+    return writes
 
-__all__ = ['AbstractBackend', 'FileBackend']
 
 class AbstractBackend(object):
 
@@ -35,37 +86,465 @@ class AbstractBackend(object):
         raise NotImplementedError('You must override the get_all_events method.')
 
 
-    def commit_events(self, events):
+    def commit_events(self, events, event_ids=None):
         """
         Should write the events to any long-term storage by any means necessary.
+
+        `events` is a mapping of all the events. `event_ids`, when given, are the
+        only events that changed since the last commit (deleted events are the
+        ones no longer in `events`), so backends that store events one by one
+        only need to write those.
         """
         raise NotImplementedError('You must override the commit_events method.')
 
 
+class AbstractEventBackend(AbstractBackend):
+    """
+    A backend that reads and writes events one at a time, so a change costs
+    O(event) rather than O(store).
+
+    `commit_events` is implemented on top of the per-event methods, for the
+    callers of the whole-store contract.
+    """
+
+    def get_event(self, event_id):
+        """Must return the event stored under `event_id`, or None."""
+        raise NotImplementedError('You must override the get_event method.')
+
+    def put_event(self, event_id, event):
+        """Must store `event` under `event_id`, replacing whatever was there."""
+        raise NotImplementedError('You must override the put_event method.')
+
+    def delete_event(self, event_id):
+        """Must delete `event_id`. Deleting a missing event does nothing."""
+        raise NotImplementedError('You must override the delete_event method.')
+
+    def event_ids(self):
+        """Must return the ids of all the stored events."""
+        raise NotImplementedError('You must override the event_ids method.')
+
+    def has_event(self, event_id):
+        return self.get_event(event_id) is not None
+
+    def changed_events(self):
+        """
+        Returns the events someone else (e.g. another process sharing the store)
+        changed since we last read or wrote them, as event id -> the event, or
+        None if it was deleted.
+
+        Should be cheap when nothing changed: it's called for every message.
+        Backends that can't tell return {}, and find out on a conflict in
+        `commit_changes` instead.
+        """
+        return {}
+
+    def commit_changes(self, changes):
+        """
+        Writes a batch of changes, all or nothing, if none of the events changed
+        since they were read.
+
+        `changes` maps event ids to `(expected_version, event)` pairs: the
+        `event_version` of the event as it was read (None if it didn't exist)
+        and what to store instead (None to delete it). Stored events get the
+        next version; returns the written events, with their versions.
+        A moved event is its old id deleted and its new one stored, in one batch.
+
+        Raises a ConflictError, having written nothing, if an event's version in
+        the store isn't the expected one.
+
+        This implementation isn't atomic: backends shared between processes
+        must override it and hold a lock across the check and the writes.
+        """
+        writes = check_versions(self.get_event, changes)
+        self._write(writes)
+        return writes
+
+    def _write(self, writes):
+        # Store the new events before deleting the old: if we die in between, a
+        # moved event is duplicated rather than lost.
+        for event_id, event in writes.items():
+            if event is not None:
+                self.put_event(event_id, event)
+        for event_id, event in writes.items():
+            if event is None:
+                self.delete_event(event_id)
+
+    def commit_events(self, events, event_ids=None):
+        if event_ids is None:
+            # No idea what changed, so write everything.
+            event_ids = set(self.event_ids()) | set(events)
+
+        for event_id in event_ids:
+            event = events.get(event_id)
+            if event is not None:
+                self.put_event(event_id, event)
+            else:
+                self.delete_event(event_id)
+
+
+class WholeStoreAdapter(AbstractEventBackend):
+    """
+    Gives a backend that only implements `get_all_events` and `commit_events`
+    the per-event interface.
+
+    The events are read once and kept in memory; every write commits all of them,
+    which is the best such a backend can do.
+    """
+
+    def __init__(self, backend, *args, **kwargs):
+        self.backend = backend
+        self.events = None
+        super(WholeStoreAdapter, self).__init__(*args, **kwargs)
+
+    def _events(self):
+        if self.events is None:
+            self.events = dict(self.backend.get_all_events())
+        return self.events
+
+    def get_all_events(self):
+        # A copy, since put_event and friends modify ours.
+        return dict(self._events())
+
+    def get_event(self, event_id):
+        return self._events().get(event_id)
+
+    def event_ids(self):
+        return list(self._events())
+
+    def put_event(self, event_id, event):
+        self._events()[event_id] = event
+        self.backend.commit_events(self.events, [event_id])
+
+    def delete_event(self, event_id):
+        if self._events().pop(event_id, None) is not None:
+            self.backend.commit_events(self.events, [event_id])
+
+    def commit_events(self, events, event_ids=None):
+        self.events = dict(events)
+        self.backend.commit_events(self.events, event_ids)
+
+    def changed_events(self):
+        if self.events is None or not hasattr(self.backend, 'changed_events'):
+            return {}
+        changed = self.backend.changed_events()
+        self._apply(changed)
+        return changed
+
+    def commit_changes(self, changes):
+        """Leaves the check to the backend if it can do it against what's really
+        stored (like FileBackend), otherwise checks against our copy."""
+        events = self._events()
+        if not hasattr(self.backend, 'commit_changes'):
+            writes = check_versions(events.get, changes)
+            self._apply(writes)
+            self.backend.commit_events(events, list(writes))
+            return writes
+
+        try:
+            writes = self.backend.commit_changes(changes)
+        except ConflictError as e:
+            self._apply(e.current)
+            raise
+        self._apply(writes)
+        return writes
+
+    def _apply(self, events):
+        for event_id, event in events.items():
+            if event is None:
+                self.events.pop(event_id, None)
+            else:
+                self.events[event_id] = event
+
+
+def as_event_backend(backend):
+    """Returns `backend` if it has the per-event interface, or wraps it in a WholeStoreAdapter."""
+    if isinstance(backend, AbstractEventBackend):
+        return backend
+    return WholeStoreAdapter(backend)
+
+
 class FileBackend(AbstractBackend):
+    """
+    Keeps all the events in one file.
+
+    `commit_changes` makes it safe to share between processes: under a lock on
+    `<filename>.lock`, it re-reads the file if someone else wrote it since we
+    last did, checks the versions of the changed events, and merges the changes
+    into what's there. `commit_events` overwrites the file regardless.
+    """
 
     filename = None
+    load_errors = ()
 
-    def __init__(self, filename, *args, **kwargs):
+    def __init__(self, filename, serializer=None, *args, **kwargs):
+        """`serializer` is the format commits are written in (see serializers.py),
+        the configured default if None. Files in any format can be read."""
         self.filename = filename
+        self.serializer = serializer
+        self.file_lock = FileLock(filename + '.lock')
+        # The events as of our last load or commit_changes, and the file they were in.
+        self.committed = None
+        self.committed_file = None
         super(FileBackend, self).__init__(*args, **kwargs)
 
 
     def get_all_events(self):
+        """Loads the events one at a time. Events that can't be decoded are
+        logged, listed in `load_errors` and skipped rather than losing the whole
+        store, and the damaged file is kept as `<filename>.corrupt` before the
+        next commit overwrites it."""
         events = {}
+        self.load_errors = []
+        # Before reading: if the file is replaced meanwhile, they won't match.
+        identity = file_identity(self.filename)
+
+        def on_error(line, message):
+            logging.warning('Skipping line %s of %s: %s', line, self.filename, message)
+            self.load_errors.append((line, message))
+
         try:
-            with open(self.filename, "r") as f:
-                try:
-                    events = json.load(f)
-                except ValueError as v_exc:
-                    pass
+            with serializers.paused_gc():
+                for event_id, event in serializers.load_items(self.filename, on_error):
+                    events[event_id] = event
+        except ValueError as v_exc:
+            logging.warning('Could not read %s: %s', self.filename, v_exc)
+            self.load_errors.append((None, str(v_exc)))
         except IOError as io_exc:
             pass
 
-        return events
+        if self.load_errors:
+            shutil.copyfile(self.filename, self.filename + '.corrupt')
+
+        # What commit_changes merges into, until someone else writes the file:
+        # the same event objects as the caller's, rather than a second copy.
+        self.committed = events
+        self.committed_file = identity
+        return dict(events)
 
 
-    def commit_events(self, events):
+    def commit_events(self, events, event_ids=None):
         """Write the whole events dictionary to the filename file."""
-        with open(self.filename, 'w+') as f:
-            json.dump(events, f)
+        with self.file_lock():
+            self.committed = dict(events)
+            serializers.dump(self.committed, self.filename, self.serializer)
+            self.committed_file = file_identity(self.filename)
+
+    def commit_changes(self, changes):
+        with self.file_lock():
+            if self.committed is None or self.committed_file != file_identity(self.filename):
+                self.committed = self.get_all_events()
+
+            writes = check_versions(self.committed.get, changes)
+            events = dict(self.committed)
+            for event_id, event in writes.items():
+                if event is None:
+                    events.pop(event_id, None)
+                else:
+                    events[event_id] = event
+            serializers.dump(events, self.filename, self.serializer)
+
+            self.committed = events
+            self.committed_file = file_identity(self.filename)
+        return writes
+
+    def changed_events(self):
+        """Only a stat, unless someone else wrote the file since we last read
+        or wrote it: then it's read again, and compared with what we had."""
+        if self.committed is None or self.committed_file == file_identity(self.filename):
+            return {}
+
+        previous = self.committed
+        self.get_all_events()
+        changed = {}
+        for event_id, event in self.committed.items():
+            if previous.get(event_id) == event:
+                # Keep the objects the caller has, rather than a second copy.
+                self.committed[event_id] = previous[event_id]
+            else:
+                changed[event_id] = event
+        for event_id in previous:
+            if event_id not in self.committed:
+                changed[event_id] = None
+        return changed
+
+
+def file_identity(filename):
+    """Changes whenever the file is written: serializers.dump replaces it with a new file."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class DbmBackend(AbstractEventBackend):
+    """
+    Stores every event as a JSON value under its own key in a dbm database
+    (whichever of gdbm, bsddb, dbm or dumbdbm `anydbm` finds).
+
+    `get_all_events` doesn't read anything: it returns a LazyEvents mapping that
+    loads events the first time they're accessed. Every other operation reads or
+    writes a single key.
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        self.filename = filename
+        self.db = anydbm.open(filename, 'c')
+        self.db_files = self._db_files()
+        # Also keeps our threads apart: dbm objects aren't safe to share between them.
+        self.file_lock = FileLock(filename + '.lock')
+        super(DbmBackend, self).__init__(*args, **kwargs)
+
+    def get_event(self, event_id):
+        with self._locked(shared=True):
+            try:
+                raw_event = self.db[event_id.encode('utf-8')]
+            except KeyError:
+                return None
+        return json.loads(raw_event)
+
+    def has_event(self, event_id):
+        with self._locked(shared=True):
+            return self.db.has_key(event_id.encode('utf-8'))
+
+    def event_ids(self):
+        with self._locked(shared=True):
+            keys = self.db.keys()
+        return [key.decode('utf-8') for key in keys]
+
+    def get_all_events(self):
+        return LazyEvents(self)
+
+    def put_event(self, event_id, event):
+        with self._locked():
+            self.db[event_id.encode('utf-8')] = json.dumps(event)
+            self._sync()
+
+    def delete_event(self, event_id):
+        key = event_id.encode('utf-8')
+        with self._locked():
+            if self.db.has_key(key):
+                del self.db[key]
+                self._sync()
+
+    def commit_changes(self, changes):
+        with self._locked():
+            def stored(event_id):
+                try:
+                    return json.loads(self.db[event_id.encode('utf-8')])
+                except KeyError:
+                    return None
+
+            writes = check_versions(stored, changes)
+            for event_id, event in writes.items():
+                if event is not None:
+                    self.db[event_id.encode('utf-8')] = json.dumps(event)
+            for event_id, event in writes.items():
+                key = event_id.encode('utf-8')
+                if event is None and self.db.has_key(key):
+                    del self.db[key]
+            self._sync()
+        return writes
+
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        with self.file_lock(shared):
+            self._refresh()
+            yield
+
+    def _db_files(self):
+        """Identifies the database files as they are now: whichever of them the dbm module uses."""
+        return [file_identity(self.filename + extension) for extension in ('', '.db', '.dir', '.dat')]
+
+    def _refresh(self):
+        # Some dbm modules (dumbdbm, for one) keep an index in memory, so
+        # reopen the database to see what other processes wrote to it.
+        db_files = self._db_files()
+        if db_files != self.db_files:
+            if isinstance(self.db, dumbdbm._Database):
+                # Otherwise closing it writes our stale index over theirs.
+                self.db._index = None
+            self.db.close()
+            self.db = anydbm.open(self.filename, 'c')
+            self.db_files = db_files
+
+    def _sync(self):
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+        self.db_files = self._db_files()
+
+    def close(self):
+        # dumbdbm writes its index out on close: make it the current one.
+        with self._locked():
+            self.db.close()
+        self.file_lock.close()
+
+
+_DELETED = object()
+
+
+class LazyEvents(object):
+    """
+    A read-only mapping of the events in a DbmBackend that loads (and keeps)
+    events as they are accessed.
+
+    `with_changes` returns a new mapping with some events replaced or deleted,
+    for changes that may not have been committed to the backend yet.
+    """
+
+    def __init__(self, backend, loaded=None):
+        self.backend = backend
+        self.loaded = loaded or {}
+
+    def get(self, event_id, default=None):
+        event = self.loaded.get(event_id)
+        if event is None:
+            event = self.backend.get_event(event_id)
+            if event is None:
+                return default
+            self.loaded[event_id] = event
+        return default if event is _DELETED else event
+
+    def __getitem__(self, event_id):
+        event = self.get(event_id)
+        if event is None:
+            raise KeyError(event_id)
+        return event
+
+    def __contains__(self, event_id):
+        if event_id in self.loaded:
+            return self.loaded[event_id] is not _DELETED
+        return self.backend.has_event(event_id)
+
+    def __iter__(self):
+        for event_id, event in self.loaded.items():
+            if event is not _DELETED:
+                yield event_id
+        for event_id in self.backend.event_ids():
+            if event_id not in self.loaded:
+                yield event_id
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        """Iterates over all the events, without keeping the ones not loaded yet."""
+        for event_id in self:
+            event = self.loaded.get(event_id)
+            if event is None:
+                event = self.backend.get_event(event_id)
+            if event is not None:
+                yield event_id, event
+
+    def with_changes(self, changes):
+        """`changes` maps event ids to their new event, or None if they were deleted."""
+        loaded = dict(self.loaded)
+        for event_id, event in changes.items():
+            loaded[event_id] = _DELETED if event is None else event
+        return LazyEvents(self.backend, loaded)
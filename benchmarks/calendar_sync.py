@@ -0,0 +1,100 @@
+"""
+Calendar sync throughput against fake_gcal.py, with injected latency and
+errors: how many events per second RSVP keeps in sync (one events.patch per
+message), and the same patches sent as a single batch request.
+
+    python benchmarks/calendar_sync.py [--events 50] [--latency 0 0.02] [--error-rate 0 0.1] [--retries 5]
+
+Failed calls are retried with the client library's own randomized exponential
+backoff, so error rates show up as both retries and wall clock time. The client
+doesn't retry the failed calls of a batch: the batch column counts them too.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import calendar_events
+import rsvp
+from backends import FileBackend
+from fake_gcal import FakeCalendarServer
+
+CALENDAR_ID = 'rsvpbot@example.com'
+
+
+def message(subject, content):
+    return {
+        'content': content,
+        'subject': subject,
+        'display_recipient': 'bench',
+        'sender_email': 'a@example.com',
+        'sender_full_name': 'Tester',
+        'sender_id': 1,
+        'type': 'stream',
+    }
+
+
+def run(count, latency, error_rate, retries):
+    directory = tempfile.mkdtemp()
+    server = FakeCalendarServer(calendars={CALENDAR_ID: 'RSVPBot'}, latency=latency, error_rate=error_rate, seed=0)
+    server.start()
+    try:
+        with patch.object(calendar_events, 'GOOGLE_CALENDAR_API_URL', server.url), \
+                patch.object(calendar_events, 'GOOGLE_CALENDAR_ID', CALENDAR_ID), \
+                patch.object(calendar_events, 'GOOGLE_CALENDAR_RETRIES', retries):
+            bot = rsvp.RSVP('rsvp', FileBackend(os.path.join(directory, 'events.json')))
+
+            # Set up without errors, then measure the syncs.
+            server.calendar.error_rate = 0
+            for i in range(count):
+                bot.process_message(message('event %d' % i, 'rsvp init\nrsvp set date 02/25/2100\n'
+                                                            'rsvp set time 10:30\nrsvp set duration 1h'))
+                bot.process_message(message('event %d' % i, 'rsvp add to calendar'))
+            server.calendar.error_rate = error_rate
+            errors_before = server.errors_injected
+
+            started = time.time()
+            for i in range(count):
+                bot.process_message(message('event %d' % i, 'rsvp set place Hopper!'))
+            sequential = time.time() - started
+            errors = server.errors_injected - errors_before
+
+            service = calendar_events._get_calendar_service()
+            batch = service.new_batch_http_request()
+            for event in bot.events.values():
+                batch.add(service.events().patch(
+                    calendarId=CALENDAR_ID, eventId=event['calendar_event']['id'], body={'location': 'Lovelace'}))
+            started = time.time()
+            batch.execute()
+            batched = time.time() - started
+
+        return sequential, errors, batched
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--latency', type=float, nargs='+', default=[0, 0.02])
+    parser.add_argument('--error-rate', type=float, nargs='+', default=[0, 0.1])
+    parser.add_argument('--retries', type=int, default=5)
+    args = parser.parse_args()
+
+    print '%8s %7s %18s %8s %14s' % ('latency', 'errors', 'sequential syncs/s', 'retries', 'batch syncs/s')
+    for latency in args.latency:
+        for error_rate in args.error_rate:
+            sequential, errors, batched = run(args.events, latency, error_rate, args.retries)
+            print '%7.0fms %6.0f%% %18.1f %8d %14.1f' % (
+                1000 * latency, 100 * error_rate, args.events / sequential, errors, args.events / batched)
+
+
+if __name__ == '__main__':
+    main()
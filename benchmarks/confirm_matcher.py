@@ -0,0 +1,51 @@
+"""
+Times the yes/no/maybe matcher against RSVPConfirmCommand's original regex on
+inputs built to make it work hard: long messages with no answer, long runs of
+almost-answers ("yesss...x") and of answer-like emoji, at growing sizes, to
+show how both scale.
+
+    python benchmarks/confirm_matcher.py [--sizes 10000 100000 1000000]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rsvp_commands
+
+INPUTS = {
+    'chatter': lambda size: 'the quick brown fox jumps over the lazy dog ' * (size // 44),
+    'colons': lambda size: ': ' * (size // 2),
+    'one long yes': lambda size: 'ye' + 's' * size + 'x',
+    'yes runs': lambda size: ('ye' + 's' * 50 + 'x ') * (size // 54),
+    'candidates': lambda size: 'ya ' * (size // 3),
+    'thumbs': lambda size: ':thumbsupx ' * (size // 11),
+}
+
+
+def timed(function, text):
+    start = time.time()
+    function(text)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    command = rsvp_commands.RSVPConfirmCommand('rsvp')
+    regex = re.compile(command.regex, flags=re.DOTALL | re.I)
+
+    print '%-14s %9s %9s %9s' % ('input', 'chars', 'regex', 'matcher')
+    for name in sorted(INPUTS):
+        for size in args.sizes:
+            text = 'rsvp ' + INPUTS[name](size)
+            print '%-14s %9d %8.4fs %8.4fs' % (name, len(text), timed(regex.match, text), timed(command.match, text))
+
+
+if __name__ == '__main__':
+    main()
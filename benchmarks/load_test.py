@@ -0,0 +1,91 @@
+"""
+End-to-end load test: a real Bot long-polls a local fake Zulip server over
+HTTP while other users post a storm of messages, a fraction of them commands
+(each `rsvp init` in a topic of its own, so replies can be matched up).
+
+Reports the rate the storm was actually posted at, how many message events per
+second the bot sustained, and the latency from a command being posted to the
+bot's reply being received by the server.
+
+    python benchmarks/load_test.py [--rate 200] [--seconds 10] [--commands 0.1] [--no-narrow]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_zulip import FakeZulipServer
+from narrow import BenchmarkBot
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(rate, seconds, command_ratio, narrow, drain_timeout=30):
+    directory = tempfile.mkdtemp()
+    server = FakeZulipServer(streams=['load'], users=[('a@example.com', 'Tester')], poll_timeout=1).start()
+    try:
+        subject = BenchmarkBot(directory, 'bot@example.com', 'key', 'rsvp', ['load'], server.url)
+        subject.narrow_to_key_word = narrow
+        thread = threading.Thread(target=subject.main)
+        thread.daemon = True
+        thread.start()
+        while not server.queues:
+            time.sleep(0.01)
+
+        count = int(rate * seconds)
+        every = max(int(round(1 / command_ratio)), 1)
+        commands = len(range(0, count, every))
+
+        def make_message(i):
+            if i % every == 0:
+                return 'a@example.com', 'load', 'event %d' % i, 'rsvp init'
+            return 'a@example.com', 'load', 'chatter', 'just chatting about lunch, message %d' % i
+
+        storm = server.storm(rate, count, make_message)
+        storm.join()
+        server.wait_for_sent_messages(commands, timeout=drain_timeout)
+        drained_at = time.time()
+
+        return {
+            'posted': len(storm.sent),
+            'posted_rate': storm.achieved_rate,
+            'events': server.events_delivered['message'],
+            'events_rate': server.events_delivered['message'] / (drained_at - storm.started_at),
+            'commands': commands,
+            'latencies': storm.reply_latencies(),
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=200, help='messages posted per second')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--commands', type=float, default=0.1, help='fraction of the messages that are commands')
+    parser.add_argument('--no-narrow', dest='narrow', action='store_false',
+                        help="don't narrow the bot's event queue to the key word")
+    args = parser.parse_args()
+
+    result = run(args.rate, args.seconds, args.commands, args.narrow)
+    latencies = result['latencies']
+    print 'posted      %d messages at %.1f/s' % (result['posted'], result['posted_rate'])
+    print 'bot events  %d message events, %.1f/s sustained' % (result['events'], result['events_rate'])
+    print 'replies     %d of %d commands' % (len(latencies), result['commands'])
+    if latencies:
+        print 'latency     p50 %.1fms  p95 %.1fms  p99 %.1fms  max %.1fms' % tuple(
+            1000 * value for value in (percentile(latencies, 0.5), percentile(latencies, 0.95),
+                                       percentile(latencies, 0.99), max(latencies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Measures how many messages the bot downloads catching up on a stream of
+mostly-chatter messages sent while it was down, with and without the
+server-side key word narrow. (Event queues get every message: Zulip doesn't
+take a key word narrow for those, see Bot.narrow.)
+
+    python benchmarks/narrow.py [--messages 2000] [--commands 20]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+from fake_zulip import FakeZulipServer
+
+
+class BenchmarkBot(bot.Bot):
+    """A bot that keeps its files in a scratch directory."""
+
+    def __init__(self, directory, *args, **kwargs):
+        bot.Bot.__init__(self, *args, directory=directory, **kwargs)
+
+
+def run(narrow, messages, commands):
+    directory = tempfile.mkdtemp()
+    server = FakeZulipServer(streams=['bench'], users=[('a@example.com', 'Tester')], poll_timeout=0.1).start()
+    try:
+        subject = BenchmarkBot(directory, 'bot@example.com', 'key', 'rsvp', ['bench'], server.url)
+        subject.narrow_to_key_word = narrow
+        subject.connect()
+        # The bot goes down, and its event queue with it.
+        server.drop_queues()
+
+        every = max(messages // commands, 1)
+        for i in range(messages):
+            content = 'rsvp init' if i % every == 0 else 'just chatting about lunch, message %d' % i
+            server.send_message('a@example.com', 'bench', 'topic %d' % (i // every), content)
+
+        started = time.time()
+        subject.connect()
+        elapsed = time.time() - started
+
+        return server.messages_fetched, len(server.sent_messages), elapsed
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--commands', type=int, default=20)
+    args = parser.parse_args()
+
+    print '%-10s %18s %8s %10s' % ('narrow', 'messages fetched', 'replies', 'seconds')
+    for narrow in (False, True):
+        received, replies, elapsed = run(narrow, args.messages, args.commands)
+        print '%-10s %18d %8d %10.3f' % ('key word' if narrow else 'none', received, replies, elapsed)
+
+
+if __name__ == '__main__':
+    main()
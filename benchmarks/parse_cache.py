@@ -0,0 +1,49 @@
+"""
+Measures `rsvp set date` / `rsvp set duration` parsing with and without the
+parse caches, on a stream of inputs drawn from the few strings people actually
+send.
+
+    python benchmarks/parse_cache.py [--inputs 5000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rsvp_commands
+from parse_cache import ParseCache
+
+DATES = ['tomorrow', 'Tomorrow', 'next friday', 'friday', 'next week', 'monday', '02/25/2100', 'march 3']
+DURATIONS = ['1h', '1 h', '90 minutes', '2h', '30m', '1h30m', '45 minutes', '3 hours']
+
+
+def run(parse, inputs):
+    start = time.time()
+    for raw in inputs:
+        parse(raw)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--inputs', type=int, default=5000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    for name, parse, daily, choices in (
+            ('set date', rsvp_commands.parse_date, True, DATES),
+            ('set duration', rsvp_commands.parse_duration, False, DURATIONS)):
+        inputs = [random.choice(choices) for _ in range(args.inputs)]
+        cache = ParseCache(parse, daily=daily)
+
+        uncached = run(parse, inputs)
+        cached = run(cache, inputs)
+        print '%-12s uncached %.3fs, cached %.3fs (%.0fx), hit rate %.1f%%' % (
+            name, uncached, cached, uncached / cached, 100 * cache.hit_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures how long FileBackend takes to save and load stores of 10k and 100k
+events in every serializer format, against the old header-less `json.dump`.
+
+    python benchmarks/serializers.py [--sizes 10000 100000] [--repeat 3]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializers
+from backends import FileBackend
+
+
+def make_events(count):
+    events = {}
+    for i in range(count):
+        events[u'stream-%d/topic %d' % (i % 50, i)] = {
+            u'name': u'Event number %d' % i,
+            u'description': u'A description long enough to look like a real one, %d' % i,
+            u'yes': [u'user%d@example.com' % j for j in range(i % 12)],
+            u'no': [u'user%d@example.com' % j for j in range(i % 3)],
+            u'maybe': [],
+            u'creator': i % 1000,
+            u'duration': 3600,
+            u'place': u'Hopper!',
+            u'time': u'10:30',
+            u'date': u'2100-02-25',
+            u'limit': None,
+            u'calendar_event': None,
+        }
+    return events
+
+
+class LegacyBackend(FileBackend):
+    """How FileBackend read and wrote events before serializers."""
+
+    def get_all_events(self):
+        with open(self.filename, 'r') as f:
+            return json.load(f)
+
+    def commit_events(self, events, event_ids=None):
+        with open(self.filename, 'w+') as f:
+            json.dump(dict(events), f)
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'events.json')
+        backends = [('legacy json', LegacyBackend(filename))]
+        for name in sorted(serializers.SERIALIZERS):
+            backends.append((name, FileBackend(filename, serializers.get_serializer(name))))
+
+        print '%-8s %-12s %8s %8s %10s' % ('events', 'format', 'save', 'load', 'size')
+        for size in args.sizes:
+            events = make_events(size)
+            for name, backend in backends:
+                save = best_of(args.repeat, lambda: backend.commit_events(events))
+                load = best_of(args.repeat, backend.get_all_events)
+                assert backend.get_all_events() == events
+                print '%-8d %-12s %7.3fs %7.3fs %9.1fM' % (
+                    size, name, save, load, os.path.getsize(filename) / 1e6)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
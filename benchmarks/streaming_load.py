@@ -0,0 +1,102 @@
+"""
+Peak memory and time of loading a big events.json with FileBackend (which
+streams it an event at a time) against decoding the whole file at once, each
+in a fresh process so the peak resident set sizes don't mix.
+
+    python benchmarks/streaming_load.py [--events 20000 100000]
+
+Memory is resident memory over that of a process that only imported the
+modules, at its peak and once the events are loaded.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializers
+from backends import FileBackend
+
+MODES = ('baseline', 'whole', 'streaming')
+
+
+def make_events(count):
+    return dict(
+        ('stream %d/topic %d' % (i % 10, i), {
+            'name': 'Event number %d' % i,
+            'description': 'Come along and bring a friend! ' * 4,
+            'yes': ['person%d@example.com' % j for j in range(10)],
+            'no': ['other%d@example.com' % j for j in range(5)],
+            'maybe': [],
+            'limit': None,
+            'date': '2100-02-25',
+            'time': '10:30',
+            'duration': 3600,
+            'place': 'Hopper',
+            'calendar_event': None,
+            'creator': 'person0@example.com',
+        })
+        for i in range(count))
+
+
+def resident():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+
+
+def child(mode, filename, count):
+    """Loads the file one way, and prints the peak and final RSS in KiB and the time taken."""
+    start = time.time()
+    if mode == 'write':
+        serializers.dump(make_events(count), filename, serializers.get_serializer('json'))
+    elif mode == 'whole':
+        with open(filename, 'rb') as f:
+            events = json.loads(f.read().partition('\n')[2])
+    elif mode == 'streaming':
+        events = FileBackend(filename).get_all_events()
+    seconds = time.time() - start
+    print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resident(), seconds
+
+
+def measure(mode, filename, count):
+    output = subprocess.check_output([sys.executable, __file__, '--child', mode, filename, str(count)])
+    peak, final, seconds = output.split()
+    return int(peak), int(final), float(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, nargs='+', default=[20000, 100000])
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, filename, count = args.child
+        return child(mode, filename, int(count))
+
+    directory = tempfile.mkdtemp()
+    try:
+        print '%8s %8s %9s %26s %26s' % ('events', 'file', 'baseline', 'whole: peak/loaded/time', 'streaming: peak/loaded/time')
+        for count in args.events:
+            filename = os.path.join(directory, 'events.json')
+            # Also in a child: peak RSS survives fork and exec.
+            measure('write', filename, count)
+            results = dict((mode, measure(mode, filename, count)) for mode in MODES)
+            baseline = results['baseline'][0]
+            row = [count, os.path.getsize(filename) / 1048576.0, baseline / 1024.0]
+            for mode in ('whole', 'streaming'):
+                peak, final, seconds = results[mode]
+                row.extend([(peak - baseline) / 1024.0, (final - baseline) / 1024.0, seconds])
+            print '%8d %7.1fM %8.1fM %10.1fM %6.1fM %5.2fs %10.1fM %6.1fM %5.2fs' % tuple(row)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
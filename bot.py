@@ -1,43 +1,119 @@
 #! /usr/local/bin/python
+import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 
 import zulip
 
+import http_pool
+import memory
+import replication
 import rsvp
+import strings
+import tracing
 import zulip_users
 
-from backends import FileBackend
+from backends import DbmBackend, FileBackend
+from event_queue import EventQueueState
+from processed_messages import ProcessedMessages
+from reminders import ReminderScheduler, parse_offsets
 
 
 class Bot():
     """ bot takes a zulip username and api key, a word or phrase to respond to,
         an optional list of the zulip streams it should be active in,
-        and the zulip site to connect to.
+        the zulip site to connect to, and an optional list of timedeltas before
+        an event's start at which to post reminders in the event's thread.
+
+        It keeps its files in `directory` (the current one by default) and
+        makes its Zulip API calls through `http_session`, a requests.Session
+        several bots can share (see tenants.py), or a session of its own.
      """
-    def __init__(self, zulip_username, zulip_api_key, key_word, subscribed_streams=None, zulip_site=None):
+    event_types = ['message', 'realm_user', 'stream']
+    catch_up_batch_size = 100
+    subscription_chunk_size = 100
+    # Have Zulip only send us messages that mention the key word when catching up.
+    narrow_to_key_word = True
+    # The longest to wait between two attempts at registering an event queue, in seconds.
+    register_max_delay = 60
+    # How often to sync the users directory in the background, 0 for never.
+    users_sync_interval = zulip_users.USERS_SYNC_INTERVAL
+    # How often to write a memory report to the trace file, 0 for never.
+    memory_interval = memory.MEMORY_INTERVAL
+
+    def __init__(self, zulip_username, zulip_api_key, key_word, subscribed_streams=None, zulip_site=None,
+                 reminder_offsets=None, directory='', http_session=None):
         self.key_word = key_word.lower()
         self.subscribed_streams = subscribed_streams or []
+        self._streams = None
+        self.directory = directory
+        self.stopped = False
+        self.stopped_event = threading.Event()
         self.client = zulip.Client(zulip_username, zulip_api_key, site=zulip_site)
+        http_pool.pool(self.client, http_session or http_pool.make_session())
         self.client._register('get_users', method='GET', url='users')
-        self.subscriptions = self.subscribe_to_streams()
-        self.rsvp = rsvp.RSVP(key_word, self.get_backend())
+        self.client._register('get_message_history', method='GET', url='messages')
+        self.subscriptions = None
+        # Every realm has its own users, and their ids, so every bot its own directory of them.
+        self.users_filename = self.path('zulip_users.json')
+        self.rsvp = rsvp.RSVP(key_word, self.get_backend(), self.users_filename)
+        self.processed_messages = self.get_processed_messages()
+        self.event_queue = self.get_event_queue_state()
+
+        self.reminders_thread = None
+        self.users_sync = None
+        self.memory_reports = None
+        self.reminders = None
+        if reminder_offsets:
+            self.reminders = ReminderScheduler(reminder_offsets, source=lambda: self.rsvp.events)
+            self.rsvp.observers.append(self.reminders)
 
 
     def get_backend(self):
         """
         Return an instance of a backend class that this bot will use
         """
-        return FileBackend(filename='events.json')
+        if os.getenv('ZULIP_RSVP_BACKEND') == 'dbm':
+            backend = DbmBackend(filename=self.path('events.db'))
+        else:
+            backend = FileBackend(filename=self.path('events.json'))
+
+        if replication.REPLICATION_LOG:
+            # Ship every change to a standby, see replication.py.
+            log = replication.ReplicationLog(self.path(replication.REPLICATION_LOG))
+            return replication.ShippingBackend(backend, log)
+        return backend
+
+    def get_processed_messages(self):
+        """
+        Return the record of already handled message ids, used to drop redelivered messages.
+        """
+        return ProcessedMessages(filename=self.path('processed_messages.log'))
+
+    def get_event_queue_state(self):
+        """
+        Return the saved position in the Zulip event queue, used to resume it after a restart.
+        """
+        return EventQueueState(filename=self.path('event_queue.json'))
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
 
     @property
     def streams(self):
-        """Standardizes a list of streams in the form [{'name': stream}]."""
-        if not self.subscribed_streams:
-            streams = [{'name': stream['name']} for stream in self.get_all_zulip_streams()]
-            return streams
-        else:
-            streams = [{'name': stream} for stream in self.subscribed_streams]
-            return streams
+        """Standardizes a list of streams in the form [{'name': stream}].
+
+        The list is fetched once and then kept up to date by `stream` events.
+        """
+        if self._streams is None:
+            if not self.subscribed_streams:
+                names = [stream['name'] for stream in self.get_all_zulip_streams()]
+            else:
+                names = self.subscribed_streams
+            self._streams = OrderedDict((name.lower(), {'name': name}) for name in names)
+        return self._streams.values()
 
     def get_all_zulip_streams(self):
         """Call Zulip API to get a list of all streams."""
@@ -47,41 +123,241 @@ class Bot():
         else:
             raise RuntimeError('check yo auth')
 
+    def get_subscribed_stream_names(self):
+        """Call Zulip API to get the (lowercased) names of the streams the bot is already subscribed to."""
+        response = self.client.list_subscriptions()
+        if response['result'] == 'success':
+            return set(stream['name'].lower() for stream in response['subscriptions'])
+        return set()
+
     def subscribe_to_streams(self):
-        """Subscribes to zulip streams."""
-        self.client.add_subscriptions(self.streams)
+        """Subscribes to the zulip streams we aren't subscribed to yet, a chunk at a time."""
+        subscribed = self.get_subscribed_stream_names()
+        missing = [stream for stream in self.streams if stream['name'].lower() not in subscribed]
+
+        for start in range(0, len(missing), self.subscription_chunk_size):
+            self.client.add_subscriptions(missing[start:start + self.subscription_chunk_size])
+        return missing
+
+    def update_streams(self, event):
+        """Follows streams being created and deleted when the bot is active in all streams."""
+        if self.subscribed_streams:
+            return
+
+        self.streams  # make sure the cache is loaded
+        for stream in event['streams']:
+            key = stream['name'].lower()
+            if event['op'] == 'create' and key not in self._streams:
+                self._streams[key] = {'name': stream['name']}
+                self.client.add_subscriptions([self._streams[key]])
+            elif event['op'] == 'delete':
+                self._streams.pop(key, None)
 
     def process(self, event):
-        if event['type'] == 'realm_user':
-            zulip_users.update_zulip_user_dict(event['person'], self.client)
-        elif event['type'] == 'message':
-            self.respond(event['message'])
+        with tracing.trace('bot.process', event=event['type']) as span:
+            if event['type'] == 'realm_user':
+                zulip_users.update_zulip_user_dict(event['person'], self.client, self.users_filename)
+            elif event['type'] == 'stream':
+                self.update_streams(event)
+            elif event['type'] == 'message':
+                span.annotate(message_id=event['message']['id'])
+                self.event_queue.saw_message(event['message']['id'])
+                if self.processed_messages.add(event['message']['id']):
+                    self.respond(event['message'])
 
     def respond(self, message):
         """Now we have an event dict, we should analyze it completely."""
 
         replies = self.rsvp.process_message(message)
 
-        for reply in replies:
-            if reply:
-                self.send_message(reply)
+        for reply in coalesce_replies(reply for reply in replies if reply):
+            self.send_message(reply)
 
     def send_message(self, msg):
         """Sends a message to zulip stream or user."""
-        msg_to = msg['display_recipient']
-        if msg['type'] == 'private':
-            msg_to = msg.get('sender_email') or msg_to
-
-        self.client.send_message({
-            "type": msg['type'],
-            "subject": msg["subject"],
-            "to": msg_to,
-            "content": msg['body']
+        with tracing.span('zulip.send_message', type=msg['type']):
+            self.client.send_message({
+                "type": msg['type'],
+                "subject": msg["subject"],
+                "to": message_recipient(msg),
+                "content": msg['body']
+            })
+
+    def send_reminder(self, event_id, offset):
+        """Posts a reminder that `event_id` starts in `offset` into its thread."""
+        event = self.rsvp.events.get(event_id)
+        if not event:
+            return
+
+        stream, _, topic = event_id.partition('/')
+        self.send_message({
+            'type': 'stream',
+            'display_recipient': stream,
+            'subject': topic,
+            'body': strings.MSG_REMINDER % (event['name'], offset),
         })
 
+    def start_reminders(self):
+        """Sends reminders from a background thread."""
+        thread = threading.Thread(target=self.reminders.run, args=(self.send_reminder,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start_users_sync(self):
+        """Syncs the users directory from a background thread, catching the
+        `realm_user` events the bot missed while it was down."""
+        thread = threading.Thread(target=zulip_users.run_sync,
+                                  args=(self.client, self.users_sync_interval, self.users_filename),
+                                  kwargs={'stopped': self.stopped_event})
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start_memory_reports(self):
+        """Writes memory reports (see memory.py) from a background thread."""
+        thread = threading.Thread(target=memory.run,
+                                  args=(lambda: self.rsvp.events, self.memory_interval, self.users_filename),
+                                  kwargs={'stopped': self.stopped_event})
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @property
+    def narrow(self):
+        """The narrow for the message history we catch up on.
+
+        Zulip ANDs the terms of a narrow, so there is no way to ask for "the key word
+        OR a private message". We don't need to: only lines starting with the key
+        word get a reply, so private messages without it are chatter as well.
+
+        The event queue doesn't get it: Zulip only takes the stream, topic, sender
+        and is operators for those, and refuses a `search`.
+        """
+        if self.narrow_to_key_word:
+            return [['search', self.key_word]]
+        return []
+
+    def connect(self):
+        """Resumes the saved event queue if the server still has it. Otherwise
+        subscribes to the streams and registers a new one."""
+        if self.event_queue.queue_id is not None and self.poll_events(dont_block=True):
+            return
+        self.subscriptions = self.subscribe_to_streams()
+        self.register()
+
+    def register(self):
+        """Registers a new event queue and catches up on the messages sent since
+        the last one we saw, which the old queue would have delivered."""
+        delay = 1
+        while True:
+            response = self.client.register(event_types=self.event_types)
+            if response['result'] == 'success':
+                break
+            logging.warning('Could not register an event queue, trying again in %ds: %s', delay, response.get('msg'))
+            time.sleep(delay)
+            delay = min(delay * 2, self.register_max_delay)
+
+        catch_up_from = self.event_queue.last_message_id
+        self.event_queue.queue_id = response['queue_id']
+        self.event_queue.last_event_id = response['last_event_id']
+        if catch_up_from is None:
+            self.event_queue.last_message_id = response.get('max_message_id')
+        self.event_queue.save()
+
+        if catch_up_from is not None:
+            self.catch_up(catch_up_from, response.get('max_message_id'))
+
+    def catch_up(self, last_message_id, max_message_id):
+        """Processes the messages after `last_message_id` up to (and including)
+        `max_message_id`; anything newer is delivered by the new event queue."""
+        anchor = last_message_id + 1
+        while max_message_id is None or anchor <= max_message_id:
+            response = self.client.get_message_history({
+                'anchor': anchor,
+                'num_before': 0,
+                'num_after': self.catch_up_batch_size,
+                'narrow': self.narrow,
+                'apply_markdown': False,
+            })
+            if response['result'] != 'success' or not response['messages']:
+                break
+
+            for message in response['messages']:
+                if message['id'] < anchor or (max_message_id is not None and message['id'] > max_message_id):
+                    continue
+                self.process({'type': 'message', 'message': message})
+
+            if response.get('found_newest'):
+                break
+            anchor = response['messages'][-1]['id'] + 1
+
+        self.event_queue.save()
+
+    def poll_events(self, dont_block=False):
+        """Fetches and processes one batch of events from the event queue.
+        Returns False if the server doesn't know about our queue anymore."""
+        response = self.client.get_events(
+            queue_id=self.event_queue.queue_id,
+            last_event_id=self.event_queue.last_event_id,
+            dont_block=dont_block,
+        )
+
+        if response['result'] != 'success':
+            if response.get('code') == 'BAD_EVENT_QUEUE_ID' or response.get('msg', '').startswith('Bad event queue id'):
+                self.event_queue.reset()
+                return False
+            # Probably a server restart or a network hiccup, try again in a bit.
+            time.sleep(1)
+            return True
+
+        for event in response['events']:
+            self.process(event)
+            self.event_queue.last_event_id = max(self.event_queue.last_event_id, event['id'])
+        self.event_queue.save()
+        return True
+
     def main(self):
-        """Blocking call that runs forever. Calls self.respond() on every event received."""
-        self.client.call_on_each_event(self.process, ['message', 'realm_user'])
+        """Blocking call that runs until stop() is called. Calls self.process() on every event received."""
+        # A bot restarted after a crash (see tenants.py) keeps its background threads.
+        if self.reminders is not None and not (self.reminders_thread and self.reminders_thread.is_alive()):
+            self.reminders_thread = self.start_reminders()
+        if self.users_sync_interval and not (self.users_sync and self.users_sync.is_alive()):
+            self.users_sync = self.start_users_sync()
+        if self.memory_interval and not (self.memory_reports and self.memory_reports.is_alive()):
+            self.memory_reports = self.start_memory_reports()
+        self.connect()
+        while not self.stopped:
+            if not self.poll_events():
+                self.register()
+
+    def stop(self):
+        """Makes main() return once the current poll is over."""
+        self.stopped = True
+        self.stopped_event.set()
+
+
+def message_recipient(msg):
+    """Who a reply goes to: the stream, or the user for private replies."""
+    if msg['type'] == 'private':
+        return msg.get('sender_email') or msg['display_recipient']
+    return msg['display_recipient']
+
+
+def coalesce_replies(replies):
+    """Merges the replies going to the same place (type, recipient and subject)
+    into one message each, so one inbound message doesn't turn into a burst of
+    outbound ones. Messages are ordered by their first reply, and the bodies
+    keep their original order.
+    """
+    coalesced = OrderedDict()
+    for reply in replies:
+        key = (reply['type'], message_recipient(reply), reply['subject'])
+        if key in coalesced:
+            coalesced[key]['body'] += '\n\n' + reply['body']
+        else:
+            coalesced[key] = dict(reply)
+    return coalesced.values()
 
 
 """ The Customization Part!
@@ -92,20 +368,22 @@ class Bot():
         single word or a phrase.
     subscribed_streams is a list of the streams the bot should be active on. An empty
         list defaults to ALL zulip streams
+    reminder_offsets is how long before an event starts the bot should post reminders
+        in its thread, e.g. "1d,1h". Empty means no reminders.
 
 """
-if __name__ == "__main__":
-    ZULIP_USERNAME = os.environ['ZULIP_RSVP_EMAIL']
-    ZULIP_API_KEY = os.environ['ZULIP_RSVP_KEY']
-    ZULIP_SITE = os.getenv('ZULIP_RSVP_SITE', 'https://recurse.zulipchat.com')
-    KEY_WORD = os.getenv('ZULIP_KEY_WORD', 'rsvp')
-    SANDBOX_STREAM = os.getenv('ZULIP_RSVP_SANDBOX_STREAM', None)
-    SUBSCRIBED_STREAMS = []
-    new_bot = Bot(
-        ZULIP_USERNAME,
-        ZULIP_API_KEY,
-        KEY_WORD,
-        SUBSCRIBED_STREAMS,
-        ZULIP_SITE,
+def from_environment(directory=''):
+    """The bot configured by the environment variables, keeping its files in `directory`."""
+    return Bot(
+        os.environ['ZULIP_RSVP_EMAIL'],
+        os.environ['ZULIP_RSVP_KEY'],
+        os.getenv('ZULIP_KEY_WORD', 'rsvp'),
+        [],
+        os.getenv('ZULIP_RSVP_SITE', 'https://recurse.zulipchat.com'),
+        parse_offsets(os.getenv('ZULIP_RSVP_REMINDERS', '')),
+        directory=directory,
     )
-    new_bot.main()
+
+
+if __name__ == "__main__":
+    from_environment().main()
@@ -2,32 +2,41 @@
 import datetime
 import os
 import re
+import threading
 
 from apiclient import discovery
+from googleapiclient.discovery_cache import base
 import httplib2
 from oauth2client.service_account import ServiceAccountCredentials
 
+import tracing
 from util import stream_topic_to_narrow_url
+from zulip_users import ZulipUsers
 
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', None)
 GOOGLE_CALENDAR_ID = os.getenv('GOOGLE_CALENDAR_ID', None)
+# Where to find the Calendar API instead of Google, e.g. a fake_gcal.py server.
+GOOGLE_CALENDAR_API_URL = os.getenv('GOOGLE_CALENDAR_API_URL', None)
+# How many times to retry calls failing with 5xx/rate limit errors, with backoff.
+GOOGLE_CALENDAR_RETRIES = int(os.getenv('GOOGLE_CALENDAR_RETRIES', 0))
 
 
-def add_rsvpbot_event_to_gcal(rsvpbot_event, rsvpbot_event_id):
-    """Given an RSVPBot event dict, create a calendar event."""
-    event_dict = _format_rsvpbot_event_for_gcal(rsvpbot_event, rsvpbot_event_id)
+def add_rsvpbot_event_to_gcal(rsvpbot_event, rsvpbot_event_id, users_filename='zulip_users.json'):
+    """Given an RSVPBot event dict, create a calendar event. Attendees' emails
+    come from the user directory in `users_filename`."""
+    event_dict = _format_rsvpbot_event_for_gcal(rsvpbot_event, rsvpbot_event_id, users_filename)
 
     return create_event_on_calendar(event_dict, GOOGLE_CALENDAR_ID)
 
 
-def update_gcal_event(rsvpbot_event, rsvpbot_event_id):
+def update_gcal_event(rsvpbot_event, rsvpbot_event_id, users_filename='zulip_users.json'):
     """Updates an existing calendar event based on an updated rsvpbot event
 
     It is expected that the rsvp_bot event has an existing calendar event
     id stored so it knows which event to update.
     """
     event_id = rsvpbot_event['calendar_event']['id']
-    new_event_details = _format_rsvpbot_event_for_gcal(rsvpbot_event, rsvpbot_event_id)
+    new_event_details = _format_rsvpbot_event_for_gcal(rsvpbot_event, rsvpbot_event_id, users_filename)
 
     return update_event_on_calendar(event_id, new_event_details, GOOGLE_CALENDAR_ID)
 
@@ -37,13 +46,15 @@ def create_event_on_calendar(event_dict, calendar_id):
     service = _get_calendar_service()
 
     if service and calendar_id:
-        calendar = service.calendars().get(calendarId=calendar_id).execute()
+        with tracing.span('gcal.calendars.get'):
+            calendar = service.calendars().get(calendarId=calendar_id).execute(num_retries=GOOGLE_CALENDAR_RETRIES)
         result = {'calendar_name': calendar['summary']}
 
-        event = service.events().insert(
-            calendarId=calendar_id,
-            body=event_dict,
-        ).execute()
+        with tracing.span('gcal.events.insert'):
+            event = service.events().insert(
+                calendarId=calendar_id,
+                body=event_dict,
+            ).execute(num_retries=GOOGLE_CALENDAR_RETRIES)
 
         result.update(event)
         return result
@@ -56,31 +67,75 @@ def update_event_on_calendar(event_id, event_dict, calendar_id):
     service = _get_calendar_service()
 
     if service and calendar_id:
-        event = service.events().patch(
-            calendarId=calendar_id,
-            eventId=event_id,
-            body=event_dict
-        ).execute()
+        with tracing.span('gcal.events.patch'):
+            event = service.events().patch(
+                calendarId=calendar_id,
+                eventId=event_id,
+                body=event_dict
+            ).execute(num_retries=GOOGLE_CALENDAR_RETRIES)
         return event
     else:
         return None
 
 
+class DiscoveryCache(base.Cache):
+    """Keeps the discovery documents services are built from in memory, for
+    every thread, so the process only fetches each one once."""
+
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            return self.documents.get(url)
+
+    def set(self, url, content):
+        with self.lock:
+            self.documents[url] = content
+
+
+_discovery_cache = DiscoveryCache()
+# Built services, per thread: they make their calls through an httplib2.Http,
+# which mustn't be used by two threads at once.
+_services = threading.local()
+
+
 def _get_calendar_service():
+    """Returns this thread's service for the configured credentials and API,
+    building it the first time."""
+    key = (GOOGLE_APPLICATION_CREDENTIALS, GOOGLE_CALENDAR_API_URL)
+    services = _services.__dict__.setdefault('services', {})
+    if key not in services:
+        with tracing.span('gcal.build_service'):
+            services[key] = _build_calendar_service()
+    return services[key]
+
+
+def _build_calendar_service():
     scopes = ['https://www.googleapis.com/auth/calendar']
     path_to_keyfile = GOOGLE_APPLICATION_CREDENTIALS
-    if not path_to_keyfile:
+    if not path_to_keyfile and not GOOGLE_CALENDAR_API_URL:
         raise KeyfilePathNotSpecifiedError
 
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        path_to_keyfile, scopes=scopes)
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('calendar', 'v3', http=http)
+    http = httplib2.Http()
+    if path_to_keyfile:
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(
+            path_to_keyfile, scopes=scopes)
+        http = credentials.authorize(http)
+
+    if GOOGLE_CALENDAR_API_URL:
+        # Stand-ins don't need credentials, and serve their own discovery document.
+        discovery_url = GOOGLE_CALENDAR_API_URL.rstrip('/') + '/discovery/v1/apis/{api}/{apiVersion}/rest'
+        return discovery.build('calendar', 'v3', http=http, discoveryServiceUrl=discovery_url,
+                               cache=_discovery_cache)
+
+    service = discovery.build('calendar', 'v3', http=http, cache=_discovery_cache)
 
     return service
 
 
-def _format_rsvpbot_event_for_gcal(rsvpbot_event, event_id):
+def _format_rsvpbot_event_for_gcal(rsvpbot_event, event_id, users_filename='zulip_users.json'):
     """Convert an RSVPBot event dict into the format needed for
     the Google Calendar API."""
 
@@ -113,14 +168,16 @@ def _format_rsvpbot_event_for_gcal(rsvpbot_event, event_id):
     end_date = start_date + duration
 
     email_regex = re.compile(r"[^@]+@[^@]+\.[^@]+")
+    # Attendees are user ids (or, in older events, emails): the calendar wants emails.
+    users = ZulipUsers(users_filename)
 
     rsvp_yes_attendee_list = [
-        {'email': entity, 'responseStatus': 'accepted'} for entity in rsvpbot_event['yes']
+        {'email': entity, 'responseStatus': 'accepted'} for entity in users.emails(rsvpbot_event['yes'])
         if email_regex.match(entity)
     ]
 
     rsvp_maybe_attendee_list = [
-        {'email': entity, 'responseStatus': 'tentative'} for entity in rsvpbot_event['maybe']
+        {'email': entity, 'responseStatus': 'tentative'} for entity in users.emails(rsvpbot_event['maybe'])
         if email_regex.match(entity)
     ]
 
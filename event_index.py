@@ -0,0 +1,149 @@
+"""
+Keeps RSVPBot events sorted by their start time so that "what's coming up"
+queries don't have to walk (and parse) the whole events dictionary.
+
+Entries are `(start, event_id, end)` tuples kept in sorted lists, one for the
+whole store and one per stream, so a range query is a bisect plus a slice.
+
+Updates replace the lists rather than modifying them, so a query running in
+another thread works on a consistent list without any locking.
+
+An index can also be built lazily from a `source` callable returning the current
+events, the first time it is queried. Updates made before that are ignored:
+the events `source` returns already include them.
+"""
+import bisect
+import datetime
+import threading
+
+
+def event_start_and_end(event):
+    """Returns the `(start, end)` datetimes of an RSVPBot event dict, or
+    `(None, None)` if the event has no usable date.
+
+    All day events (no `time`) start at midnight and last the whole day unless
+    they have an explicit `duration`.
+    """
+    date = event.get('date')
+    if not date:
+        return None, None
+
+    try:
+        if event.get('time'):
+            start = datetime.datetime.strptime('%s %s' % (date, event['time']), '%Y-%m-%d %H:%M')
+            default_duration = datetime.timedelta(0)
+        else:
+            start = datetime.datetime.strptime(date, '%Y-%m-%d')
+            default_duration = datetime.timedelta(days=1)
+    except ValueError:
+        return None, None
+
+    duration = event.get('duration')
+    end = start + (datetime.timedelta(seconds=duration) if duration else default_duration)
+    return start, end
+
+
+def event_stream(event_id):
+    """The (case-insensitive, like Zulip's) stream part of an `<stream>/<topic>` event id."""
+    return event_id.split('/')[0].lower()
+
+
+class EventIndex(object):
+    """Secondary index of events ordered by start time."""
+
+    def __init__(self, events=None, source=None):
+        self.entries = []
+        self.streams = {}
+        self.keys = {}
+        self.source = source
+        self.build_lock = threading.Lock()
+
+        if events:
+            self._build(events)
+
+    def _build(self, events):
+        for event_id, event in events.iteritems():
+            start, end = event_start_and_end(event)
+            if start is not None:
+                self.keys[event_id] = (start, end)
+                self.entries.append((start, event_id, end))
+                self.streams.setdefault(event_stream(event_id), []).append((start, event_id, end))
+
+        self.entries.sort()
+        for entries in self.streams.values():
+            entries.sort()
+
+    def _ensure_built(self):
+        if self.source is None:
+            return
+        with self.build_lock:
+            if self.source is not None:
+                self._build(self.source())
+                self.source = None
+
+    def __len__(self):
+        self._ensure_built()
+        return len(self.keys)
+
+    def __contains__(self, event_id):
+        self._ensure_built()
+        return event_id in self.keys
+
+    def update(self, event_id, event):
+        """(Re)indexes `event_id`. Passing `None` as the event removes it."""
+        with self.build_lock:
+            if self.source is None:
+                self._update(event_id, event)
+
+    def _update(self, event_id, event):
+        start, end = event_start_and_end(event) if event else (None, None)
+        if self.keys.get(event_id) == (start, end):
+            return
+
+        self.remove(event_id)
+        if start is None:
+            return
+
+        self.keys[event_id] = (start, end)
+        entry = (start, event_id, end)
+        stream = event_stream(event_id)
+        self.entries = self._with_entry(self.entries, entry)
+        self.streams[stream] = self._with_entry(self.streams.get(stream, []), entry)
+
+    def remove(self, event_id):
+        key = self.keys.pop(event_id, None)
+        if key is None:
+            return
+
+        entry = (key[0], event_id, key[1])
+        self.entries = self._without_entry(self.entries, entry)
+
+        stream = event_stream(event_id)
+        stream_entries = self._without_entry(self.streams[stream], entry)
+        if stream_entries:
+            self.streams[stream] = stream_entries
+        else:
+            del self.streams[stream]
+
+    def _with_entry(self, entries, entry):
+        position = bisect.bisect_left(entries, entry)
+        return entries[:position] + [entry] + entries[position:]
+
+    def _without_entry(self, entries, entry):
+        position = bisect.bisect_left(entries, entry)
+        if position < len(entries) and entries[position] == entry:
+            return entries[:position] + entries[position + 1:]
+        return entries
+
+    def between(self, since, until, stream=None):
+        """Returns `(start, end, event_id)` for every event starting in the
+        `[since, until)` interval, in chronological order.
+        """
+        self._ensure_built()
+        entries = self.entries if stream is None else self.streams.get(stream.lower(), [])
+
+        # `event_id`s are strings, so `(since, u'')` sorts before any entry at `since`.
+        low = bisect.bisect_left(entries, (since, u''))
+        high = bisect.bisect_left(entries, (until, u''))
+
+        return [(start, end, event_id) for start, event_id, end in entries[low:high]]
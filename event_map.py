@@ -0,0 +1,199 @@
+"""
+Copy-on-write storage for the events dictionary.
+
+An `EventMap` is an immutable snapshot of all the events: anything holding one
+(a read-only command, an export, the reminders thread...) sees a consistent
+view without any locking, however many writes happen in the meantime.
+
+Writers `begin()` an `EventMapTransaction`, a dict-like view of the snapshot in
+which events are copied the first time they're accessed, and `publish()` it as a
+new `EventMap`. Publishing never modifies the snapshot it started from.
+
+A snapshot is a shared, never modified `base` dict plus a small dict of the
+changes made since that base was built, so publishing costs O(changes) rather
+than O(events). Once the changes grow past a fraction of the base, they are
+folded into a fresh base dict.
+
+The base may also be a lazy mapping, like the LazyEvents of a DbmBackend, that
+loads events as they're read. It is then never copied into a dict: compacting
+asks it for a new mapping `with_changes` applied, and the number of events is
+only counted if someone asks for it.
+"""
+import copy
+
+_DELETED = object()
+_MISSING = object()
+
+
+class EventMap(object):
+
+    # Fold the changes into a new base once they're more than 1/8th of it.
+    compaction_ratio = 8
+    min_compaction_size = 64
+
+    def __init__(self, events=None):
+        """`events` becomes the base of the snapshot and must not be modified afterwards."""
+        self._base = events if events is not None else {}
+        self._changes = {}
+        # None until counted, for lazy bases.
+        self._len = len(self._base) if isinstance(self._base, dict) else None
+
+    @classmethod
+    def _version(cls, base, changes, length):
+        version = cls.__new__(cls)
+        version._base = base
+        version._changes = changes
+        version._len = length
+        return version
+
+    def get(self, event_id, default=None):
+        event = self._changes.get(event_id, _MISSING)
+        if event is _MISSING:
+            return self._base.get(event_id, default)
+        return default if event is _DELETED else event
+
+    def __getitem__(self, event_id):
+        event = self.get(event_id, _MISSING)
+        if event is _MISSING:
+            raise KeyError(event_id)
+        return event
+
+    def __contains__(self, event_id):
+        return self.get(event_id, _MISSING) is not _MISSING
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+    def __iter__(self):
+        for event_id in self._base:
+            if event_id not in self._changes:
+                yield event_id
+        for event_id, event in self._changes.items():
+            if event is not _DELETED:
+                yield event_id
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        """Iterates over the events without making a lazy base keep them loaded."""
+        for event_id, event in self._base.iteritems():
+            if event_id not in self._changes:
+                yield event_id, event
+        for event_id, event in self._changes.items():
+            if event is not _DELETED:
+                yield event_id, event
+
+    def values(self):
+        return [self[event_id] for event_id in self]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'EventMap(%r)' % self.to_dict()
+
+    def begin(self):
+        """Starts a transaction on top of this snapshot."""
+        return EventMapTransaction(self)
+
+    def replace(self, events):
+        """Returns a new snapshot with `events` (event_id -> event, or None if
+        it was deleted) in place of the ones in this one."""
+        return self._publish(dict(
+            (event_id, _DELETED if event is None else event) for event_id, event in events.items()))
+
+    def _publish(self, changes):
+        """Returns a new snapshot with `changes` (event_id -> event or _DELETED) applied."""
+        merged = dict(self._changes)
+        length = self._len
+        for event_id, event in changes.items():
+            if length is not None:
+                existed = event_id in self
+                if event is _DELETED:
+                    length -= existed
+                else:
+                    length += not existed
+            merged[event_id] = event
+
+        if len(merged) <= max(self.min_compaction_size, (self._len or 0) // self.compaction_ratio):
+            return self._version(self._base, merged, length)
+
+        if hasattr(self._base, 'with_changes'):
+            base = self._base.with_changes(dict(
+                (event_id, None if event is _DELETED else event) for event_id, event in merged.items()))
+            return self._version(base, {}, length)
+
+        base = dict(self._base)
+        for event_id, event in merged.items():
+            if event is _DELETED:
+                base.pop(event_id, None)
+            else:
+                base[event_id] = event
+        return self._version(base, {}, length)
+
+
+class EventMapTransaction(object):
+    """A writable, dict-like view of an EventMap.
+
+    Events are deep-copied out of the snapshot the first time they are read, so
+    they can be modified in place. Only the events passed to `publish` make it
+    into the new snapshot; everything else done in the transaction is dropped.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.changes = {}
+
+    def get(self, event_id, default=None):
+        if event_id in self.changes:
+            event = self.changes[event_id]
+            return default if event is _DELETED else event
+
+        event = self.snapshot.get(event_id, _MISSING)
+        if event is _MISSING:
+            return default
+
+        event = copy.deepcopy(event)
+        self.changes[event_id] = event
+        return event
+
+    def __getitem__(self, event_id):
+        event = self.get(event_id, _MISSING)
+        if event is _MISSING:
+            raise KeyError(event_id)
+        return event
+
+    def __setitem__(self, event_id, event):
+        self.changes[event_id] = event
+
+    def __delitem__(self, event_id):
+        self.pop(event_id)
+
+    def __contains__(self, event_id):
+        if event_id in self.changes:
+            return self.changes[event_id] is not _DELETED
+        return event_id in self.snapshot
+
+    def pop(self, event_id, *default):
+        event = self.get(event_id, _MISSING)
+        if event is _MISSING:
+            if default:
+                return default[0]
+            raise KeyError(event_id)
+        self.changes[event_id] = _DELETED
+        return event
+
+    def update(self, events):
+        for event_id, event in dict(events).items():
+            self[event_id] = event
+
+    def publish(self, event_ids):
+        """Returns a new EventMap with the changes made to `event_ids`."""
+        return self.snapshot._publish(
+            dict((event_id, self.changes[event_id]) for event_id in event_ids if event_id in self.changes))
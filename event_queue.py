@@ -0,0 +1,43 @@
+"""
+Persists where the bot is in its Zulip event queue, so that a restarted bot can
+pick up the same queue (and the events that arrived while it was down) instead
+of registering a new one.
+"""
+import json
+
+
+class EventQueueState(object):
+
+    def __init__(self, filename='event_queue.json'):
+        self.filename = filename
+        self.queue_id = None
+        self.last_event_id = None
+        # The newest message the bot has seen; where to catch up from if the queue is lost.
+        self.last_message_id = None
+
+        try:
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+
+        self.queue_id = state.get('queue_id')
+        self.last_event_id = state.get('last_event_id')
+        self.last_message_id = state.get('last_message_id')
+
+    def save(self):
+        with open(self.filename, 'w+') as f:
+            json.dump({
+                'queue_id': self.queue_id,
+                'last_event_id': self.last_event_id,
+                'last_message_id': self.last_message_id,
+            }, f)
+
+    def reset(self):
+        """Forget the current queue. `last_message_id` is kept to catch up from."""
+        self.queue_id = None
+        self.last_event_id = None
+        self.save()
+
+    def saw_message(self, message_id):
+        self.last_message_id = max(self.last_message_id, message_id)
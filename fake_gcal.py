@@ -0,0 +1,293 @@
+"""
+A local stand-in for the parts of the Google Calendar v3 API calendar_events.py
+uses, so calendar sync can be exercised (and benchmarked) end to end over HTTP
+with the real google-api-python-client, without a Google account.
+
+    server = FakeCalendarServer(calendars={'rsvpbot@example.com': 'RSVPBot'}, latency=0.05)
+    server.start()
+    # export GOOGLE_CALENDAR_API_URL=<server.url> GOOGLE_CALENDAR_ID=rsvpbot@example.com
+    ...
+    server.stop()
+
+Supported requests:
+
+    GET  discovery/v1/apis/calendar/v3/rest    (the discovery document)
+    GET  calendar/v3/calendars/<calendarId>                   (calendars.get)
+    POST calendar/v3/calendars/<calendarId>/events            (events.insert)
+    PATCH calendar/v3/calendars/<calendarId>/events/<eventId> (events.patch)
+    POST batch/calendar/v3                      (any of the above, batched)
+
+`latency` seconds are added to every HTTP request, and `error_rate` is the
+probability of any API call (including each call of a batch) failing with a
+503 backendError, which the client library retries when asked to.
+"""
+import BaseHTTPServer
+import SocketServer
+import email
+import itertools
+import json
+import random
+import threading
+import time
+import urlparse
+
+DISCOVERY_PATH = 'discovery/v1/apis/calendar/v3/rest'
+
+
+def discovery_document(root_url):
+    """The subset of the Calendar v3 discovery document the client needs for our calls."""
+    calendar_id = {'type': 'string', 'required': True, 'location': 'path'}
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'calendar:v3',
+        'name': 'calendar',
+        'version': 'v3',
+        'rootUrl': root_url,
+        'servicePath': 'calendar/v3/',
+        'batchPath': 'batch/calendar/v3',
+        'parameters': {},
+        'schemas': {
+            'Calendar': {'id': 'Calendar', 'type': 'object'},
+            'Event': {'id': 'Event', 'type': 'object'},
+        },
+        'resources': {
+            'calendars': {'methods': {
+                'get': {
+                    'id': 'calendar.calendars.get',
+                    'path': 'calendars/{calendarId}',
+                    'httpMethod': 'GET',
+                    'parameters': {'calendarId': calendar_id},
+                    'parameterOrder': ['calendarId'],
+                    'response': {'$ref': 'Calendar'},
+                },
+            }},
+            'events': {'methods': {
+                'insert': {
+                    'id': 'calendar.events.insert',
+                    'path': 'calendars/{calendarId}/events',
+                    'httpMethod': 'POST',
+                    'parameters': {'calendarId': calendar_id},
+                    'parameterOrder': ['calendarId'],
+                    'request': {'$ref': 'Event'},
+                    'response': {'$ref': 'Event'},
+                },
+                'patch': {
+                    'id': 'calendar.events.patch',
+                    'path': 'calendars/{calendarId}/events/{eventId}',
+                    'httpMethod': 'PATCH',
+                    'parameters': {
+                        'calendarId': calendar_id,
+                        'eventId': {'type': 'string', 'required': True, 'location': 'path'},
+                    },
+                    'parameterOrder': ['calendarId', 'eventId'],
+                    'request': {'$ref': 'Event'},
+                    'response': {'$ref': 'Event'},
+                },
+            }},
+        },
+    }
+
+
+class CalendarError(Exception):
+
+    def __init__(self, status, reason, message):
+        super(CalendarError, self).__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def body(self):
+        return {'error': {
+            'code': self.status,
+            'message': self.message,
+            'errors': [{'domain': 'global', 'reason': self.reason, 'message': self.message}],
+        }}
+
+
+class FakeCalendar(object):
+    """The in-memory state of the fake server. Every method is thread-safe."""
+
+    def __init__(self, calendars=None, latency=0.0, error_rate=0.0, seed=None):
+        self.lock = threading.Lock()
+        self.calendars = dict(
+            (calendar_id, {'kind': 'calendar#calendar', 'id': calendar_id, 'summary': summary})
+            for calendar_id, summary in (calendars or {}).items())
+        # calendar id -> event id -> event
+        self.events = dict((calendar_id, {}) for calendar_id in self.calendars)
+        self.event_ids = itertools.count(1)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.root_url = None
+
+        # What the clients did, for tests and benchmarks to inspect. Fetching
+        # the discovery document isn't counted as an HTTP request.
+        self.http_requests = 0
+        self.discovery_requests = 0
+        # (method, path) of every API call, batched or not.
+        self.calls = []
+        self.errors_injected = 0
+
+    def maybe_fail(self):
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors_injected += 1
+                raise CalendarError(503, 'backendError', 'Backend Error')
+
+    def _calendar_events(self, calendar_id):
+        if calendar_id not in self.calendars:
+            raise CalendarError(404, 'notFound', 'Not Found')
+        return self.events[calendar_id]
+
+    def get_calendar(self, calendar_id):
+        with self.lock:
+            self._calendar_events(calendar_id)
+            return dict(self.calendars[calendar_id])
+
+    def insert_event(self, calendar_id, body):
+        with self.lock:
+            events = self._calendar_events(calendar_id)
+            event_id = 'fake%d' % next(self.event_ids)
+            event = dict(body, kind='calendar#event', id=event_id, status='confirmed',
+                         htmlLink='%scalendar/event?eid=%s' % (self.root_url, event_id))
+            events[event_id] = event
+            return dict(event)
+
+    def patch_event(self, calendar_id, event_id, body):
+        with self.lock:
+            events = self._calendar_events(calendar_id)
+            if event_id not in events:
+                raise CalendarError(404, 'notFound', 'Not Found')
+            events[event_id].update(body)
+            return dict(events[event_id])
+
+    def call(self, method, path, body):
+        """Runs one API call. Returns its `(status, response body)`."""
+        with self.lock:
+            self.calls.append((method, path))
+        try:
+            self.maybe_fail()
+            return 200, self.route(method, path, body)
+        except CalendarError as e:
+            return e.status, e.body()
+
+    def route(self, method, path, body):
+        parts = [urlparse.unquote(part) for part in path.strip('/').split('/')]
+        if parts[:3] != ['calendar', 'v3', 'calendars'] or len(parts) < 4:
+            raise CalendarError(404, 'notFound', 'Unknown path %s' % path)
+        calendar_id, rest = parts[3], parts[4:]
+
+        if method == 'GET' and not rest:
+            return self.get_calendar(calendar_id)
+        if method == 'POST' and rest == ['events']:
+            return self.insert_event(calendar_id, body)
+        if method == 'PATCH' and len(rest) == 2 and rest[0] == 'events':
+            return self.patch_event(calendar_id, rest[1], body)
+        raise CalendarError(404, 'notFound', 'Unknown method %s %s' % (method, path))
+
+
+class FakeCalendarRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def send(self, status, content, content_type='application/json; charset=UTF-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, method):
+        calendar = self.server.calendar
+        path = urlparse.urlparse(self.path).path
+        length = int(self.headers.getheader('content-length') or 0)
+        content = self.rfile.read(length) if length else ''
+
+        if path.strip('/') == DISCOVERY_PATH:
+            with calendar.lock:
+                calendar.discovery_requests += 1
+            return self.send(200, json.dumps(discovery_document(calendar.root_url)))
+
+        with calendar.lock:
+            calendar.http_requests += 1
+        if calendar.latency:
+            time.sleep(calendar.latency)
+
+        if path.strip('/') == 'batch/calendar/v3' and method == 'POST':
+            boundary, content = self.handle_batch(calendar, content)
+            return self.send(200, content, 'multipart/mixed; boundary=%s' % boundary)
+
+        status, body = calendar.call(method, path, json.loads(content) if content else None)
+        self.send(status, json.dumps(body))
+
+    def handle_batch(self, calendar, content):
+        """Runs every call of a multipart/mixed batch request, returning the
+        boundary and content of the multipart/mixed response."""
+        request = email.message_from_string(
+            'Content-Type: %s\r\n\r\n%s' % (self.headers.getheader('content-type'), content))
+        boundary = 'batch_%d' % random.getrandbits(64)
+
+        parts = []
+        for part in request.get_payload():
+            request_line, http_request = part.get_payload().split('\n', 1)
+            method, uri, _ = request_line.split(' ', 2)
+            body = email.message_from_string(http_request).get_payload()
+            status, response = calendar.call(method, urlparse.urlparse(uri).path, json.loads(body) if body else None)
+
+            response_content = json.dumps(response)
+            parts.append(
+                '--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                'HTTP/1.1 %d %s\r\nContent-Type: application/json; charset=UTF-8\r\n'
+                'Content-Length: %d\r\n\r\n%s\r\n' % (
+                    boundary, part['Content-ID'].strip('<>'), status, self.responses[status][0],
+                    len(response_content), response_content))
+        return boundary, ''.join(parts) + '--%s--\r\n' % boundary
+
+
+class FakeCalendarHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeCalendarServer(object):
+    """Runs a FakeCalendar behind an HTTP server on a local port."""
+
+    def __init__(self, host='127.0.0.1', port=0, **calendar_kwargs):
+        self.calendar = FakeCalendar(**calendar_kwargs)
+        self.httpd = FakeCalendarHTTPServer((host, port), FakeCalendarRequestHandler)
+        self.httpd.calendar = self.calendar
+        self.calendar.root_url = self.url + '/'
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.httpd.server_address
+
+    def __getattr__(self, name):
+        return getattr(self.calendar, name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeCalendarServer(port=9992, calendars={'rsvpbot@example.com': 'RSVPBot'})
+    print 'Fake Google Calendar API listening on %s' % server.url
+    server.httpd.serve_forever()
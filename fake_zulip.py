@@ -0,0 +1,492 @@
+"""
+A local stand-in for the parts of the Zulip REST API RSVPBot uses, so the bot
+can be exercised end to end over HTTP without a real Zulip realm.
+
+    server = FakeZulipServer(streams=['test-stream'])
+    server.start()
+    bot = Bot('bot@example.com', 'key', 'rsvp', zulip_site=server.url)
+    server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+    ...
+    server.stop()
+
+It serves a single bot user (whoever authenticates) and keeps everything in
+memory. Supported endpoints, all under `/api/v1/`:
+
+    POST register, GET/DELETE events, GET/POST messages,
+    GET/POST/PATCH users/me/subscriptions, GET streams, GET users
+
+For load tests, `storm()` has other users post messages at a steady rate from a
+background thread, and measures how long the bot takes to answer them (see
+benchmarks/load_test.py).
+"""
+import BaseHTTPServer
+import SocketServer
+import itertools
+from collections import Counter
+import json
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+
+# The only operators Zulip takes in the narrow of an event queue.
+EVENT_NARROW_OPERATORS = ('stream', 'topic', 'sender', 'is')
+
+
+def message_matches_narrow(message, narrow):
+    """Implements the subset of Zulip's narrow operators RSVPBot relies on."""
+    for operator, operand in narrow or []:
+        operand = operand.lower()
+        if operator == 'stream':
+            if message['type'] != 'stream' or message['display_recipient'].lower() != operand:
+                return False
+        elif operator in ('topic', 'subject'):
+            if message['subject'].lower() != operand:
+                return False
+        elif operator == 'is' and operand == 'private':
+            if message['type'] != 'private':
+                return False
+        elif operator == 'sender':
+            if message['sender_email'].lower() != operand:
+                return False
+        elif operator == 'search':
+            text = (message['subject'] + ' ' + message['content']).lower()
+            if not all(word in text for word in operand.split()):
+                return False
+    return True
+
+
+class EventQueue(object):
+
+    def __init__(self, queue_id, event_types, narrow):
+        self.queue_id = queue_id
+        self.event_types = event_types
+        self.narrow = narrow
+        self.events = []
+        self.next_event_id = 0
+
+    def wants(self, event):
+        if self.event_types is not None and event['type'] not in self.event_types:
+            return False
+        if event['type'] == 'message':
+            return message_matches_narrow(event['message'], self.narrow)
+        return True
+
+    def push(self, event):
+        event = dict(event, id=self.next_event_id)
+        self.next_event_id += 1
+        self.events.append(event)
+
+    def ack(self, last_event_id):
+        self.events = [event for event in self.events if event['id'] > last_event_id]
+
+
+class FakeZulipRealm(object):
+    """The in-memory state of the fake server. Every method is thread-safe."""
+
+    def __init__(self, streams=(), users=(), bot_email='bot@example.com', poll_timeout=1.0):
+        self.condition = threading.Condition()
+        self.bot_email = bot_email
+        self.poll_timeout = poll_timeout
+        self.queues = {}
+        self.queue_ids = itertools.count(1)
+
+        self.streams = {}
+        self.stream_ids = itertools.count(1)
+        for name in streams:
+            self.create_stream(name)
+
+        self.users = {}
+        self.user_ids = itertools.count(1)
+        self.add_user(bot_email, 'RSVPBot')
+        for email, full_name in users:
+            self.add_user(email, full_name)
+
+        self.subscriptions = set()
+        self.messages = []
+        self.message_ids = itertools.count(1)
+
+        # What the bot did, for tests to inspect.
+        self.sent_messages = []
+        self.requests = []
+        # event type -> number of events of that type handed to the bot
+        self.events_delivered = Counter()
+        # Number of messages handed to the bot by the message history.
+        self.messages_fetched = 0
+
+    # Realm changes, as made by other users.
+
+    def create_stream(self, name):
+        with self.condition:
+            stream = {'name': name, 'stream_id': next(self.stream_ids), 'description': ''}
+            self.streams[name.lower()] = stream
+            self._push_event({'type': 'stream', 'op': 'create', 'streams': [stream]})
+            return stream
+
+    def delete_stream(self, name):
+        with self.condition:
+            stream = self.streams.pop(name.lower())
+            self.subscriptions.discard(name.lower())
+            self._push_event({'type': 'stream', 'op': 'delete', 'streams': [stream]})
+
+    def add_user(self, email, full_name):
+        with self.condition:
+            user = {'email': email, 'full_name': full_name, 'user_id': next(self.user_ids), 'is_bot': False}
+            self.users[email] = user
+            self._push_event({'type': 'realm_user', 'op': 'add', 'person': user})
+            return user
+
+    def rename_user(self, email, full_name):
+        with self.condition:
+            user = self.users[email]
+            user['full_name'] = full_name
+            self._push_event({'type': 'realm_user', 'op': 'update',
+                              'person': {'user_id': user['user_id'], 'full_name': full_name}})
+            return user
+
+    def send_message(self, sender_email, stream, subject, content):
+        """A user posts `content` to `stream`/`subject`."""
+        with self.condition:
+            return self._add_message(self.users[sender_email], 'stream', stream, subject, content)
+
+    def send_private_message(self, sender_email, content):
+        """A user sends `content` to the bot privately."""
+        with self.condition:
+            recipients = [
+                {'email': email, 'full_name': self.users[email]['full_name'], 'id': self.users[email]['user_id']}
+                for email in (sender_email, self.bot_email)
+            ]
+            return self._add_message(self.users[sender_email], 'private', recipients, '', content)
+
+    def storm(self, rate, count, make_message):
+        """Starts posting `count` messages, `rate` per second. `make_message(i)`
+        returns the `(sender_email, stream, subject, content)` of the i-th one."""
+        return MessageStorm(self, rate, count, make_message).start()
+
+    def drop_queues(self):
+        """Forget every event queue, like a Zulip server restart or queue expiry does."""
+        with self.condition:
+            self.queues.clear()
+
+    # The bot's API.
+
+    def _add_message(self, sender, message_type, recipient, subject, content):
+        message = {
+            'id': next(self.message_ids),
+            'type': message_type,
+            'display_recipient': recipient,
+            'subject': subject,
+            'content': content,
+            'sender_email': sender['email'],
+            'sender_full_name': sender['full_name'],
+            'sender_id': sender['user_id'],
+            'timestamp': int(time.time()),
+        }
+        self.messages.append(message)
+
+        if self._bot_receives(message):
+            self._push_event({'type': 'message', 'message': message, 'flags': []})
+        return message
+
+    def _bot_receives(self, message):
+        if message['type'] == 'private':
+            return any(recipient['email'] == self.bot_email for recipient in message['display_recipient'])
+        return message['display_recipient'].lower() in self.subscriptions
+
+    def _push_event(self, event):
+        for queue in self.queues.values():
+            if queue.wants(event):
+                queue.push(event)
+        self.condition.notify_all()
+
+    def register(self, event_types=None, narrow=None):
+        for operator, _ in narrow or []:
+            if operator not in EVENT_NARROW_OPERATORS:
+                raise ZulipError('Operator %s not supported.' % operator)
+        with self.condition:
+            queue = EventQueue('fake-queue-%d' % next(self.queue_ids), event_types, narrow)
+            self.queues[queue.queue_id] = queue
+            max_message_id = self.messages[-1]['id'] if self.messages else -1
+            return {'queue_id': queue.queue_id, 'last_event_id': -1, 'max_message_id': max_message_id}
+
+    def get_events(self, queue_id, last_event_id, dont_block=False):
+        deadline = time.time() + self.poll_timeout
+        with self.condition:
+            while True:
+                queue = self.queues.get(queue_id)
+                if queue is None:
+                    raise ZulipError('Bad event queue id: %s' % queue_id, code='BAD_EVENT_QUEUE_ID')
+
+                queue.ack(last_event_id)
+                remaining = deadline - time.time()
+                if queue.events or dont_block or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            events = list(queue.events)
+            if not events and not dont_block:
+                queue.push({'type': 'heartbeat'})
+                events = list(queue.events)
+            self.events_delivered.update(event['type'] for event in events)
+            return events
+
+    def deregister(self, queue_id):
+        with self.condition:
+            self.queues.pop(queue_id, None)
+
+    def post_message(self, request):
+        with self.condition:
+            message = {
+                'type': request['type'],
+                'to': request['to'],
+                'subject': request.get('subject', ''),
+                'content': request['content'],
+                'sent_at': time.time(),
+            }
+            self.sent_messages.append(message)
+            self.condition.notify_all()
+            return len(self.sent_messages)
+
+    def get_messages(self, anchor, num_before, num_after, narrow=None):
+        with self.condition:
+            received = [
+                message for message in self.messages
+                if self._bot_receives(message) and message_matches_narrow(message, narrow)
+            ]
+            before = [message for message in received if message['id'] < anchor]
+            after = [message for message in received if message['id'] >= anchor]
+            selected = (before[-num_before:] if num_before else []) + after[:num_after]
+            self.messages_fetched += len(selected)
+            return selected, len(after) <= num_after
+
+    def subscribe(self, names):
+        with self.condition:
+            for name in names:
+                if name.lower() not in self.streams:
+                    self.create_stream(name)
+                self.subscriptions.add(name.lower())
+
+    def unsubscribe(self, names):
+        with self.condition:
+            for name in names:
+                self.subscriptions.discard(name.lower())
+
+    def list_subscriptions(self):
+        with self.condition:
+            return [self.streams[name] for name in sorted(self.subscriptions) if name in self.streams]
+
+    def wait_for_sent_messages(self, count, timeout=5):
+        """Blocks until the bot has sent at least `count` messages."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while len(self.sent_messages) < count and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return len(self.sent_messages) >= count
+
+
+class MessageStorm(object):
+    """Posts messages into a FakeZulipRealm at a steady rate from a background
+    thread. If posting falls behind schedule, the late messages are sent right
+    away rather than dropped, so `achieved_rate` may fall short of `rate`."""
+
+    def __init__(self, realm, rate, count, make_message):
+        self.realm = realm
+        self.rate = rate
+        self.count = count
+        self.make_message = make_message
+        # (message, time it was posted)
+        self.sent = []
+        self.thread = None
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        self.started_at = time.time()
+        for i in range(self.count):
+            delay = self.started_at + float(i) / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sender_email, stream, subject, content = self.make_message(i)
+            message = self.realm.send_message(sender_email, stream, subject, content)
+            self.sent.append((message, time.time()))
+        self.finished_at = time.time()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    @property
+    def achieved_rate(self):
+        if not self.finished_at or self.finished_at == self.started_at:
+            return None
+        return len(self.sent) / (self.finished_at - self.started_at)
+
+    def reply_latencies(self):
+        """Seconds between each stream message and the bot's first reply in its
+        topic, for the messages that got one (in the order they were posted)."""
+        first_replies = {}
+        with self.realm.condition:
+            for reply in self.realm.sent_messages:
+                if reply['type'] == 'stream':
+                    first_replies.setdefault((reply['to'].lower(), reply['subject']), reply['sent_at'])
+
+        latencies = []
+        for message, posted_at in self.sent:
+            if message['type'] != 'stream':
+                continue
+            replied_at = first_replies.get((message['display_recipient'].lower(), message['subject']))
+            if replied_at is not None and replied_at >= posted_at:
+                latencies.append(replied_at - posted_at)
+        return latencies
+
+
+class ZulipError(Exception):
+
+    def __init__(self, msg, code='BAD_REQUEST'):
+        super(ZulipError, self).__init__(msg)
+        self.msg = msg
+        self.code = code
+
+
+class FakeZulipRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api_request('GET')
+
+    def do_POST(self):
+        self.handle_api_request('POST')
+
+    def do_PATCH(self):
+        self.handle_api_request('PATCH')
+
+    def do_DELETE(self):
+        self.handle_api_request('DELETE')
+
+    def read_params(self):
+        parsed = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(parsed.query))
+        length = int(self.headers.getheader('content-length') or 0)
+        if length:
+            params.update(urlparse.parse_qsl(self.rfile.read(length)))
+        return parsed.path, params
+
+    def handle_api_request(self, method):
+        path, params = self.read_params()
+        endpoint = path.split('/api/v1/', 1)[-1]
+        realm = self.server.realm
+        realm.requests.append((method, endpoint))
+
+        try:
+            status, body = 200, self.route(realm, method, endpoint, params)
+            body['result'] = 'success'
+            body.setdefault('msg', '')
+        except ZulipError as e:
+            status, body = 400, {'result': 'error', 'msg': e.msg, 'code': e.code}
+        except KeyError as e:
+            status, body = 400, {'result': 'error', 'msg': 'Missing %s argument' % e, 'code': 'REQUEST_VARIABLE_MISSING'}
+
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def route(self, realm, method, endpoint, params):
+        if endpoint == 'register' and method == 'POST':
+            event_types = json.loads(params['event_types']) if 'event_types' in params else None
+            narrow = json.loads(params.get('narrow', '[]'))
+            return realm.register(event_types, narrow)
+
+        if endpoint == 'events' and method == 'GET':
+            events = realm.get_events(
+                params['queue_id'],
+                int(params['last_event_id']),
+                json.loads(params.get('dont_block', 'false')))
+            return {'events': events, 'queue_id': params['queue_id']}
+
+        if endpoint == 'events' and method == 'DELETE':
+            realm.deregister(params['queue_id'])
+            return {}
+
+        if endpoint == 'messages' and method == 'POST':
+            return {'id': realm.post_message(params)}
+
+        if endpoint == 'messages' and method == 'GET':
+            messages, found_newest = realm.get_messages(
+                int(params['anchor']),
+                int(params['num_before']),
+                int(params['num_after']),
+                json.loads(params.get('narrow', '[]')))
+            return {'messages': messages, 'found_newest': found_newest}
+
+        if endpoint == 'users/me/subscriptions':
+            if method == 'GET':
+                return {'subscriptions': realm.list_subscriptions()}
+            if method == 'POST':
+                realm.subscribe([stream['name'] for stream in json.loads(params['subscriptions'])])
+                return {}
+            if method == 'PATCH':
+                realm.unsubscribe(json.loads(params['delete']))
+                return {}
+
+        if endpoint == 'streams' and method == 'GET':
+            return {'streams': sorted(realm.streams.values(), key=lambda stream: stream['stream_id'])}
+
+        if endpoint == 'users' and method == 'GET':
+            return {'members': realm.users.values()}
+
+        raise ZulipError('Unknown endpoint: %s %s' % (method, endpoint))
+
+
+class FakeZulipHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A bot killed in the middle of a poll (e.g. by a failover test) isn't our error.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeZulipServer(object):
+    """Runs a FakeZulipRealm behind an HTTP server on a local port."""
+
+    def __init__(self, host='127.0.0.1', port=0, **realm_kwargs):
+        self.realm = FakeZulipRealm(**realm_kwargs)
+        self.httpd = FakeZulipHTTPServer((host, port), FakeZulipRequestHandler)
+        self.httpd.realm = self.realm
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.httpd.server_address
+
+    def __getattr__(self, name):
+        return getattr(self.realm, name)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeZulipServer(port=9991, streams=['test-stream'], users=[('a@example.com', 'Tester')])
+    print 'Fake Zulip server listening on %s' % server.url
+    server.httpd.serve_forever()
@@ -0,0 +1,67 @@
+"""
+Advisory locks on a lock file, respected by every thread and process that
+locks the same file, e.g. two bots sharing an events store, or a bot and a
+maintenance script.
+
+    lock = FileLock('events.json.lock')
+    with lock():
+        ...  # nobody else holds it
+    with lock(shared=True):
+        ...  # only other shared holders
+
+or, to hold it for longer than a block, `lock.acquire()` and `lock.release()`.
+
+Processes are kept apart with flock(2), threads of the same process with a
+threading lock (flock locks belong to the open file, which they share). The
+lock is released if the process dies, so a crash never leaves it stuck.
+"""
+import contextlib
+import errno
+import fcntl
+import threading
+
+
+class FileLock(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.thread_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def __call__(self, shared=False):
+        self.acquire(shared)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, shared=False, blocking=True):
+        """Takes the lock until `release()`. Returns False, without waiting, if
+        `blocking` is False and someone else holds it."""
+        if not self.thread_lock.acquire(blocking):
+            return False
+        try:
+            if self.file is None:
+                self.file = open(self.filename, 'a')
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            fcntl.flock(self.file.fileno(), flags if blocking else flags | fcntl.LOCK_NB)
+        except IOError as e:
+            self.thread_lock.release()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        return True
+
+    def release(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def close(self):
+        with self.thread_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,57 @@
+"""
+Connection pooling for zulip.Client.
+
+zulip.Client sends every API call with `requests.request`, which sets up a new
+connection (TLS handshake included) for each one and closes it afterwards.
+`pool(client, session)` makes a client send its calls through a
+requests.Session instead, so connections are kept alive and reused, and any
+number of clients (e.g. the tenants of a Runner, see tenants.py) can share one
+pool.
+"""
+import types
+
+import requests
+from requests.adapters import HTTPAdapter
+import zulip
+
+# Taken before anything (e.g. a test) gets the chance to patch zulip.Client.
+_do_api_query = zulip.Client.do_api_query.im_func
+
+
+def make_session(pool_size=10):
+    """A session keeping up to `pool_size` connections open per host. Each
+    long-polling client holds one for as long as its poll lasts."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class SessionRequests(object):
+    """Stands in for the `requests` module inside do_api_query, sending the
+    requests through `session`."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def request(self, *args, **kwargs):
+        return self.session.request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def pool(client, session):
+    """Makes `client` send its API calls through `session`. Returns the client."""
+    # do_api_query looks `requests` up in the zulip module's globals, so run
+    # the same code with a copy of them where it's the session.
+    function = types.FunctionType(
+        _do_api_query.func_code, dict(_do_api_query.func_globals, requests=SessionRequests(session)),
+        _do_api_query.func_name, _do_api_query.func_defaults)
+    client.do_api_query = types.MethodType(function, client)
+
+    # Also worked out on every call, by reading files about the platform.
+    user_agent = client.get_user_agent()
+    client.get_user_agent = lambda: user_agent
+    return client
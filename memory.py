@@ -0,0 +1,250 @@
+"""
+Where a bot's memory goes, by component:
+
+* `events`: the events store (RSVP.events), with the bytes per event.
+* `attendees`: the attendee lists inside it. Every answer stores its own copy
+  of the user id (or, in older events, email), so `duplicate_bytes` is what
+  sharing one object per attendee would save.
+* `users`: the user directory (zulip_users.json), as loaded by the commands
+  that need names.
+* `regexes`: the compiled regular expressions the `re` module caches.
+* `code`: the imported modules, and the functions and code objects in them.
+* `process`: the resident set size of the whole process, which the above are
+  part of (along with the interpreter, and memory it hasn't given back).
+
+Sizes are deep: an object's `sys.getsizeof` plus that of everything it holds,
+each object counted once. Python 2 has no tracemalloc, so this is what the
+objects take, not what was allocated for them.
+
+Admins (ZULIP_RSVP_ADMINS) get the report for the running bot with `rsvp
+memory`. With ZULIP_RSVP_MEMORY_INTERVAL set (in seconds, 0 by default,
+meaning off), the bot also writes it to the trace file every so often, as
+Chrome trace counter events, which chrome://tracing and Perfetto plot over
+time (see tracing.py). For a report on the store and directory on disk, or
+the history of the reports in a trace file:
+
+    python memory.py [--backend dbm] [--events events.json] [--users zulip_users.json]
+    python memory.py --history [traces.json]
+"""
+import argparse
+import collections
+import gc
+import logging
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import types
+
+import tracing
+
+MEMORY_INTERVAL = int(os.getenv('ZULIP_RSVP_MEMORY_INTERVAL', 0))
+
+RESPONSES = ('yes', 'no', 'maybe')
+
+
+def deep_size(obj, seen=None):
+    """The bytes taken by `obj` and the containers, strings and numbers it
+    holds. Objects already in `seen` (id -> object, updated) aren't counted.
+    It keeps them alive, so the id of one that's gone can't be reused by the next."""
+    seen = {} if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen[id(obj)] = obj
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+def rss_bytes():
+    """The resident set size of this process, or its peak where the current one isn't known."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # Kilobytes on Linux, bytes on OS X.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure_events(events, seen):
+    """Events are read through `iteritems`, so a lazy store (see DbmBackend) is
+    measured as if it were all loaded, without keeping it loaded."""
+    count = size = 0
+    for event_id, event in events.iteritems():
+        count += 1
+        size += deep_size(event_id, seen) + deep_size(event, seen)
+    return collections.OrderedDict([
+        ('count', count),
+        ('bytes', size),
+        ('bytes_per_event', size // count if count else 0),
+    ])
+
+
+def measure_attendees(events):
+    # attendee -> {id of each copy: the copy}
+    copies = {}
+    entries = 0
+    for _, event in events.iteritems():
+        for response in RESPONSES:
+            for attendee in event.get(response) or ():
+                entries += 1
+                copies.setdefault(attendee, {})[id(attendee)] = attendee
+
+    duplicates = duplicate_bytes = 0
+    for same in copies.values():
+        sizes = [sys.getsizeof(copy) for copy in same.values()]
+        duplicates += len(sizes) - 1
+        duplicate_bytes += sum(sizes) - max(sizes)
+    return collections.OrderedDict([
+        ('entries', entries),
+        ('distinct', len(copies)),
+        ('duplicates', duplicates),
+        ('duplicate_bytes', duplicate_bytes),
+    ])
+
+
+def measure_users(users, seen):
+    return collections.OrderedDict([
+        ('count', len(users.users) + len(users.legacy)),
+        ('bytes', deep_size(users.users, seen) + deep_size(users.legacy, seen)),
+    ])
+
+
+def measure_regexes():
+    patterns = list(re._cache.values()) + list(re._cache_repl.values())
+    return collections.OrderedDict([
+        ('count', len(patterns)),
+        ('bytes', sum(sys.getsizeof(pattern) for pattern in patterns)),
+    ])
+
+
+def measure_code():
+    """Code objects aren't tracked by the garbage collector: they're found
+    through the functions that are."""
+    seen = {}
+    size = 0
+    modules = [module for module in sys.modules.values() if module is not None]
+    for module in modules:
+        size += sys.getsizeof(module) + sys.getsizeof(module.__dict__)
+    for obj in gc.get_objects():
+        if isinstance(obj, types.FunctionType):
+            size += sys.getsizeof(obj)
+            code = obj.__code__
+            if id(code) not in seen:
+                seen[id(code)] = code
+                size += sys.getsizeof(code) + sys.getsizeof(code.co_code) + deep_size(code.co_consts, seen)
+        elif isinstance(obj, (type, types.ClassType)):
+            size += sys.getsizeof(obj)
+    return collections.OrderedDict([
+        ('modules', len(modules)),
+        ('bytes', size),
+    ])
+
+
+def report(events, users=None):
+    """The memory taken by each component: `events` is an EventMap, `users` a
+    ZulipUsers (the directory on disk if None)."""
+    if users is None:
+        # Not at the top: zulip_users needs the zulip package, the CLI's history doesn't.
+        from zulip_users import ZulipUsers
+        users = ZulipUsers()
+
+    seen = {}
+    return collections.OrderedDict([
+        ('events', measure_events(events, seen)),
+        ('attendees', measure_attendees(events)),
+        ('users', measure_users(users, seen)),
+        ('regexes', measure_regexes()),
+        ('code', measure_code()),
+        ('process', collections.OrderedDict([('rss_bytes', rss_bytes())])),
+    ])
+
+
+def format_report(memory_report):
+    lines = ['component|measure|value', ':---|:---|---:']
+    for component, measures in memory_report.items():
+        for measure, value in measures.items():
+            lines.append('%s|%s|%d' % (component, measure, value))
+    return '\n'.join(lines)
+
+
+def emit(memory_report, tracer=None):
+    """Writes a report to the trace file, a counter event per component."""
+    tracer = tracer or tracing.tracer
+    # The same time for all of them, which is how `history` tells reports apart.
+    now = time.time()
+    for component, measures in memory_report.items():
+        tracer.counter('memory.' + component, now, **measures)
+
+
+def run(source, interval=MEMORY_INTERVAL, users_filename='zulip_users.json', stopped=None):
+    """Blocking call that emits a report of the events `source()` returns,
+    and the user directory in `users_filename`, every `interval` seconds until
+    `stopped` (a threading.Event) is set."""
+    from zulip_users import ZulipUsers
+
+    stopped = stopped or threading.Event()
+    while not stopped.wait(interval):
+        try:
+            emit(report(source(), ZulipUsers(users_filename)))
+        except Exception:
+            logging.exception('Reporting memory failed.')
+
+
+def history(events):
+    """Formats the reports among the events of a trace file, oldest first."""
+    reports = collections.OrderedDict()
+    for event in events:
+        if event.get('ph') == 'C' and event['name'].startswith('memory.'):
+            reports.setdefault((event['pid'], event['ts']), {})[event['name']] = event['args']
+
+    lines = ['%-19s %7s %9s %12s %12s %12s %12s' % (
+        'time', 'pid', 'events', 'event bytes', 'dup. bytes', 'user bytes', 'rss')]
+    for (pid, ts), counters in reports.items():
+        get = lambda name, measure: counters.get('memory.' + name, {}).get(measure, 0)
+        lines.append('%-19s %7d %9d %12d %12d %12d %12d' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts / 1e6)), pid, get('events', 'count'), get('events', 'bytes'), get('attendees', 'duplicate_bytes'),
+            get('users', 'bytes'), get('process', 'rss_bytes')))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reports where the memory of RSVPBot goes.')
+    parser.add_argument('--history', nargs='?', const=tracing.TRACE_FILE, metavar='TRACE_FILE',
+                        help='list the reports the bot wrote to a trace file instead')
+    parser.add_argument('--backend', choices=('json', 'dbm'), default=os.getenv('ZULIP_RSVP_BACKEND', 'json'))
+    parser.add_argument('--events', help='the events store (events.json, or events.db for dbm)')
+    parser.add_argument('--users', default='zulip_users.json', help='the user directory')
+    args = parser.parse_args()
+
+    if args.history:
+        print history(tracing.read_events(args.history))
+        return
+
+    from backends import DbmBackend, FileBackend
+    from event_map import EventMap
+    from zulip_users import ZulipUsers
+
+    if args.backend == 'dbm':
+        backend = DbmBackend(filename=args.events or 'events.db')
+    else:
+        backend = FileBackend(filename=args.events or 'events.json')
+    print format_report(report(EventMap(backend.get_all_events()), ZulipUsers(args.users)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Memoizes the slow, pure-Python parsers behind `rsvp set date` and `rsvp set
+duration` (parsedatetime and pytimeparse), since people keep sending the same
+few strings: "tomorrow", "next friday", "1h", "90 minutes"...
+
+Inputs are normalized (case and whitespace) before being looked up. The cache
+keeps the `maxsize` most recently used entries.
+
+What a relative date like "tomorrow" means depends on the day it's parsed, so a
+`daily` cache is emptied the first time it's used after midnight.
+
+Caches are shared by every RSVP in the process (see tenants.py), so lookups are
+locked. Parsing isn't: two threads missing on the same input both parse it.
+"""
+import datetime
+import re
+import threading
+from collections import OrderedDict
+
+
+def normalize(raw):
+    return re.sub(r'\s+', ' ', raw.strip()).lower()
+
+
+class ParseCache(object):
+
+    def __init__(self, parse, maxsize=1024, daily=False):
+        self.parse = parse
+        self.maxsize = maxsize
+        self.daily = daily
+        self.day = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __call__(self, raw):
+        key = normalize(raw)
+        with self.lock:
+            if self.daily:
+                today = datetime.date.today()
+                if today != self.day:
+                    self.entries.clear()
+                    self.day = today
+
+            if key in self.entries:
+                self.hits += 1
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                return value
+            self.misses += 1
+
+        value = self.parse(key)
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.maxsize:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
+        return value
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,61 @@
+"""
+Remembers the ids of the last messages the bot handled, so that messages
+redelivered by Zulip (e.g. after the event queue is re-registered) are not
+processed twice.
+
+Ids are kept in an insertion ordered dict capped at `capacity` entries and
+appended to a log file, one per line, so they survive restarts. The log is
+rewritten with just the live ids once it grows to twice the capacity.
+"""
+from collections import OrderedDict
+
+
+class ProcessedMessages(object):
+
+    def __init__(self, filename='processed_messages.log', capacity=10000):
+        self.filename = filename
+        self.capacity = capacity
+        self.ids = OrderedDict()
+        self.logged = 0
+
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    self.logged += 1
+                    line = line.strip()
+                    if line.isdigit():
+                        self._remember(int(line))
+        except IOError:
+            pass
+
+    def __contains__(self, message_id):
+        return message_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _remember(self, message_id):
+        self.ids[message_id] = True
+        if len(self.ids) > self.capacity:
+            self.ids.popitem(last=False)
+
+    def add(self, message_id):
+        """Records `message_id`. Returns False if it had already been recorded."""
+        if message_id in self.ids:
+            return False
+
+        self._remember(message_id)
+
+        if self.logged >= 2 * self.capacity:
+            self.compact()
+        else:
+            with open(self.filename, 'a') as f:
+                f.write('%d\n' % message_id)
+            self.logged += 1
+        return True
+
+    def compact(self):
+        """Rewrite the log file with only the ids currently remembered."""
+        with open(self.filename, 'w') as f:
+            f.writelines('%d\n' % message_id for message_id in self.ids)
+        self.logged = len(self.ids)
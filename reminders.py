@@ -0,0 +1,141 @@
+"""
+Schedules "this event is starting soon" reminders for RSVPBot events.
+
+Pending reminders live in a heap ordered by when they are due, so the bot only
+ever looks at the next one instead of polling every event. When an event's start
+changes, new entries are pushed and the old ones are left in the heap; they are
+recognized as stale (they belong to an older schedule of that event) and
+dropped when they reach the top.
+
+Like the EventIndex, a scheduler given a `source` callable instead of `events`
+only reads the events (from whatever `source` returns then) the first time it
+is used, which is usually in the reminders thread rather than at startup.
+"""
+import datetime
+import heapq
+import itertools
+import threading
+
+from pytimeparse.timeparse import timeparse
+
+from event_index import event_start_and_end
+
+
+class ReminderScheduler(object):
+    """Heap of `(due, generation, event_id, offset)` reminders.
+
+    `offsets` is a list of `datetime.timedelta`s: how long before an event's
+    start each reminder should be sent.
+    """
+
+    # Maximum time the scheduler thread sleeps, so wall clock changes are noticed.
+    max_sleep = 60
+
+    def __init__(self, offsets, events=None, now=None, source=None):
+        self.offsets = sorted(offsets, reverse=True)
+        # event_id -> (start, generation of its current schedule)
+        self.scheduled = {}
+        self.generations = itertools.count()
+        self.heap = []
+        self.condition = threading.Condition()
+        self.source = source
+
+        if events:
+            self._build(events, now or datetime.datetime.now())
+
+    def _build(self, events, now):
+        for event_id, event in events.iteritems():
+            start, _ = event_start_and_end(event)
+            if start is not None:
+                self.heap.extend(self._schedule(event_id, start, now))
+        heapq.heapify(self.heap)
+
+    def _ensure_built(self):
+        with self.condition:
+            if self.source is not None:
+                self._build(self.source(), datetime.datetime.now())
+                self.source = None
+
+    def __len__(self):
+        self._ensure_built()
+        return len(self.heap)
+
+    def _schedule(self, event_id, start, now):
+        generation = next(self.generations)
+        self.scheduled[event_id] = (start, generation)
+        return [(start - offset, generation, event_id, offset) for offset in self.offsets if start - offset > now]
+
+    def update(self, event_id, event, now=None):
+        """Reschedules `event_id`'s reminders. Passing `None` as the event cancels them."""
+        start = event_start_and_end(event)[0] if event else None
+
+        with self.condition:
+            if self.source is not None:
+                # Not built yet; it will be from events that include this change.
+                return
+
+            if self.scheduled.get(event_id, (None,))[0] == start:
+                return
+
+            if start is None:
+                self.scheduled.pop(event_id, None)
+                return
+
+            for entry in self._schedule(event_id, start, now or datetime.datetime.now()):
+                heapq.heappush(self.heap, entry)
+
+            self._compact()
+            self.condition.notify()
+
+    def _is_stale(self, entry):
+        return self.scheduled.get(entry[2], (None, None))[1] != entry[1]
+
+    def _compact(self):
+        """Drops stale entries once they outnumber the live ones."""
+        if len(self.heap) > 2 * len(self.scheduled) * len(self.offsets) + 64:
+            self.heap = [entry for entry in self.heap if not self._is_stale(entry)]
+            heapq.heapify(self.heap)
+
+    def pop_due(self, now):
+        """Removes and returns `(event_id, offset)` for every reminder due at `now`."""
+        due = []
+        self._ensure_built()
+        with self.condition:
+            while self.heap and self.heap[0][0] <= now:
+                entry = heapq.heappop(self.heap)
+                if not self._is_stale(entry):
+                    due.append((entry[2], entry[3]))
+        return due
+
+    def seconds_until_next(self, now):
+        self._ensure_built()
+        with self.condition:
+            while self.heap and self._is_stale(self.heap[0]):
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return self.max_sleep
+            delta = self.heap[0][0] - now
+            return min(max(delta.total_seconds(), 0), self.max_sleep)
+
+    def run(self, callback, now=datetime.datetime.now):
+        """Blocking call that runs forever, calling `callback(event_id, offset)`
+        for every reminder as it comes due."""
+        while True:
+            with self.condition:
+                due = self.pop_due(now())
+                if not due:
+                    self.condition.wait(self.seconds_until_next(now()))
+                    continue
+
+            for event_id, offset in due:
+                callback(event_id, offset)
+
+
+def parse_offsets(raw_offsets):
+    """Parses a comma separated list of durations (e.g. `"1d, 1h"`) into timedeltas."""
+    offsets = []
+    for raw_offset in raw_offsets.split(','):
+        seconds = timeparse(raw_offset.strip()) if raw_offset.strip() else None
+        if seconds:
+            offsets.append(datetime.timedelta(seconds=seconds))
+    return offsets
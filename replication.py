@@ -0,0 +1,315 @@
+"""
+Log shipping to a hot standby.
+
+With ZULIP_RSVP_REPLICATION_LOG set (to, say, `events.log`), the bot wraps its
+backend in a ShippingBackend, which appends every change it commits to that
+log, one JSON record per line:
+
+    {"seq": 1, "reset": true, "events": {"<event_id>": {...}, ...}}
+    {"seq": 2, "events": {"<event_id>": {...}, "<moved_event_id>": null}}
+
+A "reset" record holds the whole store, the others the events a commit wrote
+(null for deleted ones). The log starts with a reset every time the bot starts,
+and is replaced by a new one starting with a reset once it grows past
+ZULIP_RSVP_REPLICATION_MAX_BYTES, so it never needs anything older.
+
+A standby process tails the log and applies it to a store of its own:
+
+    python replication.py primary/events.log --directory standby
+
+While it runs, the primary holds a lock on `<log>.primary`. The moment the
+primary dies (or stops) the lock is released: the standby applies what's left
+of the log, takes the lock (so a restarted primary waits for it instead of
+writing alongside), copies the primary's event queue position, processed
+messages and user directory, and runs the bot from its own directory. Both sides need to be on
+the same machine, which the log and the lock are local to.
+
+Changes are shipped after they're committed to the store, so a primary dying
+in between loses the last change to the standby.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import time
+
+from backends import AbstractEventBackend, DbmBackend, FileBackend, as_event_backend
+from event_map import EventMap
+from file_lock import FileLock
+
+REPLICATION_LOG = os.getenv('ZULIP_RSVP_REPLICATION_LOG')
+REPLICATION_MAX_BYTES = int(os.getenv('ZULIP_RSVP_REPLICATION_MAX_BYTES', 10 * 1024 * 1024))
+
+# What a bot taking over copies from the primary's directory, so it resumes the
+# primary's event queue, doesn't answer messages a second time and knows its users.
+TAKEOVER_FILES = ('event_queue.json', 'processed_messages.log', 'zulip_users.json')
+
+
+class ReplicationLog(object):
+    """The writing end of the log. Only one may be open per log at a time: the
+    constructor waits for whoever else holds `<filename>.primary`."""
+
+    def __init__(self, filename, max_bytes=REPLICATION_MAX_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.file = None
+        self.seq = last_seq(filename)
+
+        self.primary_lock = FileLock(filename + '.primary')
+        if not self.primary_lock.acquire(blocking=False):
+            logging.warning('Waiting for whoever is writing %s to stop.', filename)
+            self.primary_lock.acquire()
+
+    def reset(self, events):
+        """Starts a new log holding `events`, the whole store."""
+        self.seq += 1
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(self.encode(events, reset=True))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.filename, 'ab')
+
+    def append(self, events, snapshot):
+        """Logs the events a commit wrote, None for the deleted ones. Starts a new
+        log with `snapshot()` if this one has grown too big."""
+        if self.file.tell() > self.max_bytes:
+            return self.reset(snapshot())
+
+        self.seq += 1
+        self.file.write(self.encode(events))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def encode(self, events, reset=False):
+        record = {'seq': self.seq, 'events': events}
+        if reset:
+            record['reset'] = True
+        return json.dumps(record) + '\n'
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.primary_lock.release()
+        self.primary_lock.close()
+
+
+def last_seq(filename):
+    """The number of the last record in a log, 0 if there's none."""
+    seq = 0
+    reader = LogReader(filename)
+    for record in reader.read():
+        seq = record['seq']
+    reader.close()
+    return seq
+
+
+class ShippingBackend(AbstractEventBackend):
+    """Passes everything on to `backend`, and logs the changes it commits."""
+
+    def __init__(self, backend, log, *args, **kwargs):
+        self.backend = as_event_backend(backend)
+        self.log = log
+        super(ShippingBackend, self).__init__(*args, **kwargs)
+        self.log.reset(self.snapshot())
+
+    def snapshot(self):
+        return dict(self.backend.get_all_events().items())
+
+    def ship(self, events):
+        self.log.append(events, self.snapshot)
+
+    def get_all_events(self):
+        return self.backend.get_all_events()
+
+    def get_event(self, event_id):
+        return self.backend.get_event(event_id)
+
+    def has_event(self, event_id):
+        return self.backend.has_event(event_id)
+
+    def event_ids(self):
+        return self.backend.event_ids()
+
+    def put_event(self, event_id, event):
+        self.backend.put_event(event_id, event)
+        self.ship({event_id: event})
+
+    def delete_event(self, event_id):
+        self.backend.delete_event(event_id)
+        self.ship({event_id: None})
+
+    def changed_events(self):
+        return self.backend.changed_events()
+
+    def commit_changes(self, changes):
+        writes = self.backend.commit_changes(changes)
+        self.ship(writes)
+        return writes
+
+    def commit_events(self, events, event_ids=None):
+        self.backend.commit_events(events, event_ids)
+        if event_ids is None:
+            self.log.reset(self.snapshot())
+        else:
+            self.ship(dict((event_id, events.get(event_id)) for event_id in event_ids))
+
+    def close(self):
+        if hasattr(self.backend, 'close'):
+            self.backend.close()
+        self.log.close()
+
+
+class LogReader(object):
+    """Reads the records appended to a log since the last `read()`, following
+    it when it's replaced by a new one."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.partial = ''
+
+    def read(self):
+        while True:
+            if self.file is None:
+                try:
+                    # Unlike a file(), reads on past an end of file it already reached.
+                    self.file = io.open(self.filename, 'rb')
+                except IOError:
+                    return
+                self.partial = ''
+
+            for record in self.read_lines():
+                yield record
+
+            # Once we're at the end of a log that was replaced, the rest is in the new one.
+            try:
+                replaced = os.stat(self.filename).st_ino != os.fstat(self.file.fileno()).st_ino
+            except OSError:
+                replaced = False
+            if not replaced:
+                return
+            self.file.close()
+            self.file = None
+
+    def read_lines(self):
+        data = self.partial + self.file.read()
+        lines = data.split('\n')
+        # Whatever follows the last newline is still being written.
+        self.partial = lines.pop()
+        for line in lines:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logging.warning('Skipping a damaged record in %s: %r', self.filename, line[:100])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Standby(object):
+    """Keeps `backend` a copy of the primary's store by applying its log."""
+    poll_interval = 0.1
+
+    def __init__(self, log_filename, backend):
+        self.log_filename = log_filename
+        self.reader = LogReader(log_filename)
+        self.backend = as_event_backend(backend)
+        self.events = EventMap(self.backend.get_all_events())
+        self.seq = None
+        self.primary_lock = FileLock(log_filename + '.primary')
+
+    def poll(self):
+        """Applies the records appended to the log since the last poll, and
+        commits the events they changed in one go. Returns how many there were."""
+        count = 0
+        reset = False
+        changed = set()
+        for record in self.reader.read():
+            if record.get('reset'):
+                self.events = EventMap(record['events'])
+                reset = True
+                changed.clear()
+            elif self.seq is not None and record['seq'] <= self.seq:
+                continue
+            else:
+                if self.seq is not None and record['seq'] != self.seq + 1:
+                    logging.warning('Records %d to %d are missing from %s.', self.seq + 1, record['seq'] - 1,
+                                    self.log_filename)
+                self.events = self.events.replace(record['events'])
+                changed.update(record['events'])
+            self.seq = record['seq']
+            count += 1
+
+        if reset:
+            self.backend.commit_events(self.events)
+        elif changed:
+            self.backend.commit_events(self.events, list(changed))
+        return count
+
+    def follow(self, timeout=None):
+        """
+        Applies the log as it grows until the primary goes away, then takes its
+        lock. Returns True once it has, with every record applied, or False if
+        the primary is still there after `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.poll()
+            # Without a log, there's no primary to take over from yet.
+            if os.path.exists(self.log_filename) and self.primary_lock.acquire(blocking=False):
+                self.poll()
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+
+    def take_over(self, directory):
+        """Copies the primary's TAKEOVER_FILES into `directory`, for a bot running from there."""
+        primary_directory = os.path.dirname(self.log_filename)
+        for filename in TAKEOVER_FILES:
+            source = os.path.join(primary_directory, filename)
+            if os.path.exists(source):
+                shutil.copy(source, os.path.join(directory, filename))
+        self.reader.close()
+        if hasattr(self.backend, 'close'):
+            self.backend.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keeps a standby copy of a bot\'s events, and runs the bot '
+                                                 'from it when the primary goes away.')
+    parser.add_argument('log', help='the replication log the primary writes')
+    parser.add_argument('--directory', default='standby', help='where the standby keeps its files')
+    args = parser.parse_args()
+
+    # Not at the top: bot imports this module.
+    import bot
+
+    logging.basicConfig(level=logging.INFO)
+    if not os.path.isdir(args.directory):
+        os.makedirs(args.directory)
+    if os.getenv('ZULIP_RSVP_BACKEND') == 'dbm':
+        backend = DbmBackend(filename=os.path.join(args.directory, 'events.db'))
+    else:
+        backend = FileBackend(filename=os.path.join(args.directory, 'events.json'))
+
+    standby = Standby(args.log, backend)
+    standby.follow()
+    logging.info('The primary is gone, taking over after record %s.', standby.seq)
+    standby.take_over(args.directory)
+    bot.from_environment(args.directory).main()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,75 @@
 from __future__ import with_statement
+import copy
+import logging
 import re
 import json
+import threading
 
+import calendar_events
 import rsvp_commands
-from strings import ERROR_INVALID_COMMAND
+import strings
+import tracing
+from backends import ConflictError, as_event_backend, event_version
+from event_index import EventIndex
+from event_map import EventMap
+from strings import ERROR_INVALID_COMMAND, ERROR_COMMAND_FAILED, ERROR_CONFLICT, ERROR_NOT_AN_EVENT
 
 
 class RSVP(object):
 
-  def __init__(self, key_word, backend):
+  # How many times a message is run again when the events it changed were
+  # changed by someone else (e.g. another process sharing the backend) meanwhile.
+  commit_attempts = 5
+
+  def __init__(self, key_word, backend, users_filename='zulip_users.json'):
     """
-    keep a copy in memory of the whole events dictionary and commit it when necessary
-    to the supplied backend.
+    keep a copy in memory of the whole events dictionary and write the events that
+    change to the supplied backend, one message at a time. Backends that only support
+    whole-store commits are wrapped in a WholeStoreAdapter.
+
+    Attendees' names and emails are looked up in the user directory in
+    `users_filename` (see zulip_users.py), which is the realm's own.
+
+    `self.events` is an immutable EventMap snapshot: readers can hold on to it
+    without locking, messages that change events publish a new one.
     """
 
-    self.backend = backend
+    self.backend = as_event_backend(backend)
     self.key_word = key_word
-    self.command_list = (
-      rsvp_commands.RSVPInitCommand(key_word),
-      rsvp_commands.RSVPHelpCommand(key_word),
-      rsvp_commands.RSVPCancelCommand(key_word),
-      rsvp_commands.RSVPMoveCommand(key_word),
-      rsvp_commands.RSVPSetLimitCommand(key_word),
-      rsvp_commands.RSVPSetDateCommand(key_word),
-      rsvp_commands.RSVPSetTimeCommand(key_word),
-      rsvp_commands.RSVPSetTimeAllDayCommand(key_word),
-      rsvp_commands.RSVPSetStringAttributeCommand(key_word),
-      rsvp_commands.RSVPSummaryCommand(key_word),
-      rsvp_commands.RSVPPingCommand(key_word),
-      rsvp_commands.RSVPCreditsCommand(key_word),
-      rsvp_commands.RSVPCreateCalendarEventCommand(key_word),
-      rsvp_commands.RSVPSetDurationCommand(key_word),
-
-      # This needs to be at last for fuzzy yes|no checking
-      rsvp_commands.RSVPConfirmCommand(key_word)
-    )
-
-    self.events = self.backend.get_all_events()
+    self.users_filename = users_filename
+    self.events = EventMap(self.backend.get_all_events())
+    self.write_lock = threading.Lock()
+    # Built the first time it's queried, so startup doesn't read every event.
+    self.index = EventIndex(source=lambda: self.events)
+    # Everything that needs to follow changes to individual events, e.g. the
+    # reminders scheduler. Each has an `update(event_id, event)` method.
+    self.observers = [self.index]
+    # Shared with every other RSVP using the same key word.
+    self.command_list = rsvp_commands.command_table(key_word)
 
   def commit_events(self):
     """Write the whole events dictionary to the backend."""
     self.backend.commit_events(self.events)
 
+  def save(self, transaction):
+    """Commits the events changed by a transaction to the backend, if nobody
+    changed them since the transaction read them. Returns the written events."""
+    return self.backend.commit_changes(transaction.changes())
+
+  def refresh(self, events):
+    """Takes in events that were changed by someone else: event_id -> the event,
+    or None if it was deleted."""
+    self.events = self.events.replace(events)
+    for event_id, event in events.items():
+      for observer in self.observers:
+        observer.update(event_id, event)
+
+  def pull(self):
+    """Takes in whatever someone else changed in the backend since we last looked."""
+    changed = self.backend.changed_events()
+    if changed:
+      self.refresh(changed)
+
   def __exit__(self, type, value, traceback):
     """Before the program terminates, commit events."""
     self.commit_events()
@@ -73,15 +101,166 @@ class RSVP(object):
     return messages
 
   def route(self, message):
-    """Split multiple line message and collate the responses."""
+    """Split multiple line message and collate the responses.
+
+    Messages whose commands are all read-only run against `self.events` as it
+    is, an immutable snapshot: they neither wait for the write lock nor copy the
+    events they read.
+
+    All the lines of any other message are a single transaction on a copy-on-write
+    view of the events: the events they change are published as a new snapshot,
+    committed and synced to the calendar once at the end. If a line fails, the
+    changes made by the lines before it are dropped as well, and so is any `add to
+    calendar` among them: calendar events are only created once the message is
+    committed.
+
+    Either way the message runs on top of what other writers (e.g. another process
+    sharing the backend) changed before it came in. If one of them changes one of
+    the same events in the meantime, the commit fails and the whole message runs
+    again on top of their changes.
+    """
     content = message['content']
-    responses = []
     lines = normalize_whitespace(content)
-    for line in lines:
-      responses.extend(self.route_internal(message, line))
-    return responses
 
-  def route_internal(self, message, content):
+    with tracing.span('rsvp.route', lines=len(lines)):
+      if self.read_only(lines):
+        # A writer holding the lock pulled before it started.
+        if self.write_lock.acquire(False):
+          try:
+            self.pull()
+          finally:
+            self.write_lock.release()
+        responses, failed = self.run_lines(message, lines, self.events)
+        if failed is not None:
+          return [rsvp_commands.RSVPMessage('private', ERROR_COMMAND_FAILED % failed, message['sender_email'])]
+        return responses
+
+      with self.write_lock:
+        self.pull()
+        for _ in range(self.commit_attempts):
+          transaction = RSVPTransaction(self.events)
+          responses, failed = self.run_lines(message, lines, transaction.events, transaction)
+          if failed is not None:
+            return [rsvp_commands.RSVPMessage('private', ERROR_COMMAND_FAILED % failed, message['sender_email'])]
+
+          try:
+            self.finish(transaction)
+          except ConflictError as e:
+            logging.info('%s, running the message again.', e)
+            self.refresh(e.current)
+          else:
+            return responses
+
+    logging.warning('Gave up on %r after %d conflicts.', content, self.commit_attempts)
+    return [rsvp_commands.RSVPMessage('private', ERROR_CONFLICT, message['sender_email'])]
+
+  def read_only(self, lines):
+    """Whether none of the lines run a command that changes events."""
+    for line in lines:
+      if re.match(r'^{}'.format(self.key_word), line, flags=re.I):
+        command, _ = self.match_command(line)
+        if command is not None and not command.read_only:
+          return False
+    return True
+
+  def run_lines(self, message, lines, events, transaction=None):
+    """Runs the lines of a message against `events`, recording the changes in
+    `transaction`. Returns the replies, and the line that failed (the lines after
+    it don't run) or None."""
+    responses = []
+    for line in lines:
+      try:
+        responses.extend(self.route_internal(message, line, events, transaction))
+      except Exception:
+        logging.exception('Error running %r, rolling back the whole message.', line)
+        return responses, line
+    return responses, None
+
+  def finish(self, transaction):
+    """Commits and publishes the changes made by a transaction and lets
+    everything that follows the events know about them. Raises a ConflictError,
+    having changed nothing, if the backend refuses the commit.
+
+    Calendar events are only created (and updated) once the commit went
+    through, so a transaction that's dropped or run again has no effect on
+    the calendar."""
+    if transaction.changed:
+      with tracing.span('rsvp.save', events=len(transaction.changed)):
+        written = self.save(transaction)
+      self.publish(written)
+
+      for event_id in transaction.calendar_sync:
+        self.sync_calendar_event(event_id)
+
+    for event_id, reply in transaction.calendar_create:
+      reply.body = self.create_calendar_event(event_id)
+
+  def publish(self, written):
+    """Takes in the events a commit wrote."""
+    # Written with their new versions, so the next commit expects those.
+    self.events = self.events.replace(written)
+
+    with tracing.span('rsvp.observers'):
+      for event_id, event in written.items():
+        for observer in self.observers:
+          observer.update(event_id, event)
+
+  def create_calendar_event(self, event_id):
+    """Adds `event_id` to the calendar and records the calendar event in it.
+    Returns the message telling how that went."""
+    event = self.events.get(event_id)
+    if not event:
+      # Moved or canceled by a later line of the same message.
+      return ERROR_NOT_AN_EVENT
+
+    try:
+      with tracing.span('rsvp.create_calendar'):
+        cal_event = calendar_events.add_rsvpbot_event_to_gcal(event, event_id, self.users_filename)
+    except calendar_events.KeyfilePathNotSpecifiedError:
+      return strings.ERROR_CALENDAR_ENVS_NOT_SET
+    except calendar_events.DateAndTimeNotSuppliedError:
+      return strings.ERROR_DATE_AND_TIME_NOT_SET
+    except calendar_events.DurationNotSuppliedError:
+      return strings.ERROR_DURATION_NOT_SET
+    except Exception:
+      logging.exception('Error adding %s to the calendar.', event_id)
+      return strings.ERROR_CALENDAR_FAILED % self.key_word
+    if not cal_event:
+      return strings.ERROR_CALENDAR_ENVS_NOT_SET
+
+    calendar_event = {'id': cal_event.get('id'), 'html_link': cal_event.get('htmlLink')}
+    for _ in range(self.commit_attempts):
+      event = copy.deepcopy(self.events.get(event_id))
+      if event is None:
+        break
+      event['calendar_event'] = calendar_event
+      try:
+        self.publish(self.backend.commit_changes({event_id: (event_version(self.events.get(event_id)), event)}))
+        break
+      except ConflictError as e:
+        self.refresh(e.current)
+    else:
+      logging.warning('Could not record calendar event %s in %s.', calendar_event['id'], event_id)
+
+    return strings.MSG_ADDED_TO_CALENDAR.format(
+        calendar_name=cal_event.get('calendar_name'),
+        url=cal_event.get('htmlLink'))
+
+  def sync_calendar_event(self, event_id):
+    """Updates the calendar event of `event_id`, if it has one."""
+    event = self.events.get(event_id)
+    if not (event and event.get('calendar_event') and event['calendar_event']['id']):
+      return
+
+    try:
+      with tracing.span('rsvp.sync_calendar'):
+        calendar_events.update_gcal_event(event, event_id, self.users_filename)
+    except (calendar_events.KeyfilePathNotSpecifiedError,
+            calendar_events.DateAndTimeNotSuppliedError,
+            calendar_events.DurationNotSuppliedError):
+      pass
+
+  def route_internal(self, message, content, events, transaction=None):
     """Route message to matching command.
 
     To be a valid rsvp command, the string must start with the string rsvp.
@@ -89,40 +268,57 @@ class RSVP(object):
     We then pattern-match it with every known command pattern.
     If there's absolutely no match, we return None, which, for the purposes of this program,
     means no reply.
+
+    Commands run against `events`: the view of `transaction`, whose changes only
+    become visible when it's published, or a snapshot for read-only commands,
+    which have no transaction.
     """
     event_id = self.event_id(message)
 
     regex = r'^{}'.format(self.key_word)
 
     if re.match(regex, content, flags=re.I):
-      for command in self.command_list:
-        matches = command.match(content)
-        if matches:
-          kwargs = {
-            'event': self.events.get(event_id),
-            'event_id': event_id,
-            'sender_email': message['sender_email'],
-            'sender_full_name': message['sender_full_name'],
-            'sender_id': message['sender_id'],
-            'subject': message['subject'],
-          }
-
-          if matches.groupdict():
-            kwargs.update(matches.groupdict())
-
-          response = command.execute(self.events, **kwargs)
-
-          # Allow for a single events object but multiple messaages to send
-          self.events = response.events
-          self.commit_events()
-
-          # if it has multiple messages to send, then return that instead of
-          # the pair
-          return response.messages
-
-      return [rsvp_commands.RSVPMessage('private', ERROR_INVALID_COMMAND % (content), message['sender_email'])]
+      with tracing.span('rsvp.dispatch'):
+        command, matches = self.match_command(content)
+
+      if command is None:
+        return [rsvp_commands.RSVPMessage('private', ERROR_INVALID_COMMAND % (content), message['sender_email'])]
+
+      kwargs = {
+        'event': events.get(event_id),
+        'event_id': event_id,
+        'index': self.index,
+        'users_filename': self.users_filename,
+        'sender_email': message['sender_email'],
+        'sender_full_name': message['sender_full_name'],
+        'sender_id': message['sender_id'],
+        'subject': message['subject'],
+      }
+
+      if matches.groupdict():
+        kwargs.update(matches.groupdict())
+
+      with tracing.span('rsvp.command', command=type(command).__name__):
+        response = command.execute(events, **kwargs)
+      if transaction is not None:
+        transaction.record(response.event_ids)
+        if response.calendar_create:
+          transaction.calendar_create.append((event_id, response.calendar_create))
+
+      # if it has multiple messages to send, then return that instead of
+      # the pair
+      return response.messages
+
     return [rsvp_commands.RSVPMessage('private', None)]
 
+  def match_command(self, content):
+    """Returns the first command matching `content` and its match, or (None, None)."""
+    for command in self.command_list:
+      matches = command.match(content)
+      if matches:
+        return command, matches
+    return None, None
+
 
   def create_message_from_message(self, message, body):
     """Convenience method for creating a zulip response message from a
@@ -157,6 +353,34 @@ class RSVP(object):
     return u'{}/{}'.format(message['display_recipient'], message['subject'])
 
 
+class RSVPTransaction(object):
+  """Keeps track of the events changed by the commands of one message, which
+  run against a copy-on-write view of the `snapshot` they started from."""
+
+  def __init__(self, snapshot):
+    self.events = snapshot.begin()
+    self.changed = []
+    self.calendar_sync = []
+    # (event_id, reply) of the events to add to the calendar once committed.
+    self.calendar_create = []
+
+  def record(self, event_ids):
+    """Records the events a command changed."""
+    for event_id in event_ids:
+      if event_id not in self.changed:
+        self.changed.append(event_id)
+      if event_id not in self.calendar_sync:
+        self.calendar_sync.append(event_id)
+
+  def changes(self):
+    """The changes to commit, for the backend's `commit_changes`: each changed
+    event's version when the transaction started, and the event now (None if
+    it was deleted)."""
+    return dict(
+      (event_id, (event_version(self.events.snapshot.get(event_id)), self.events.get(event_id)))
+      for event_id in self.changed)
+
+
 def normalize_whitespace(content):
     """Strips trailing and leading whitespace from each line, and normalizes contiguous
     whitespace with a single space.
@@ -2,17 +2,23 @@
 from __future__ import unicode_literals
 import re
 import datetime
+import os
 from time import mktime
 import random
+import threading
 
 from pytimeparse.timeparse import timeparse
 import parsedatetime
 
-import calendar_events
+import memory
 import strings
 import util
+from parse_cache import ParseCache
 from zulip_users import ZulipUsers
 
+# Who can use the admin commands (`rsvp memory`): a comma separated list of emails.
+ADMINS = set(email.strip().lower() for email in os.getenv('ZULIP_RSVP_ADMINS', '').split(',') if email.strip())
+
 
 class RSVPMessage(object):
   """Class that represents a response from an RSVPCommand.
@@ -37,8 +43,18 @@ class RSVPMessage(object):
 
 
 class RSVPCommandResponse(object):
-  def __init__(self, events, *args):
+  """What an RSVPCommand returns: the events dict, the messages to send and,
+  through the `event_ids` keyword argument, the ids of the events it created,
+  modified or deleted. Changes to events that aren't listed are not saved.
+
+  `calendar_create`, an RSVPMessage, asks for the event to be added to the
+  calendar once the message's changes are committed: RSVP fills in its body
+  with the outcome then.
+  """
+  def __init__(self, events, *args, **kwargs):
     self.events = events
+    self.event_ids = kwargs.get('event_ids', [])
+    self.calendar_create = kwargs.get('calendar_create')
     self.messages = []
     for arg in args:
       if isinstance(arg, RSVPMessage):
@@ -48,6 +64,9 @@ class RSVPCommandResponse(object):
 class RSVPCommand(object):
   """Base class for an RSVPCommand."""
   regex = None
+  # Commands that don't change any event run on the current snapshot of the
+  # events (see RSVP.route), so they must not modify what they're given.
+  read_only = False
 
   def __init__(self, prefix, *args, **kwargs):
     # prefix is the command start the bot listens to, typically 'rsvp'
@@ -96,7 +115,7 @@ class RSVPInitCommand(RSVPCommand):
             'description': None,
             'place': None,
             'creator': sender_id,
-            'yes': [sender_email],
+            'yes': [sender_id],
             'no': [],
             'maybe': [],
             'time': None,
@@ -107,13 +126,18 @@ class RSVPInitCommand(RSVPCommand):
           }
         }
       )
-      response = RSVPCommandResponse(events, RSVPMessage('stream', body))
+      response = RSVPCommandResponse(events, RSVPMessage('stream', body), event_ids=[event_id])
 
     return response
 
 
+def parse_duration(raw_duration):
+  return timeparse(raw_duration, granularity='minutes')
+
+
 class RSVPSetDurationCommand(RSVPEventNeededCommand):
   regex = r'set duration (?P<duration>.+)$'
+  parsed_durations = ParseCache(parse_duration)
 
   def run(self, events, *args, **kwargs):
     event = kwargs.pop('event')
@@ -121,47 +145,27 @@ class RSVPSetDurationCommand(RSVPEventNeededCommand):
     duration = kwargs.pop('duration')
     sender_email = kwargs.pop('sender_email')
 
-    parsed_duration_in_seconds = timeparse(duration, granularity='minutes')
+    parsed_duration_in_seconds = self.parsed_durations(duration)
     event['duration'] = parsed_duration_in_seconds
     body = strings.MSG_DURATION_SET % (event_id, datetime.timedelta(seconds=parsed_duration_in_seconds))
-    calendar_event_id = event.get('calendar_event') and event['calendar_event']['id']
-    if calendar_event_id:
-      try:
-        calendar_events.update_gcal_event(event, event_id)
-      except calendar_events.KeyfilePathNotSpecifiedError:
-        pass
 
-    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email), event_ids=[event_id])
 
 
 class RSVPCreateCalendarEventCommand(RSVPEventNeededCommand):
+  """Only asks for the calendar event: it's created once the message is
+  committed (see RSVP.create_calendar_event), so a message that's rolled back
+  or run again never leaves one behind, or creates two."""
   regex = r'add to calendar$'
 
   def run(self, events, *args, **kwargs):
-    event = kwargs.pop('event')
-    event_id = kwargs.pop('event_id')
-
-    try:
-      cal_event = calendar_events.add_rsvpbot_event_to_gcal(event, event_id)
-    except calendar_events.KeyfilePathNotSpecifiedError:
-      body = strings.ERROR_CALENDAR_ENVS_NOT_SET
-    except calendar_events.DateAndTimeNotSuppliedError:
-      body = strings.ERROR_DATE_AND_TIME_NOT_SET
-    except calendar_events.DurationNotSuppliedError:
-      body = strings.ERROR_DURATION_NOT_SET
-    else:
-      event['calendar_event'] = {}
-      event['calendar_event']['id'] = cal_event.get('id')
-      event['calendar_event']['html_link'] = cal_event.get('htmlLink')
-      body = strings.MSG_ADDED_TO_CALENDAR.format(
-          calendar_name=cal_event.get('calendar_name'),
-          url=cal_event.get('htmlLink'))
-
-    return RSVPCommandResponse(events, RSVPMessage('stream', body))
+    reply = RSVPMessage('stream', None)
+    return RSVPCommandResponse(events, reply, calendar_create=reply)
 
 
 class RSVPHelpCommand(RSVPCommand):
   regex = r'help$'
+  read_only = True
 
   with open('README.md', 'r') as readme_file:
       readme_contents = readme_file.read()
@@ -184,13 +188,16 @@ class RSVPCancelCommand(RSVPEventNeededCommand):
     # Only they can delete the event.
     creator = event['creator']
 
+    event_ids = []
+
     if creator == sender_id:
       body = strings.MSG_EVENT_CANCELED
       events.pop(event_id)
+      event_ids.append(event_id)
     else:
       body = strings.ERROR_NOT_AUTHORIZED_TO_DELETE
 
-    return RSVPCommandResponse(events, RSVPMessage('stream', body))
+    return RSVPCommandResponse(events, RSVPMessage('stream', body), event_ids=event_ids)
 
 
 class RSVPMoveCommand(RSVPEventNeededCommand):
@@ -202,6 +209,7 @@ class RSVPMoveCommand(RSVPEventNeededCommand):
     event = kwargs.pop('event')
     destination = kwargs.pop('destination')
     success_msg = None
+    event_ids = []
 
     # Check if the issuer of this command is the event's original creator.
     # Only she can modify the event.
@@ -243,14 +251,96 @@ class RSVPMoveCommand(RSVPEventNeededCommand):
           )
 
           success_msg = RSVPMessage('stream', strings.MSG_INIT_SUCCESSFUL, stream, topic)
+          event_ids = [event_id, new_event_id]
 
-    return RSVPCommandResponse(events, RSVPMessage('stream', body), success_msg)
+    return RSVPCommandResponse(events, RSVPMessage('stream', body), success_msg, event_ids=event_ids)
 
 
 class LimitReachedException(Exception):
   pass
 
 
+class ConfirmMatch(object):
+  """The decision ConfirmMatcher found, with the same groups as RSVPConfirmCommand.regex."""
+
+  def __init__(self, decision, text):
+    self.decision = decision
+    self.text = text
+
+  def groupdict(self):
+    return dict(
+      ('%s_decision' % decision, self.text if decision == self.decision else None)
+      for decision in ('yes', 'no', 'maybe'))
+
+
+class ConfirmMatcher(object):
+  """Finds the first yes/no/maybe in a message, in one pass.
+
+  A single scanner regex walks the message once, yielding only the tokens that
+  could be an answer: whole words starting with the first letter of one, and
+  the answer emojis. Each word is then looked up in the tables below, so no
+  alternative is ever retried at a position.
+
+  `words` are answers that must match a whole word, `stretched` ones may repeat
+  their last letter ("yesss", "nooo"); all of them are lowercase.
+  """
+
+  words = {
+    'yes': ('in', 'yep', 'y'),
+    'no': ('out', 'nope', 'n'),
+    'maybe': ('maybe',),
+  }
+  stretched = {
+    'yes': ('yes', 'yeah', 'yas'),
+    'no': ('no', 'nah'),
+    'maybe': (),
+  }
+  emojis = {
+    'yes': (':thumbsup:', ':thumbs_up:', ':+1:'),
+    'no': (':thumbsdown:', ':thumbs_down:', ':-1:'),
+    'maybe': (),
+  }
+  decisions = ('yes', 'no', 'maybe')
+
+  def __init__(self, prefix):
+    self.prefix = re.compile(prefix, flags=re.I)
+    self.answers = {}
+    self.stretched_answers = {}
+    for decision in self.decisions:
+      for answer in self.words[decision] + self.emojis[decision]:
+        self.answers[answer] = decision
+      for answer in self.stretched[decision]:
+        self.stretched_answers[answer] = decision
+
+    first_letters = set(word[0] for words in (self.words, self.stretched) for answers in words.values()
+                        for word in answers)
+    emojis = sorted((emoji for emojis in self.emojis.values() for emoji in emojis), key=len, reverse=True)
+    # \w* is greedy and followed by a non word character either way, so this
+    # never backtracks.
+    self.tokens = re.compile(r'(?<!\w)(?:[{letters}]\w*|(?:{emojis})(?!\w))'.format(
+      letters=''.join(sorted(first_letters)),
+      emojis='|'.join(re.escape(emoji) for emoji in emojis)), flags=re.I)
+
+  def decide(self, token):
+    token = token.lower()
+    decision = self.answers.get(token)
+    if decision:
+      return decision
+    # "yesss" -> "yes"
+    return self.stretched_answers.get(token.rstrip(token[-1]) + token[-1])
+
+  def match(self, text):
+    prefix = self.prefix.match(text)
+    if not prefix:
+      return None
+
+    for token in self.tokens.finditer(text, prefix.end()):
+      decision = self.decide(token.group())
+      if decision:
+        return ConfirmMatch(decision, token.group())
+    return None
+
+
 class RSVPConfirmCommand(RSVPEventNeededCommand):
 
   yes_answers = (
@@ -281,11 +371,22 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
   # matched is a word on its own, i.e. we want to match "yes" but not
   # "yesterday". We can't use simple word boundaries here ("\b") if we want to
   # support emojis like :thumbsup: because ':' is not a word character.
+  #
+  # `match` doesn't run this regex anymore, it is kept as the specification of
+  # what a decision looks like: ConfirmMatcher finds the same one in a single
+  # pass over the message instead of trying every alternative at every position.
   regex = r'.*?(?<!\w)({yes}|{no}|{maybe})(?!\w)'.format(
     yes=regex_yes,
     no=regex_no,
     maybe=regex_maybe)
 
+  def __init__(self, prefix, *args, **kwargs):
+    super(RSVPConfirmCommand, self).__init__(prefix, *args, **kwargs)
+    self.matcher = ConfirmMatcher(self.prefix)
+
+  def match(self, input_str):
+    return self.matcher.match(input_str)
+
   responses = {
     "yes": "**You** are attending **%s**!",
     "no": "You are **not** attending **%s**!",
@@ -318,39 +419,41 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
         return response_string + random.choice(self.funky_no_postfixes)
       return response_string
 
-  def confirm(self, event, event_id, sender_email, decision):
+  def confirm(self, event, event_id, sender_id, sender_email, decision):
     # Temporary kludge to add a 'maybe' array to legacy events. Can be removed after
     # all currently logged events have passed.
     if ('maybe' not in event.keys()):
       event['maybe'] = []
 
+    # Attendees are stored by user id. Older events list emails: whoever answers
+    # again is moved over to their id.
+    sender = (sender_id, sender_email)
+
     # If they're in a different response list, take them out of it.
     for response in self.responses.keys():
       # prevent duplicates if replying multiple times
       if (response == decision):
-        # if they're already in that list, nothing to do
-        if (sender_email not in event[response]):
-          event[response].append(sender_email)
+        attendees = []
+        for attendee in event[response] + [sender_id]:
+          if attendee in sender:
+            attendee = sender_id
+          if attendee not in attendees:
+            attendees.append(attendee)
+        event[response] = attendees
       # else, remove all instances of them from other response lists.
-      elif sender_email in event[response]:
-        event[response] = [value for value in event[response] if value != sender_email]
-      calendar_event_id = event.get('calendar_event') and event['calendar_event']['id']
-      if calendar_event_id:
-        try:
-          calendar_events.update_gcal_event(event, event_id)
-        except calendar_events.KeyfilePathNotSpecifiedError:
-          pass
+      elif sender_id in event[response] or sender_email in event[response]:
+        event[response] = [value for value in event[response] if value not in sender]
 
     return event
 
-  def attempt_confirm(self, event, event_id, sender_email, decision, limit):
+  def attempt_confirm(self, event, event_id, sender_id, sender_email, decision, limit):
     if decision == 'yes' and limit:
       available_seats = limit - len(event['yes'])
       # In this case, we need to do some extra checking for the attendance limit.
       if (available_seats - 1 < 0):
         raise LimitReachedException()
 
-    return self.confirm(event, event_id, sender_email, decision)
+    return self.confirm(event, event_id, sender_id, sender_email, decision)
 
   def run(self, events, *args, **kwargs):
     event_id = kwargs.pop('event_id')
@@ -360,19 +463,22 @@ class RSVPConfirmCommand(RSVPEventNeededCommand):
     decision = 'yes' if yes_decision else ('no' if no_decision else 'maybe')
     sender_name = kwargs.pop('sender_full_name')
     sender_email = kwargs.pop('sender_email')
+    sender_id = kwargs.pop('sender_id')
 
     limit = event['limit']
+    event_ids = []
 
     try:
-      event = self.attempt_confirm(event, event_id,  sender_email, decision, limit)
+      event = self.attempt_confirm(event, event_id, sender_id, sender_email, decision, limit)
 
       # Update the events dict with the new event.
       events[event_id] = event
+      event_ids.append(event_id)
       # 1 in 10 chance of generating a funky response
       response = self.generate_response(decision, event_id, funkify=(random.random() < 0.1))
     except LimitReachedException:
       response = strings.ERROR_LIMIT_REACHED
-    return RSVPCommandResponse(events, RSVPMessage('private', response, sender_email))
+    return RSVPCommandResponse(events, RSVPMessage('private', response, sender_email), event_ids=event_ids)
 
 
 class RSVPSetLimitCommand(RSVPEventNeededCommand):
@@ -380,28 +486,41 @@ class RSVPSetLimitCommand(RSVPEventNeededCommand):
 
   def run(self, events, *args, **kwargs):
     event = kwargs.pop('event')
+    event_id = kwargs.pop('event_id')
     attendance_limit = int(kwargs.pop('limit'))
     event['limit'] = attendance_limit
-    return RSVPCommandResponse(events, RSVPMessage('stream', strings.MSG_ATTENDANCE_LIMIT_SET % attendance_limit))
+    return RSVPCommandResponse(
+      events,
+      RSVPMessage('stream', strings.MSG_ATTENDANCE_LIMIT_SET % attendance_limit),
+      event_ids=[event_id])
+
+
+_calendar = parsedatetime.Calendar()
+
+
+def parse_date(raw_date):
+  time_struct, parse_status = _calendar.parse(raw_date)
+  return datetime.date.fromtimestamp(mktime(time_struct))
 
 
 class RSVPSetDateCommand(RSVPEventNeededCommand):
-  cal = parsedatetime.Calendar()
   regex = r'set date (?P<date>.*)$'
+  # Relative dates ("tomorrow") change meaning at midnight.
+  parsed_dates = ParseCache(parse_date, daily=True)
 
   def _is_in_the_future(self, event_date):
     today = datetime.date.today()
     return event_date >= today
 
   def _parse_date(self, raw_date):
-    time_struct, parse_status = self.cal.parse(raw_date)
-    return datetime.date.fromtimestamp(mktime(time_struct))
+    return self.parsed_dates(raw_date)
 
   def run(self, events, *args, **kwargs):
     event = kwargs.pop('event')
     event_id = kwargs.pop('event_id')
     sender_email = kwargs.pop('sender_email')
     raw_date = kwargs.pop('date')
+    event_ids = []
     try:
       event_date = self._parse_date(raw_date)
     except ValueError:
@@ -410,17 +529,12 @@ class RSVPSetDateCommand(RSVPEventNeededCommand):
     if event_date and self._is_in_the_future(event_date):
       event['date'] = str(event_date)
       events[event_id] = event
+      event_ids.append(event_id)
       body = strings.MSG_DATE_SET % (event_id, event_date.strftime("%x"))
-      calendar_event_id = event.get('calendar_event') and event['calendar_event']['id']
-      if calendar_event_id:
-        try:
-          calendar_events.update_gcal_event(event, event_id)
-        except calendar_events.KeyfilePathNotSpecifiedError:
-          pass
     else:
       body = strings.ERROR_DATE_NOT_VALID % raw_date
 
-    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email), event_ids=event_ids)
 
 
 class RSVPSetTimeCommand(RSVPEventNeededCommand):
@@ -430,21 +544,17 @@ class RSVPSetTimeCommand(RSVPEventNeededCommand):
     event_id = kwargs.pop('event_id')
     hours, minutes = int(kwargs.pop('hours')), int(kwargs.pop('minutes'))
     sender_email = kwargs.pop('sender_email')
+    event_ids = []
 
     if hours in range(0, 24) and minutes in range(0, 60):
       event = events[event_id]
       event['time'] = '%02d:%02d' % (hours, minutes)
+      event_ids.append(event_id)
       body = strings.MSG_TIME_SET % (event_id, hours, minutes)
-      calendar_event_id = event.get('calendar_event') and event['calendar_event']['id']
-      if calendar_event_id:
-        try:
-          calendar_events.update_gcal_event(event, event_id)
-        except calendar_events.KeyfilePathNotSpecifiedError:
-          pass
     else:
       body = strings.ERROR_TIME_NOT_VALID % (hours, minutes)
 
-    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email), event_ids=event_ids)
 
 
 class RSVPSetTimeAllDayCommand(RSVPEventNeededCommand):
@@ -454,7 +564,10 @@ class RSVPSetTimeAllDayCommand(RSVPEventNeededCommand):
     event_id = kwargs.pop('event_id')
     sender_email = kwargs.pop('sender_email')
     events[event_id]['time'] = None
-    return RSVPCommandResponse(events, RSVPMessage('private', strings.MSG_TIME_SET_ALLDAY % event_id, sender_email))
+    return RSVPCommandResponse(
+      events,
+      RSVPMessage('private', strings.MSG_TIME_SET_ALLDAY % event_id, sender_email),
+      event_ids=[event_id])
 
 
 class RSVPSetStringAttributeCommand(RSVPEventNeededCommand):
@@ -470,38 +583,30 @@ class RSVPSetStringAttributeCommand(RSVPEventNeededCommand):
 
     event = events[event_id]
     event[attribute] = value
-    calendar_event_id = event.get('calendar_event') and event['calendar_event']['id']
-    if calendar_event_id:
-      try:
-        calendar_events.update_gcal_event(event, event_id)
-      except calendar_events.KeyfilePathNotSpecifiedError:
-        pass
     body = strings.MSG_STRING_ATTR_SET % (attribute, value)
-    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email), event_ids=[event_id])
 
 
 class RSVPPingCommand(RSVPEventNeededCommand):
   regex = r'^({key_word} ping)$|({key_word} ping (?P<message>.+))$'
+  read_only = True
 
   def __init__(self, prefix, *args, **kwargs):
     self.regex = self.regex.format(key_word=prefix)
 
-  def get_users_dict(self):
-    return ZulipUsers()
+  def get_users_dict(self, filename):
+    return ZulipUsers(filename)
 
   def run(self, events, *args, **kwargs):
-    users = self.get_users_dict()
+    users = self.get_users_dict(kwargs.pop('users_filename'))
 
     event = kwargs.pop('event')
     message = kwargs.get('message')
 
     body = "**Pinging all participants who RSVP'd!!**\n"
 
-    for participant in event['yes']:
-      body += "@**%s** " % users.convert_email_to_pingable_name(participant)
-
-    for participant in event['maybe']:
-      body += "@**%s** " % users.convert_email_to_pingable_name(participant)
+    for mention in users.mentions(event['yes'] + event['maybe']):
+      body += "%s " % mention
 
     if message:
       body += ('\n' + message)
@@ -511,6 +616,7 @@ class RSVPPingCommand(RSVPEventNeededCommand):
 
 class RSVPCreditsCommand(RSVPEventNeededCommand):
   regex = r'credits$'
+  read_only = True
 
   def run(self, events, *args, **kwargs):
 
@@ -549,14 +655,33 @@ class RSVPCreditsCommand(RSVPEventNeededCommand):
 
 
 class RSVPSummaryCommand(RSVPEventNeededCommand):
-  regex = r'(summary$|status$)'
+  """Shows an event's details, the number of people on each list and a page of
+  their names, `rows_per_page` per list. `summary page K` shows the K-th page
+  instead of the first, `summary full` every name. Only the names shown are
+  looked up and rendered."""
+  regex = r'(summary|status)( page (?P<page>\d+)| (?P<full>full))?$'
+  read_only = True
+  rows_per_page = 20
 
-  def get_users_dict(self):
-    return ZulipUsers()
+  def get_users_dict(self, filename):
+    return ZulipUsers(filename)
 
   def run(self, events, *args, **kwargs):
     event = kwargs.pop('event')
-    users = self.get_users_dict()
+    sender_email = kwargs.pop('sender_email')
+    page = int(kwargs.get('page') or 1)
+    responses = [event['yes'], event['no'], event['maybe']]
+
+    rows = max(len(attendees) for attendees in responses)
+    if kwargs.get('full'):
+      start, stop, pages = 0, rows, 1
+    else:
+      pages = max((rows + self.rows_per_page - 1) // self.rows_per_page, 1)
+      if not 1 <= page <= pages:
+        body = strings.ERROR_NO_SUCH_SUMMARY_PAGE % (page, pages)
+        return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+      start = (page - 1) * self.rows_per_page
+      stop = start + self.rows_per_page
 
     summary_table = '**%s**' % (event['name'])
     summary_table += '\t|\t\n:---:|:---:\n'
@@ -580,16 +705,99 @@ class RSVPSummaryCommand(RSVPEventNeededCommand):
 
     confirmation_table = confirmation_table.format(len(event['yes']), len(event['no']), len(event['maybe']))
 
-    row_list = map(None, event['yes'], event['no'], event['maybe'])
+    users = self.get_users_dict(kwargs.pop('users_filename'))
+    row_list = map(None, *[users.names(attendees[start:stop]) for attendees in responses])
 
     for row in row_list:
-      confirmation_table += '{}|{}|{}\n'.format(
-        '' if row[0] is None else users.convert_email_to_pingable_name(row[0]),
-        '' if row[1] is None else users.convert_email_to_pingable_name(row[1]),
-        '' if row[2] is None else users.convert_email_to_pingable_name(row[2])
-      )
+      confirmation_table += '{}|{}|{}\n'.format(*['' if name is None else name for name in row])
     else:
       confirmation_table += '\t|\t'
 
     body = summary_table + '\n\n' + confirmation_table
+    if page < pages:
+      body += '\n\n' + strings.MSG_SUMMARY_PAGE % (start + 1, stop, page, pages, page + 1)
     return RSVPCommandResponse(events, RSVPMessage('stream', body))
+
+
+class RSVPUpcomingCommand(RSVPCommand):
+  """Lists the events in the RSVP's EventIndex, passed in as the `index` keyword argument."""
+  regex = r'upcoming( (?P<stream>.+))?$'
+  read_only = True
+  days = 7
+
+  def now(self):
+    return datetime.datetime.now()
+
+  def run(self, events, *args, **kwargs):
+    sender_email = kwargs.pop('sender_email')
+    stream = kwargs.get('stream')
+    index = kwargs.pop('index')
+
+    # Start from midnight so that all day events (and whatever else is on) today are listed too.
+    today = datetime.datetime.combine(self.now().date(), datetime.time())
+    upcoming = index.between(today, today + datetime.timedelta(days=self.days), stream)
+
+    if not upcoming:
+      body = strings.MSG_NO_UPCOMING_EVENTS % self.days
+      return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+
+    body = '**Upcoming events**\t|\t\n:---:|:---:\n'
+    for start, end, event_id in upcoming:
+      event = events.get(event_id)
+      if not event:
+        continue
+      stream_name, _, topic = event_id.partition('/')
+      when = start.strftime('%a %Y-%m-%d') + (' @ %s' % event['time'] if event['time'] else ' (All day)')
+      body += '%s|[%s](%s)\n' % (when, event['name'], util.stream_topic_to_narrow_url(stream_name, topic))
+
+    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+
+
+class RSVPMemoryCommand(RSVPCommand):
+  """Sends an admin a report of the memory this bot takes, see memory.py."""
+  regex = r'memory$'
+  read_only = True
+
+  def run(self, events, *args, **kwargs):
+    sender_email = kwargs.pop('sender_email')
+    if sender_email.lower() not in ADMINS:
+      return RSVPCommandResponse(events, RSVPMessage('private', strings.ERROR_NOT_AN_ADMIN, sender_email))
+
+    # Along with commands that change events, it runs in their transaction: the
+    # snapshot that started from is what the bot keeps in memory.
+    snapshot = getattr(events, 'snapshot', events)
+    body = memory.format_report(memory.report(snapshot, ZulipUsers(kwargs.pop('users_filename'))))
+    return RSVPCommandResponse(events, RSVPMessage('private', body, sender_email))
+
+
+_command_tables = {}
+_command_tables_lock = threading.Lock()
+
+
+def command_table(key_word):
+  """The commands for `key_word`, in the order they're matched. Commands keep
+  no state of their own, so every RSVP with the same key word shares them."""
+  with _command_tables_lock:
+    if key_word not in _command_tables:
+      _command_tables[key_word] = (
+        RSVPInitCommand(key_word),
+        RSVPHelpCommand(key_word),
+        RSVPCancelCommand(key_word),
+        RSVPMoveCommand(key_word),
+        RSVPSetLimitCommand(key_word),
+        RSVPSetDateCommand(key_word),
+        RSVPSetTimeCommand(key_word),
+        RSVPSetTimeAllDayCommand(key_word),
+        RSVPSetStringAttributeCommand(key_word),
+        RSVPSummaryCommand(key_word),
+        RSVPPingCommand(key_word),
+        RSVPCreditsCommand(key_word),
+        RSVPCreateCalendarEventCommand(key_word),
+        RSVPSetDurationCommand(key_word),
+        RSVPUpcomingCommand(key_word),
+        RSVPMemoryCommand(key_word),
+
+        # This needs to be at last for fuzzy yes|no checking
+        RSVPConfirmCommand(key_word)
+      )
+    return _command_tables[key_word]
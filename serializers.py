@@ -0,0 +1,258 @@
+"""
+Serializers for the files RSVPBot keeps its data in (events.json, zulip_users.json).
+
+Files start with a one line header naming the format they were written in and
+its version, e.g.
+
+    RSVPBOT marshal 2
+
+followed by the payload, so `load` picks the right serializer whatever format
+the bot is currently configured to write. Files without a header are plain JSON
+written by older versions of the bot.
+
+Formats:
+
+* `json`: compact JSON, one item of the top level dictionary per line.
+  Encoded with simplejson's C encoder when it's installed, decoded with the
+  stdlib's (C accelerated) decoder so strings always come back as unicode.
+  `load_items` reads it a line at a time, so a store never has to be in memory
+  twice and a corrupt or truncated line only loses the item on it.
+* `marshal`: Python's own binary format. The fastest by far, but only readable
+  by the same major version of Python; the header records `marshal.version` so
+  a newer file is refused rather than misread.
+
+Files are written to a temporary file that's then renamed over the old one, so
+a crash mid-write leaves the previous version rather than a truncated file.
+
+The format written by default is picked with the ZULIP_RSVP_FORMAT environment
+variable (`json` unless set).
+"""
+import contextlib
+import gc
+import itertools
+import json
+import marshal
+import os
+import re
+
+try:
+    import simplejson
+    from simplejson.encoder import c_make_encoder
+except ImportError:
+    simplejson = None
+    c_make_encoder = None
+
+HEADER_PREFIX = 'RSVPBOT '
+
+
+class SerializerError(ValueError):
+    pass
+
+
+class Serializer(object):
+    name = None
+    version = 1
+
+    def dumps(self, obj):
+        raise NotImplementedError('You must override the dumps method.')
+
+    def loads(self, payload):
+        raise NotImplementedError('You must override the loads method.')
+
+    def can_load(self, version):
+        return version <= self.version
+
+    def iter_items(self, lines, on_error):
+        """Yields the (key, value) items of the dictionary in `lines`, the
+        (line number, line) pairs of the rest of the file after the header.
+        Formats that can't be read piecemeal decode it all at once, and raise a
+        ValueError if it's corrupt."""
+        return self.loads(''.join(line for _, line in lines)).iteritems()
+
+
+class JSONSerializer(Serializer):
+    name = 'json'
+
+    def dumps(self, obj):
+        if not isinstance(obj, dict) or not obj:
+            return self.encode(obj)
+        return '{\n%s\n}' % ',\n'.join(
+            '%s:%s' % (self.encode(key), self.encode(value)) for key, value in obj.iteritems())
+
+    def encode(self, obj):
+        if c_make_encoder is not None:
+            return simplejson.dumps(obj, separators=(',', ':'))
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, payload):
+        return json.loads(payload)
+
+    def iter_items(self, lines, on_error):
+        # Every event has the same keys: decode them to the same objects rather
+        # than to a new string per event.
+        keys = {}
+        decoder = json.JSONDecoder(object_pairs_hook=lambda pairs: dict(
+            [(keys.setdefault(key, key), value) for key, value in pairs]))
+
+        for number, line in lines:
+            line = line.strip().rstrip(',')
+            if line in ('', '{', '}'):
+                continue
+            if line.startswith('{'):
+                # The whole dictionary on one line: written before items got
+                # lines of their own.
+                for item in iter_object(line, number, on_error, decoder):
+                    yield item
+                continue
+            try:
+                item = decoder.decode('{%s}' % line)
+            except ValueError as e:
+                on_error(number, str(e))
+                continue
+            if len(item) != 1:
+                on_error(number, 'Expected a single item, found %d' % len(item))
+                continue
+            yield item.popitem()
+
+
+class MarshalSerializer(Serializer):
+    name = 'marshal'
+    version = marshal.version
+
+    def dumps(self, obj):
+        return marshal.dumps(obj)
+
+    def loads(self, payload):
+        try:
+            return marshal.loads(payload)
+        except (EOFError, TypeError) as e:
+            raise SerializerError('Corrupt marshal data: %s' % e)
+
+
+_whitespace = re.compile(r'\s*')
+
+
+def iter_object(text, number, on_error, decoder=json.JSONDecoder()):
+    """Yields the items of the JSON object `text` one at a time. If the object
+    is corrupt or truncated, the items before the damage are still yielded."""
+    def skip(position, expected):
+        position = _whitespace.match(text, position).end()
+        if text[position:position + 1] not in expected:
+            raise ValueError('Expected %s at column %d' % (' or '.join(map(repr, expected)), position + 1))
+        return _whitespace.match(text, position + 1).end()
+
+    try:
+        position = skip(0, '{')
+        if text[position:position + 1] == '}':
+            return
+        while True:
+            key, position = decoder.raw_decode(text, position)
+            if not isinstance(key, basestring):
+                raise ValueError('Expected a key at column %d' % (position + 1))
+            value, position = decoder.raw_decode(text, skip(position, ':'))
+            yield key, value
+            position = _whitespace.match(text, position).end()
+            if text[position:position + 1] == '}':
+                return
+            position = skip(position, ',')
+    except ValueError as e:
+        on_error(number, '%s; the rest of the line was skipped' % e)
+
+
+SERIALIZERS = dict((serializer.name, serializer) for serializer in (JSONSerializer(), MarshalSerializer()))
+
+
+def get_serializer(name=None):
+    """Returns the serializer called `name`, or the configured default one."""
+    name = name or os.getenv('ZULIP_RSVP_FORMAT', 'json')
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise SerializerError('Unknown format %r' % name)
+
+
+def dumps(obj, serializer=None):
+    serializer = serializer or get_serializer()
+    return '%s%s %d\n%s' % (HEADER_PREFIX, serializer.name, serializer.version, serializer.dumps(obj))
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """Decoding a big store allocates a container per event, and the cyclic
+    garbage collector keeps rescanning all of them while they're being built.
+    None of them can be garbage yet, so don't let it."""
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def loads(data):
+    with paused_gc():
+        return _loads(data)
+
+
+def _loads(data):
+    if not data.startswith(HEADER_PREFIX):
+        # Written before files had a header.
+        return json.loads(data)
+
+    header, _, payload = data.partition('\n')
+    return _serializer_for(header).loads(payload)
+
+
+def _serializer_for(header):
+    try:
+        _, name, version = header.rstrip('\n').split(' ')
+        version = int(version)
+    except ValueError:
+        raise SerializerError('Malformed header %r' % header)
+
+    serializer = get_serializer(name)
+    if not serializer.can_load(version):
+        raise SerializerError('Can not read version %d of the %s format' % (version, name))
+    return serializer
+
+
+def dump(obj, filename, serializer=None):
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(dumps(obj, serializer))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary, filename)
+
+
+def load(filename):
+    with open(filename, 'rb') as f:
+        return loads(f.read())
+
+
+def load_items(filename, on_error=None):
+    """
+    Yields the (key, value) items of the dictionary stored in `filename` one at
+    a time, reading no more of the file than the item needs where the format
+    allows it (see `JSONSerializer`).
+
+    Items that can't be decoded are reported by calling `on_error` with their
+    line number and the reason, and skipped. Without `on_error`, they raise a
+    SerializerError. A header that can't be read raises whichever.
+    """
+    def raise_error(number, message):
+        raise SerializerError('Line %d: %s' % (number, message))
+
+    with open(filename, 'rb') as f:
+        lines = enumerate(f, 1)
+        number, header = next(lines, (1, ''))
+        if header.startswith(HEADER_PREFIX):
+            serializer = _serializer_for(header)
+        else:
+            # Written before files had a header.
+            serializer = SERIALIZERS['json']
+            lines = itertools.chain([(number, header)], lines)
+
+        for item in serializer.iter_items(lines, on_error or raise_error):
+            yield item
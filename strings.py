@@ -7,13 +7,21 @@ MSG_STRING_ATTR_SET = "The %s for this event has been set to **%s**!\n`rsvp help
 MSG_ATTENDANCE_LIMIT_SET = "The attendance limit for this event has been set to **%d**! Hurry up and `rsvp yes` now!.\n`rsvp help` for more options"
 MSG_EVENT_CANCELED = "The event has been canceled!"
 MSG_EVENT_MOVED = "This event has been moved to [%s](%s)!"
+MSG_NO_UPCOMING_EVENTS = "There are no RSVPBot events in the next %d days."
+MSG_REMINDER = "Reminder: **%s** starts in **%s**! `rsvp summary` for the details."
+MSG_SUMMARY_PAGE = "Attendees %d to %d, page %d of %d. `rsvp summary page %d` for the next ones, `rsvp summary full` for everyone."
 MSG_ADDED_TO_CALENDAR = "Event [added to {calendar_name} Calendar]({url})!"
+ERROR_COMMAND_FAILED = "Oops! Something went wrong with `%s`, so none of the commands in your message were applied."
+ERROR_CALENDAR_FAILED = "Oops! Something went wrong with `%s add to calendar`, so the event wasn't added to the calendar. The rest of your message was applied."
+ERROR_CONFLICT = "Oops! This event is changing too fast right now, so none of the commands in your message were applied. Please try again."
 ERROR_INVALID_COMMAND = "`%s` is not a valid RSVPBot command! Type `rsvp help` for the correct syntax."
 ERROR_NOT_AN_EVENT = "This thread is not an RSVPBot event!. Type `rsvp init` to make it into an event."
+ERROR_NOT_AN_ADMIN = "Oops! Only RSVPBot's admins can do that."
 ERROR_NOT_AUTHORIZED_TO_DELETE = "Oops! You cannot cancel this event! Only the event's original creator can do so."
 ERROR_ALREADY_AN_EVENT = "Oops! That thread is already an RSVPBot event!"
 ERROR_TIME_NOT_VALID = "Oops! **%02d:%02d** is not a valid time!"
 ERROR_DATE_NOT_VALID = "Oops! **%s** is not a valid date in the **future**!"
+ERROR_NO_SUCH_SUMMARY_PAGE = "Oops! There's no page **%d** of attendees, this event's summary only has **%d**."
 ERROR_LIMIT_REACHED = "Oh no! The **limit** for this event has been reached!"
 ERROR_MISSING_MOVE_DESTINATION = "`rsvp move` requires a Zulip stream URL destination (e.g. 'https://recurse.zulipchat.com/#narrow/stream/announce/topic/All.20Hands.20Meeting')"
 ERROR_BAD_MOVE_DESTINATION = "`%s` is not a valid move destination URL!`rsvp move` requires a Zulip stream URL destination (e.g. 'https://recurse.zulipchat.com/#narrow/stream/announce/topic/All.20Hands.20Meeting') Type `rsvp help` for the correct syntax."
@@ -0,0 +1,124 @@
+"""
+Runs several bot identities and key words ("tenants") in one process, rather
+than a process, with its own interpreter and copies of every module, each.
+
+    python tenants.py tenants.json
+
+where tenants.json lists them:
+
+    [
+        {"name": "rc", "email": "rsvp-bot@zulipchat.com", "api_key": "...",
+         "site": "https://recurse.zulipchat.com", "key_word": "rsvp",
+         "streams": [], "reminders": "1d,1h"},
+        {"name": "rc-events", "email": "events-bot@zulipchat.com", "api_key": "...",
+         "site": "https://recurse.zulipchat.com", "key_word": "event"}
+    ]
+
+Only `name`, `email` and `api_key` are required; the others default like the
+environment variables bot.py reads. Each tenant keeps its events, processed
+messages, event queue position and user directory in a directory of its own,
+`<directory>/<name>`, and polls Zulip from a thread of its own.
+
+Tenants share what doesn't belong to any of them: the command tables (one per
+key word, see rsvp_commands.command_table), the discovery documents Google
+Calendar services are built from (see calendar_events), and the pool of
+connections their Zulip API calls go through (see http_pool).
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+
+import http_pool
+from bot import Bot
+from reminders import parse_offsets
+
+
+class Tenant(object):
+
+    def __init__(self, name, email, api_key, site='https://recurse.zulipchat.com', key_word='rsvp',
+                 streams=None, reminders=''):
+        self.name = name
+        self.email = email
+        self.api_key = api_key
+        self.site = site
+        self.key_word = key_word
+        self.streams = streams or []
+        self.reminders = reminders
+
+
+def load_tenants(filename):
+    with open(filename) as f:
+        return [Tenant(**tenant) for tenant in json.load(f)]
+
+
+class Runner(object):
+    """Hosts a Bot per tenant. `start()` runs them all in background threads;
+    a bot that crashes is logged and started again after `restart_delay`
+    seconds, without disturbing the others."""
+    restart_delay = 5
+
+    def __init__(self, tenants, directory='tenants'):
+        # Each bot holds a connection for its long poll, and one for what it sends meanwhile.
+        self.session = http_pool.make_session(pool_size=2 * len(tenants) + 2)
+        self.bots = {}
+        for tenant in tenants:
+            if tenant.name in self.bots:
+                raise ValueError('Two tenants are called %r' % tenant.name)
+            tenant_directory = os.path.join(directory, tenant.name)
+            if not os.path.isdir(tenant_directory):
+                os.makedirs(tenant_directory)
+            self.bots[tenant.name] = Bot(
+                tenant.email, tenant.api_key, tenant.key_word, tenant.streams, tenant.site,
+                parse_offsets(tenant.reminders), directory=tenant_directory, http_session=self.session)
+        self.threads = {}
+        self.stopped = threading.Event()
+
+    def start(self):
+        for name, bot in self.bots.items():
+            thread = threading.Thread(target=self.run_bot, args=(name, bot), name='tenant-%s' % name)
+            thread.daemon = True
+            thread.start()
+            self.threads[name] = thread
+        return self
+
+    def run_bot(self, name, bot):
+        while not (self.stopped.is_set() or bot.stopped):
+            try:
+                bot.main()
+            except Exception:
+                logging.exception('Tenant %s crashed, restarting it in %ds.', name, self.restart_delay)
+                self.stopped.wait(self.restart_delay)
+
+    def stop(self, timeout=None):
+        """Stops every bot once its current poll is over, and waits for them."""
+        self.stopped.set()
+        for bot in self.bots.values():
+            bot.stop()
+        for thread in self.threads.values():
+            thread.join(timeout)
+
+    def wait(self):
+        """Blocks until stop() is called, e.g. by a signal handler."""
+        while not self.stopped.is_set():
+            # Waiting with a timeout lets KeyboardInterrupt through.
+            self.stopped.wait(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs every bot listed in a tenants file in one process.')
+    parser.add_argument('tenants', help='JSON file listing the tenants')
+    parser.add_argument('--directory', default='tenants', help='where the tenants keep their files')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    runner = Runner(load_tenants(args.tenants), args.directory).start()
+    try:
+        runner.wait()
+    except KeyboardInterrupt:
+        runner.stop(timeout=5)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,49 @@
 from collections import Counter
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+import glob
+import json
 import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from mock import Mock, patch
+from mock import Mock, call, patch
 
+import bot
 import calendar_events
+import memory
+import replication
 import rsvp
 import rsvp_commands
+import serializers
+import tenants
+import tracing
+import zulip_users
 from zulip_users import ZulipUsers
-from backends import FileBackend
+from backends import ConflictError, DbmBackend, FileBackend, WholeStoreAdapter
+from event_index import EventIndex
+from event_map import EventMap
+from parse_cache import ParseCache
+from reminders import ReminderScheduler, parse_offsets
+from processed_messages import ProcessedMessages
+from event_queue import EventQueueState
+from fake_gcal import FakeCalendarServer
+from fake_zulip import FakeZulipServer, ZulipError
+from file_lock import FileLock
+
+
+# Made up Zulip user ids of the test users, by email.
+USER_IDS = {'a@example.com': 12345}
+
+
+def user_id(email):
+    return USER_IDS.setdefault(email, 20000 + len(USER_IDS))
 
 
 class CalendarEventTest(unittest.TestCase):
@@ -148,13 +182,19 @@ class RSVPTest(unittest.TestCase):
     def setUp(self):
         self.rsvp = rsvp.RSVP('rsvp', FileBackend(filename='test.json'))
         self.issue_command('rsvp init')
-        self.event = self.get_test_event()
+
+    @property
+    def event(self):
+        # Commands publish new copies of the events they change, so always look
+        # at the current one.
+        return self.get_test_event()
 
     def tearDown(self):
-        try:
-            os.remove('test.json')
-        except OSError:
-            pass
+        for filename in ('test.json', 'test.json.lock'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
 
     def create_input_message(
             self,
@@ -162,7 +202,7 @@ class RSVPTest(unittest.TestCase):
             sender_full_name='Tester',
             subject='Testing',
             display_recipient='test-stream',
-            sender_id='12345',
+            sender_id=None,
             message_type='stream',
             sender_email='a@example.com'):
 
@@ -170,7 +210,7 @@ class RSVPTest(unittest.TestCase):
             'content': content,
             'subject': subject,
             'display_recipient': display_recipient,
-            'sender_id': sender_id,
+            'sender_id': user_id(sender_email) if sender_id is None else sender_id,
             'sender_full_name': sender_full_name,
             'sender_email': sender_email,
             'type': message_type,
@@ -191,7 +231,7 @@ class RSVPTest(unittest.TestCase):
 class RSVPInitTest(RSVPTest):
     def test_event_init(self):
         self.assertIn('test-stream/Testing', self.rsvp.events)
-        self.assertEqual('12345', self.event['creator'])
+        self.assertEqual(user_id('a@example.com'), self.event['creator'])
 
     def test_cannot_double_init(self):
         output = self.issue_command('rsvp init')
@@ -282,36 +322,36 @@ class RSVPDecisionTest(RSVPTest):
 
         self.assertEqual(None, self.event['limit'])
         self.assertIn('**You** are attending', output[0]['body'])
-        self.assertIn('a@example.com', self.event['yes'])
-        self.assertNotIn('a@example.com', self.event['no'])
-        self.assertNotIn('a@example.com', self.event['maybe'])
+        self.assertIn(user_id('a@example.com'), self.event['yes'])
+        self.assertNotIn(user_id('a@example.com'), self.event['no'])
+        self.assertNotIn(user_id('a@example.com'), self.event['maybe'])
 
     def test_rsvp_maybe_with_no_prior_reservation(self):
         output = self.issue_command('rsvp maybe')
 
         self.assertEqual(None, self.event['limit'])
         self.assertIn("You **might** be attending", output[0]['body'])
-        self.assertIn('a@example.com', self.event['maybe'])
-        self.assertNotIn('a@example.com', self.event['no'])
-        self.assertNotIn('a@example.com', self.event['yes'])
+        self.assertIn(user_id('a@example.com'), self.event['maybe'])
+        self.assertNotIn(user_id('a@example.com'), self.event['no'])
+        self.assertNotIn(user_id('a@example.com'), self.event['yes'])
 
     def test_rsvp_no_with_no_prior_reservation(self):
         output = self.issue_command('rsvp no')
 
         self.assertIn('You are **not** attending', output[0]['body'])
-        self.assertNotIn('a@example.com', self.event['yes'])
-        self.assertNotIn('a@example.com', self.event['maybe'])
-        self.assertIn('a@example.com', self.event['no'])
+        self.assertNotIn(user_id('a@example.com'), self.event['yes'])
+        self.assertNotIn(user_id('a@example.com'), self.event['maybe'])
+        self.assertIn(user_id('a@example.com'), self.event['no'])
 
     def test_rsvp_yes_with_prior_reservation(self):
         self.issue_command('rsvp yes')
         count_dict = Counter(self.event['yes'])
 
-        self.assertEqual(1, count_dict['a@example.com'])
+        self.assertEqual(1, count_dict[user_id('a@example.com')])
 
         self.issue_command('rsvp yes')
         count_dict = Counter(self.event['yes'])
-        self.assertEqual(1, count_dict['a@example.com'])
+        self.assertEqual(1, count_dict[user_id('a@example.com')])
 
     def test_rsvp_maybe_with_prior_reservation(self):
         self.issue_command('rsvp maybe')
@@ -319,7 +359,7 @@ class RSVPDecisionTest(RSVPTest):
 
         count_dict = Counter(self.event['maybe'])
 
-        self.assertEqual(1, count_dict['a@example.com'])
+        self.assertEqual(1, count_dict[user_id('a@example.com')])
 
     def test_rsvp_no_with_prior_cancelation(self):
         self.issue_command('rsvp no')
@@ -327,49 +367,49 @@ class RSVPDecisionTest(RSVPTest):
 
         count_dict = Counter(self.event['no'])
 
-        self.assertEqual(1, count_dict['a@example.com'])
+        self.assertEqual(1, count_dict[user_id('a@example.com')])
 
     def test_rsvp_changing_response(self):
         output = self.issue_command('rsvp maybe')
         count_dict = Counter(self.event['maybe'])
-        self.assertEqual(1, count_dict['a@example.com'])
+        self.assertEqual(1, count_dict[user_id('a@example.com')])
         self.assertIn("You **might** be attending", output[0]['body'])
 
         # NOT in the yes or no lists
         count_dict = Counter(self.event['yes'])
-        self.assertEqual(0, count_dict['a@example.com'])
+        self.assertEqual(0, count_dict[user_id('a@example.com')])
         count_dict = Counter(self.event['no'])
-        self.assertEqual(0, count_dict['a@example.com'])
+        self.assertEqual(0, count_dict[user_id('a@example.com')])
 
         output = self.issue_command('rsvp no')
         count_dict = Counter(self.event['no'])
-        self.assertEqual(1, count_dict['a@example.com'])
+        self.assertEqual(1, count_dict[user_id('a@example.com')])
         self.assertIn('You are **not** attending', output[0]['body'])
 
         # NOT in the yes or maybe lists
         count_dict = Counter(self.event['yes'])
-        self.assertEqual(0, count_dict['a@example.com'])
+        self.assertEqual(0, count_dict[user_id('a@example.com')])
         count_dict = Counter(self.event['maybe'])
-        self.assertEqual(0, count_dict['a@example.com'])
+        self.assertEqual(0, count_dict[user_id('a@example.com')])
 
         output = self.issue_command('rsvp yes')
         count_dict = Counter(self.event['yes'])
-        self.assertEqual(1, count_dict['a@example.com'])
+        self.assertEqual(1, count_dict[user_id('a@example.com')])
         self.assertIn('**You** are attending', output[0]['body'])
 
         # NOT in the no or maybe lists
         count_dict = Counter(self.event['no'])
-        self.assertEqual(0, count_dict['a@example.com'])
+        self.assertEqual(0, count_dict[user_id('a@example.com')])
         count_dict = Counter(self.event['maybe'])
-        self.assertEqual(0, count_dict['a@example.com'])
+        self.assertEqual(0, count_dict[user_id('a@example.com')])
 
     def general_yes_with_no_prior_reservation(self, msg):
         output = self.issue_command(msg)
 
         self.assertEqual(None, self.event['limit'])
         self.assertIn('are attending', output[0]['body'])
-        self.assertIn('a@example.com', self.event['yes'])
-        self.assertNotIn('a@example.com', self.event['no'])
+        self.assertIn(user_id('a@example.com'), self.event['yes'])
+        self.assertNotIn(user_id('a@example.com'), self.event['no'])
 
     def test_rsvp_hell_yes(self):
         self.general_yes_with_no_prior_reservation('rsvp hell yes')
@@ -423,8 +463,8 @@ class RSVPDecisionTest(RSVPTest):
         self.assertEqual(None, self.event['limit'])
         self.assertNotIn('are attending', output[0]['body'])
         self.assertIn('are **not** attending', output[0]['body'])
-        self.assertNotIn('a@example.com', self.event['yes'])
-        self.assertIn('a@example.com', self.event['no'])
+        self.assertNotIn(user_id('a@example.com'), self.event['yes'])
+        self.assertIn(user_id('a@example.com'), self.event['no'])
 
     def test_rsvp_hell_no(self):
         self.general_no_with_no_prior_reservation('rsvp hell no!')
@@ -447,7 +487,7 @@ class RSVPDecisionTest(RSVPTest):
         self.assertIn('is not a valid RSVPBot command!', output[0]['body'])
         self.assertNotIn('are attending', output[0]['body'])
         self.assertNotIn('are **not** attending', output[0]['body'])
-        self.assertNotIn('a@example.com', self.event['no'])
+        self.assertNotIn(user_id('a@example.com'), self.event['no'])
 
     def test_rsvp_nose(self):
         self.rsvp_word_contains_command('rsvp nose jobs')
@@ -470,6 +510,61 @@ class RSVPDecisionTest(RSVPTest):
     def test_RSVP_yes_way(self):
         self.general_yes_with_no_prior_reservation('RSVP yes plz')
 
+    def use_legacy_event(self, **responses):
+        """Replaces the test event with one from before attendees were user ids."""
+        event = dict(self.event, **responses)
+        FileBackend('test.json').commit_events({'test-stream/Testing': event})
+        self.rsvp = rsvp.RSVP('rsvp', FileBackend(filename='test.json'))
+
+    def test_legacy_attendees_move_to_their_id_when_they_answer(self):
+        self.use_legacy_event(yes=['a@example.com'], no=['b@example.com'], maybe=[])
+
+        self.issue_custom_command('rsvp yes', sender_email='b@example.com')
+        self.assertEqual(['a@example.com', user_id('b@example.com')], self.event['yes'])
+        self.assertEqual([], self.event['no'])
+
+        self.issue_command('rsvp maybe')
+        self.assertEqual([user_id('b@example.com')], self.event['yes'])
+        self.assertEqual([user_id('a@example.com')], self.event['maybe'])
+
+    def test_legacy_attendees_are_not_counted_twice(self):
+        self.use_legacy_event(yes=['a@example.com'], no=[], maybe=[])
+        self.issue_command('rsvp yes')
+        self.assertEqual([user_id('a@example.com')], self.event['yes'])
+
+
+class ConfirmMatcherTest(unittest.TestCase):
+
+    fragments = [
+        'yes', 'y', 'ye', 's', 'ssss', 'yeah', 'h', 'yas', 'yep', 'in', 'n', 'no', 'ooo', 'nope', 'nah', 'out',
+        'maybe', 'yesterday', 'eyes', 'nose', 'YES', 'Nah', ':thumbsup:', ':thumbs_up:', ':thumbsdown:',
+        ':thumbs_down:', ':+1:', ':-1:', ':', '_', '1', ' ', '  ', '\n', '!', ',', 'x', u'\xe9', 'rsvp ',
+    ]
+
+    def setUp(self):
+        self.command = rsvp_commands.RSVPConfirmCommand('rsvp')
+
+    def regex_groups(self, message):
+        match = re.match(self.command.regex, message, flags=re.DOTALL | re.I)
+        return match.groupdict() if match else None
+
+    def matcher_groups(self, message):
+        match = self.command.match(message)
+        return match.groupdict() if match else None
+
+    def test_same_decisions_as_the_regex(self):
+        fuzz = random.Random(39)
+        for _ in range(5000):
+            message = 'rsvp ' + ''.join(fuzz.choice(self.fragments) for _ in range(fuzz.randint(0, 8)))
+            self.assertEqual(self.regex_groups(message), self.matcher_groups(message), repr(message))
+
+    def test_examples(self):
+        self.assertEqual('yesss', self.matcher_groups('rsvp yesterday? yesss')['yes_decision'])
+        self.assertEqual(':thumbs_down:', self.matcher_groups('rsvp :thumbs_down:')['no_decision'])
+        self.assertEqual('Maybe', self.matcher_groups('RSVP Maybe, yes')['maybe_decision'])
+        self.assertIsNone(self.matcher_groups('rsvp yesterday a:+1:'))
+        self.assertIsNone(self.matcher_groups('rsvpyes'))
+
 
 class RSVPLimitTest(RSVPTest):
     def test_set_limit(self):
@@ -495,7 +590,7 @@ class RSVPLimitTest(RSVPTest):
         )
 
         self.assertIn('are attending', output[0]['body'])
-        self.assertIn('b@example.com', self.event['yes'])
+        self.assertIn(user_id('b@example.com'), self.event['yes'])
         self.assertEqual(498, self.event['limit'] - len(self.event['yes']))
 
 
@@ -712,6 +807,1627 @@ class RSVPSummaryTest(RSVPTest):
         output = self.issue_command('rsvp summary')
         self.assertIn('Testing', output[0]['body'])
 
+    def answer(self, count, decision='yes'):
+        for i in range(count):
+            self.issue_custom_command('rsvp %s' % decision, sender_email='%s%d@example.com' % (decision, i))
+
+    def attendee_rows(self, body):
+        lines = body.split(':---:|:---:|:---:\n')[1].split('\n')
+        return lines[:lines.index('\t|\t')]
+
+    def test_summary_shows_the_first_page_of_attendees(self):
+        self.answer(25)
+        self.answer(3, 'no')
+        with patch.object(rsvp_commands.RSVPSummaryCommand, 'rows_per_page', 10):
+            body = self.issue_command('rsvp summary')[0]['body']
+
+        self.assertIn('YES (26) |NO (3) |MAYBE(0)', body)
+        self.assertEqual(10, len(self.attendee_rows(body)))
+        self.assertIn('page 1 of 3. `rsvp summary page 2`', body)
+
+    def test_summary_pages(self):
+        self.answer(25)
+        names = patch.object(ZulipUsers, 'names', autospec=True, side_effect=lambda _, attendees: map(str, attendees))
+        with patch.object(rsvp_commands.RSVPSummaryCommand, 'rows_per_page', 10), names as names:
+            body = self.issue_command('rsvp summary page 3')[0]['body']
+
+        expected = ['%d||' % user_id('yes%d@example.com' % i) for i in range(19, 25)]
+        self.assertEqual(expected, self.attendee_rows(body))
+        self.assertNotIn('rsvp summary page', body)
+        # Only the names on the page are looked up.
+        self.assertEqual(6, sum(len(call[0][1]) for call in names.call_args_list))
+
+    def test_summary_full(self):
+        self.answer(25)
+        with patch.object(rsvp_commands.RSVPSummaryCommand, 'rows_per_page', 10):
+            body = self.issue_command('rsvp summary full')[0]['body']
+        self.assertEqual(26, len(self.attendee_rows(body)))
+        self.assertNotIn('rsvp summary page', body)
+
+    def test_summary_page_out_of_range(self):
+        output = self.issue_command('rsvp summary page 2')
+        self.assertEqual('private', output[0]['type'])
+        self.assertIn('only has **1**', output[0]['body'])
+
+
+class EventIndexTest(unittest.TestCase):
+
+    def make_event(self, date, time=None, duration=None):
+        return {'date': date, 'time': time, 'duration': duration}
+
+    def test_events_are_ordered_by_start(self):
+        index = EventIndex({
+            'b/late': self.make_event('2100-02-25', '18:00'),
+            'a/early': self.make_event('2100-02-25', '09:00'),
+            'a/allday': self.make_event('2100-02-25'),
+            'a/next-day': self.make_event('2100-02-26', '09:00'),
+        })
+
+        upcoming = index.between(datetime(2100, 2, 25), datetime(2100, 2, 26))
+        self.assertEqual(['a/allday', 'a/early', 'b/late'], [event_id for _, _, event_id in upcoming])
+
+    def test_between_filters_by_stream(self):
+        index = EventIndex({
+            'b/late': self.make_event('2100-02-25', '18:00'),
+            'a/early': self.make_event('2100-02-25', '09:00'),
+        })
+
+        upcoming = index.between(datetime(2100, 2, 25), datetime(2100, 2, 26), 'B')
+        self.assertEqual(['b/late'], [event_id for _, _, event_id in upcoming])
+
+    def test_end_uses_duration(self):
+        index = EventIndex({'a/a': self.make_event('2100-02-25', '09:00', 5400)})
+
+        _, end, _ = index.between(datetime(2100, 2, 25), datetime(2100, 2, 26))[0]
+        self.assertEqual(datetime(2100, 2, 25, 10, 30), end)
+
+    def test_update_moves_and_removes_entries(self):
+        index = EventIndex({'a/a': self.make_event('2100-02-25', '09:00')})
+
+        index.update('a/a', self.make_event('2100-03-25', '09:00'))
+        self.assertEqual([], index.between(datetime(2100, 2, 25), datetime(2100, 2, 26)))
+        self.assertEqual(1, len(index.between(datetime(2100, 3, 25), datetime(2100, 3, 26))))
+
+        index.update('a/a', None)
+        self.assertNotIn('a/a', index)
+        self.assertEqual({}, index.streams)
+
+    def test_events_without_a_valid_date_are_not_indexed(self):
+        index = EventIndex({'a/a': self.make_event(None), 'a/b': self.make_event('not a date')})
+        self.assertEqual(0, len(index))
+
+
+class RSVPUpcomingTest(RSVPTest):
+    def test_upcoming_lists_events_by_date(self):
+        self.issue_command('rsvp set time 10:30')
+        self.issue_custom_command('rsvp init', subject='Earlier')
+        self.issue_custom_command('rsvp set time 09:00', subject='Earlier')
+
+        output = self.issue_command('rsvp upcoming')
+
+        body = output[0]['body']
+        self.assertEqual('private', output[0]['type'])
+        self.assertIn('[Testing]', body)
+        self.assertLess(body.index('[Earlier]'), body.index('[Testing]'))
+
+    def test_upcoming_skips_events_past_the_window(self):
+        self.issue_command('rsvp set date 02/25/2099')
+        output = self.issue_command('rsvp upcoming')
+        self.assertIn('There are no RSVPBot events in the next 7 days', output[0]['body'])
+
+    def test_upcoming_by_stream(self):
+        self.issue_custom_command('rsvp init', display_recipient='other-stream')
+
+        output = self.issue_command('rsvp upcoming other-stream')
+        self.assertIn('other-stream', output[0]['body'])
+        self.assertNotIn('test-stream', output[0]['body'])
+
+    def test_upcoming_does_not_list_canceled_or_moved_events(self):
+        self.issue_custom_command('rsvp init', subject='Canceled')
+        self.issue_custom_command('rsvp cancel', subject='Canceled')
+        self.issue_command('rsvp move http://testhost/#narrow/stream/test-move/subject/MovedTo')
+
+        output = self.issue_command('rsvp upcoming')
+        self.assertNotIn('Canceled', output[0]['body'])
+        self.assertNotIn('test-stream', output[0]['body'])
+        self.assertIn('[MovedTo]', output[0]['body'])
+
+
+class ReminderSchedulerTest(unittest.TestCase):
+
+    now = datetime(2100, 2, 24, 12, 0)
+
+    def make_scheduler(self, events, offsets=(timedelta(hours=1),)):
+        return ReminderScheduler(list(offsets), events, now=self.now)
+
+    def test_reminders_come_due_in_order(self):
+        scheduler = self.make_scheduler({
+            'a/late': {'date': '2100-02-25', 'time': '18:00'},
+            'a/early': {'date': '2100-02-25', 'time': '09:00'},
+        })
+
+        self.assertEqual([], scheduler.pop_due(datetime(2100, 2, 25, 7, 59)))
+        self.assertEqual([('a/early', timedelta(hours=1))], scheduler.pop_due(datetime(2100, 2, 25, 8, 0)))
+        self.assertEqual([('a/late', timedelta(hours=1))], scheduler.pop_due(datetime(2100, 2, 26)))
+        self.assertEqual(0, len(scheduler))
+
+    def test_every_offset_gets_a_reminder(self):
+        scheduler = self.make_scheduler(
+            {'a/a': {'date': '2100-02-25', 'time': '18:00'}},
+            offsets=(timedelta(hours=1), timedelta(days=1)))
+
+        due = scheduler.pop_due(datetime(2100, 2, 26))
+        self.assertEqual([('a/a', timedelta(days=1)), ('a/a', timedelta(hours=1))], due)
+
+    def test_reminders_already_past_are_skipped(self):
+        scheduler = self.make_scheduler({'a/a': {'date': '2100-02-24', 'time': '12:30'}})
+        self.assertEqual(0, len(scheduler))
+
+    def test_rescheduled_event_is_only_reminded_at_its_new_time(self):
+        scheduler = self.make_scheduler({'a/a': {'date': '2100-02-25', 'time': '09:00'}})
+        scheduler.update('a/a', {'date': '2100-02-25', 'time': '18:00'}, now=self.now)
+
+        self.assertEqual([], scheduler.pop_due(datetime(2100, 2, 25, 12, 0)))
+        self.assertEqual([('a/a', timedelta(hours=1))], scheduler.pop_due(datetime(2100, 2, 25, 17, 0)))
+
+    def test_rescheduling_back_and_forth_reminds_once(self):
+        scheduler = self.make_scheduler({'a/a': {'date': '2100-02-25', 'time': '09:00'}})
+        scheduler.update('a/a', {'date': '2100-02-25', 'time': '18:00'}, now=self.now)
+        scheduler.update('a/a', {'date': '2100-02-25', 'time': '09:00'}, now=self.now)
+
+        self.assertEqual(1, len(scheduler.pop_due(datetime(2100, 2, 26))))
+
+    def test_canceled_event_is_not_reminded(self):
+        scheduler = self.make_scheduler({'a/a': {'date': '2100-02-25', 'time': '09:00'}})
+        scheduler.update('a/a', None)
+        self.assertEqual([], scheduler.pop_due(datetime(2100, 2, 26)))
+
+    def test_parse_offsets(self):
+        self.assertEqual([timedelta(days=1), timedelta(minutes=90)], parse_offsets('1d, 90 minutes'))
+        self.assertEqual([], parse_offsets(''))
+
+
+class RSVPReminderTest(RSVPTest):
+    def test_set_date_and_time_reschedule_reminders(self):
+        scheduler = ReminderScheduler([timedelta(hours=1)], self.rsvp.events)
+        self.rsvp.observers.append(scheduler)
+
+        self.issue_command('rsvp set date 02/25/2100')
+        self.issue_command('rsvp set time 10:30')
+
+        due = scheduler.pop_due(datetime(2100, 2, 26))
+        self.assertEqual([('test-stream/Testing', timedelta(hours=1))], due)
+
+    def test_lazy_scheduler_reads_the_events_when_first_used(self):
+        scheduler = ReminderScheduler([timedelta(hours=1)], source=lambda: self.rsvp.events)
+        self.rsvp.observers.append(scheduler)
+
+        self.issue_command('rsvp set date 02/25/2100\nrsvp set time 10:30')
+        self.assertIsNotNone(scheduler.source)
+
+        due = scheduler.pop_due(datetime(2100, 2, 26))
+        self.assertEqual([('test-stream/Testing', timedelta(hours=1))], due)
+
+
+class ParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parse = Mock(side_effect=lambda raw: raw.upper())
+
+    def test_same_normalized_input_is_parsed_once(self):
+        cache = ParseCache(self.parse)
+        self.assertEqual('NEXT FRIDAY', cache('next friday'))
+        self.assertEqual('NEXT FRIDAY', cache(' Next   Friday'))
+
+        self.assertEqual(1, self.parse.call_count)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(0.5, cache.hit_rate)
+
+    def test_least_recently_used_entries_are_dropped(self):
+        cache = ParseCache(self.parse, maxsize=2)
+        cache('a')
+        cache('b')
+        cache('a')
+        cache('c')
+
+        self.assertEqual(2, len(cache))
+        cache('a')
+        cache('b')
+        self.assertEqual(4, self.parse.call_count)
+
+    def test_daily_cache_is_emptied_at_midnight(self):
+        cache = ParseCache(self.parse, daily=True)
+        with patch('parse_cache.datetime') as mock_datetime:
+            mock_datetime.date.today.return_value = date(2100, 2, 24)
+            cache('tomorrow')
+            cache('tomorrow')
+            mock_datetime.date.today.return_value = date(2100, 2, 25)
+            cache('tomorrow')
+
+        self.assertEqual(2, self.parse.call_count)
+
+    def test_threads_can_share_a_cache(self):
+        cache = ParseCache(lambda raw: raw.upper(), maxsize=3)
+        errors = []
+
+        def use_cache():
+            try:
+                for i in range(2000):
+                    self.assertEqual(str(i % 5), cache(str(i % 5)))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use_cache) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(3, len(cache))
+        self.assertEqual(8000, cache.hits + cache.misses)
+
+
+class RSVPParseCacheTest(RSVPTest):
+    def test_set_date_and_duration_use_the_caches(self):
+        parsed_dates = rsvp_commands.RSVPSetDateCommand.parsed_dates
+        parsed_durations = rsvp_commands.RSVPSetDurationCommand.parsed_durations
+        parsed_dates.clear()
+        parsed_durations.clear()
+
+        self.issue_command('rsvp set date tomorrow\nrsvp set date Tomorrow')
+        self.issue_command('rsvp set duration 90 minutes\nrsvp set duration 90 minutes')
+
+        self.assertEqual((1, 1), (parsed_dates.hits, parsed_dates.misses))
+        self.assertEqual((1, 1), (parsed_durations.hits, parsed_durations.misses))
+        self.assertEqual(5400, self.event['duration'])
+
+
+class ProcessedMessagesTest(unittest.TestCase):
+
+    def tearDown(self):
+        try:
+            os.remove('test_processed.log')
+        except OSError:
+            pass
+
+    def test_add_reports_duplicates(self):
+        processed = ProcessedMessages('test_processed.log')
+        self.assertTrue(processed.add(1))
+        self.assertFalse(processed.add(1))
+        self.assertTrue(processed.add(2))
+
+    def test_oldest_ids_are_evicted(self):
+        processed = ProcessedMessages('test_processed.log', capacity=2)
+        for message_id in (1, 2, 3):
+            processed.add(message_id)
+
+        self.assertNotIn(1, processed)
+        self.assertIn(3, processed)
+        self.assertEqual(2, len(processed))
+
+    def test_ids_survive_restarts(self):
+        processed = ProcessedMessages('test_processed.log', capacity=2)
+        for message_id in range(10):
+            processed.add(message_id)
+
+        reloaded = ProcessedMessages('test_processed.log', capacity=2)
+        self.assertFalse(reloaded.add(9))
+        self.assertTrue(reloaded.add(7))
+
+    def test_log_is_compacted(self):
+        processed = ProcessedMessages('test_processed.log', capacity=2)
+        for message_id in range(10):
+            processed.add(message_id)
+
+        with open('test_processed.log') as f:
+            self.assertLessEqual(len(f.readlines()), 4)
+
+
+class BotTest(unittest.TestCase):
+
+    def setUp(self):
+        client_patcher = patch('zulip.Client')
+        self.addCleanup(client_patcher.stop)
+        client_patcher.start()
+        self.patch_bot_storage()
+
+        self.bot = bot.Bot('bot@example.com', 'key', 'rsvp', ['test-stream'])
+
+    def patch_bot_storage(self):
+        """Point every file the bot keeps at test files, created afresh for each Bot."""
+        for name, factory in (
+                ('get_backend', lambda: FileBackend(filename='test.json')),
+                ('get_processed_messages', lambda: ProcessedMessages('test_processed.log')),
+                ('get_event_queue_state', lambda: EventQueueState('test_queue.json'))):
+            patcher = patch.object(bot.Bot, name, side_effect=factory)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+        patcher = patch.object(bot.Bot, 'users_sync_interval', 0)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def tearDown(self):
+        for filename in ('test.json', 'test.json.lock', 'test_processed.log', 'test_queue.json'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def create_message_event(self, content, message_id=1):
+        return {
+            'type': 'message',
+            'message': {
+                'id': message_id,
+                'content': content,
+                'subject': 'Testing',
+                'display_recipient': 'test-stream',
+                'sender_id': user_id('a@example.com'),
+                'sender_full_name': 'Tester',
+                'sender_email': 'a@example.com',
+                'type': 'stream',
+            },
+        }
+
+
+class BotProcessTest(BotTest):
+    def test_redelivered_message_is_only_handled_once(self):
+        event = self.create_message_event('rsvp init')
+
+        self.bot.process(event)
+        self.bot.process(event)
+
+        self.assertEqual(1, self.bot.client.send_message.call_count)
+
+    def test_different_messages_are_all_handled(self):
+        self.bot.process(self.create_message_event('rsvp init', message_id=1))
+        self.bot.process(self.create_message_event('rsvp init', message_id=2))
+
+        self.assertEqual(2, self.bot.client.send_message.call_count)
+
+
+class BotRestartTest(BotTest):
+    def test_background_threads_survive_restarts(self):
+        subject = bot.Bot('bot@example.com', 'key', 'rsvp', ['test-stream'], reminder_offsets=[timedelta(hours=1)])
+        subject.stopped = True
+        with patch.object(subject, 'connect'), patch.object(subject, 'start_reminders') as start_reminders:
+            start_reminders.return_value.is_alive.return_value = True
+            subject.main()
+            # What tenants.Runner does after a crash.
+            subject.main()
+
+        start_reminders.assert_called_once_with()
+
+
+class BotRespondTest(BotTest):
+    def sent_messages(self):
+        return [call[0][0] for call in self.bot.client.send_message.call_args_list]
+
+    def test_replies_to_the_same_recipient_are_sent_together(self):
+        self.bot.process(self.create_message_event('rsvp init'))
+        self.bot.client.send_message.reset_mock()
+
+        self.bot.process(self.create_message_event(
+            'rsvp set time 10:30\nrsvp set place Hopper!\nrsvp set description Party', message_id=2))
+
+        sent = self.sent_messages()
+        self.assertEqual(1, len(sent))
+        self.assertEqual('a@example.com', sent[0]['to'])
+        body = sent[0]['content']
+        self.assertLess(body.index('**10:30**'), body.index('**Hopper!**'))
+        self.assertLess(body.index('**Hopper!**'), body.index('**Party**'))
+
+    def test_replies_to_different_recipients_keep_their_order(self):
+        self.bot.process(self.create_message_event(
+            'rsvp init\nrsvp set time 10:30\nrsvp set limit 5\nrsvp set place Hopper!'))
+
+        sent = self.sent_messages()
+        self.assertEqual(2, len(sent))
+
+        self.assertEqual(('stream', 'test-stream', 'Testing'), (sent[0]['type'], sent[0]['to'], sent[0]['subject']))
+        self.assertIn('now an RSVPBot event', sent[0]['content'])
+        self.assertLess(sent[0]['content'].index('RSVPBot event'), sent[0]['content'].index('attendance limit'))
+
+        self.assertEqual(('private', 'a@example.com'), (sent[1]['type'], sent[1]['to']))
+        self.assertLess(sent[1]['content'].index('**10:30**'), sent[1]['content'].index('**Hopper!**'))
+
+    def test_replies_to_other_threads_are_not_merged(self):
+        self.bot.process(self.create_message_event('rsvp init'))
+        self.bot.client.send_message.reset_mock()
+
+        self.bot.process(self.create_message_event(
+            'rsvp move http://testhost/#narrow/stream/test-move/subject/MovedTo', message_id=2))
+
+        sent = self.sent_messages()
+        self.assertEqual(['test-stream', 'test-move'], [message['to'] for message in sent])
+
+
+class FakeZulipBotTest(BotTest):
+    """Runs bots against a local fake Zulip server instead of a mocked client."""
+
+    def setUp(self):
+        self.server = FakeZulipServer(
+            streams=['test-stream', 'other-stream'],
+            users=[('a@example.com', 'Tester')],
+            poll_timeout=0.2,
+        ).start()
+        self.addCleanup(self.server.stop)
+        self.patch_bot_storage()
+        self.bot = self.start_bot()
+
+    def start_bot(self, subscribed_streams=('test-stream',), **kwargs):
+        new_bot = bot.Bot('bot@example.com', 'key', 'rsvp', list(subscribed_streams), self.server.url, **kwargs)
+        new_bot.connect()
+        return new_bot
+
+    def requests_to(self, method, endpoint):
+        return len([request for request in self.server.requests if request == (method, endpoint)])
+
+
+class FakeZulipStormTest(FakeZulipBotTest):
+    def test_storm_replies_are_timed(self):
+        storm = self.server.storm(
+            1000, 10, lambda i: ('a@example.com', 'test-stream', 'Event %d' % i, 'rsvp init' if i % 2 else 'hi'))
+        self.assertTrue(storm.join(timeout=5))
+        while len(self.server.sent_messages) < 5:
+            self.bot.poll_events()
+
+        self.assertEqual(10, len(storm.sent))
+        self.assertEqual(5, len(storm.reply_latencies()))
+        self.assertTrue(all(latency >= 0 for latency in storm.reply_latencies()))
+        self.assertEqual(10, self.server.events_delivered['message'])
+
+
+class TracingTest(FakeZulipBotTest):
+    def setUp(self):
+        super(TracingTest, self).setUp()
+        self.tracer = tracing.Tracer('test_traces.json', sample_rate=1)
+        patcher = patch.object(tracing, 'tracer', self.tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.remove_trace_files)
+
+    def remove_trace_files(self):
+        for filename in glob.glob('test_traces.json*'):
+            os.remove(filename)
+
+    def test_messages_are_traced_through_every_stage(self):
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+        self.bot.poll_events()
+
+        with open('test_traces.json') as f:
+            self.assertEqual('[', f.readline().strip())
+        events = list(tracing.read_events('test_traces.json'))
+        by_id = dict((event['args']['span_id'], event) for event in events)
+        parents = dict((event['name'], by_id[event['args']['parent_id']]['name'])
+                       for event in events if event['args']['parent_id'] is not None)
+        self.assertEqual({
+            'rsvp.route': 'bot.process',
+            'rsvp.dispatch': 'rsvp.route',
+            'rsvp.command': 'rsvp.route',
+            'rsvp.save': 'rsvp.route',
+            'rsvp.observers': 'rsvp.route',
+            'zulip.send_message': 'bot.process',
+        }, parents)
+        self.assertEqual(1, len(set(event['args']['trace_id'] for event in events)))
+        self.assertTrue(all(event['ph'] == 'X' and event['dur'] >= 0 for event in events))
+
+        root = [event for event in events if event['name'] == 'bot.process'][0]
+        self.assertEqual('message', root['args']['event'])
+        self.assertEqual('RSVPInitCommand', [event for event in events
+                                             if event['name'] == 'rsvp.command'][0]['args']['command'])
+
+    def test_only_sampled_traces_are_written(self):
+        self.tracer.sample_rate = 0
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+        self.bot.poll_events()
+
+        self.assertFalse(os.path.exists('test_traces.json'))
+        with tracing.span('orphan') as span:
+            self.assertIs(tracing.NULL_SPAN, span)
+
+    def test_files_are_rotated(self):
+        self.tracer.max_bytes = 2000
+        self.tracer.backup_count = 2
+        for i in range(20):
+            with tracing.trace('bot.process', i=i):
+                with tracing.span('rsvp.route'):
+                    pass
+
+        self.assertEqual(['test_traces.json', 'test_traces.json.1', 'test_traces.json.2'],
+                         sorted(glob.glob('test_traces.json*')))
+        for filename in glob.glob('test_traces.json*'):
+            self.assertLessEqual(os.path.getsize(filename), 2000)
+            with open(filename) as f:
+                events = json.loads(f.read().rstrip(',\n') + ']')
+            # Traces aren't split across files.
+            self.assertEqual(len(events), 2 * len(set(event['args']['trace_id'] for event in events)))
+
+        numbers = [event['args']['i'] for event in tracing.read_events('test_traces.json')
+                   if event['name'] == 'bot.process']
+        self.assertEqual(sorted(numbers), numbers)
+        self.assertEqual(19, numbers[-1])
+
+    def test_summary_lists_the_slowest_traces_first(self):
+        for name, sleep in (('fast', 0), ('slow', 0.02), ('medium', 0.01)):
+            with tracing.trace(name):
+                with tracing.span('inner'):
+                    time.sleep(sleep)
+
+        summary = tracing.summarize(tracing.read_events('test_traces.json'), top=2)
+        self.assertIn('Slowest 2 of 3 traces', summary)
+        self.assertLess(summary.index('slow'), summary.index('medium'))
+        self.assertNotIn('fast', summary.partition('span ')[0])
+        self.assertRegexpMatches(summary, r'inner\s+3 ')
+
+
+class MemoryTest(RSVPTest):
+    def setUp(self):
+        super(MemoryTest, self).setUp()
+        self.addCleanup(self.remove_trace_files)
+
+    def remove_trace_files(self):
+        for filename in glob.glob('test_traces.json*'):
+            os.remove(filename)
+
+    def test_deep_size_counts_shared_objects_once(self):
+        item = [u'x' * 100]
+        shared = memory.deep_size([item, item])
+        self.assertEqual(sys.getsizeof([item, item]) + memory.deep_size(item), shared)
+
+        seen = {}
+        memory.deep_size(item, seen)
+        self.assertEqual(sys.getsizeof([item, item]), memory.deep_size([item, item], seen))
+
+    def test_report_by_component(self):
+        # Parsed separately, like the attendees of events loaded from a file.
+        events = EventMap({
+            'a/a': {'yes': [int('123456'), u'a@example.com'], 'no': [], 'maybe': []},
+            'b/b': {'yes': [int('123456')], 'no': [], 'maybe': [json.loads('"a@example.com"')]},
+        })
+        users = ZulipUsers('test_users_file.json')
+        users.add(123456, u'b@example.com', u'B')
+        report = memory.report(events, users)
+
+        self.assertEqual(['events', 'attendees', 'users', 'regexes', 'code', 'process'], report.keys())
+        self.assertEqual(2, report['events']['count'])
+        self.assertEqual(report['events']['bytes'] // 2, report['events']['bytes_per_event'])
+        self.assertEqual({'entries': 4, 'distinct': 2, 'duplicates': 2,
+                          'duplicate_bytes': sys.getsizeof(123456) + sys.getsizeof(u'a@example.com')},
+                         dict(report['attendees']))
+        self.assertEqual(1, report['users']['count'])
+        self.assertGreater(report['code']['modules'], 0)
+        self.assertGreater(report['process']['rss_bytes'], report['events']['bytes'])
+
+    def test_reports_are_written_as_counters(self):
+        tracer = tracing.Tracer('test_traces.json', sample_rate=0)
+        for _ in range(2):
+            memory.emit(memory.report(self.rsvp.events), tracer)
+
+        counters = [event for event in tracing.read_events('test_traces.json') if event['ph'] == 'C']
+        self.assertEqual(12, len(counters))
+        self.assertEqual(1, counters[0]['args']['count'])
+        history = memory.history(tracing.read_events('test_traces.json')).splitlines()
+        self.assertEqual(3, len(history))
+        self.assertIn('Slowest 0 of 0 traces', tracing.summarize(tracing.read_events('test_traces.json')))
+
+    def test_memory_command_is_for_admins(self):
+        output = self.issue_command('rsvp memory')
+        self.assertIn('admins', output[0]['body'])
+
+        with patch.object(rsvp_commands, 'ADMINS', {'a@example.com'}):
+            output = self.issue_command('rsvp memory')
+        self.assertEqual('private', output[0]['type'])
+        self.assertIn('events|count|1', output[0]['body'])
+
+
+class ReplicationTest(RSVPTest):
+    """A primary shipping the changes it commits to a standby's store."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.log_filename = os.path.join(self.directory, 'events.log')
+        self.log = replication.ReplicationLog(self.log_filename)
+        self.rsvp = rsvp.RSVP('rsvp', replication.ShippingBackend(
+            FileBackend(os.path.join(self.directory, 'events.json')), self.log))
+        self.addCleanup(self.rsvp.backend.close)
+        self.standby = self.start_standby()
+        self.issue_command('rsvp init')
+
+    def start_standby(self):
+        return replication.Standby(self.log_filename, FileBackend(os.path.join(self.directory, 'standby.json')))
+
+    def standby_events(self):
+        self.standby.poll()
+        return FileBackend(os.path.join(self.directory, 'standby.json')).get_all_events()
+
+    def test_standby_follows_the_primarys_commits(self):
+        self.issue_command('rsvp set place Hopper!')
+        self.assertEqual(self.rsvp.events.to_dict(), self.standby_events())
+
+        self.issue_custom_command('rsvp init', subject='Another')
+        self.issue_command('rsvp move http://testhost/#narrow/stream/test-move/subject/MovedTo')
+        self.assertEqual(['test-move/MovedTo', 'test-stream/Another'], sorted(self.standby_events()))
+        self.assertEqual(self.rsvp.events.to_dict(), self.standby_events())
+
+    def test_standby_starting_late_gets_the_whole_store(self):
+        self.issue_command('rsvp set place Hopper!')
+        self.standby = self.start_standby()
+        self.assertEqual(self.rsvp.events.to_dict(), self.standby_events())
+
+    def test_standby_follows_the_log_when_it_is_replaced(self):
+        self.log.max_bytes = 0
+        self.standby.poll()
+        for subject in ('a', 'b', 'c'):
+            self.issue_custom_command('rsvp init', subject=subject)
+            if subject != 'b':
+                self.standby.poll()
+
+        with open(self.log_filename) as f:
+            self.assertEqual(1, len(f.readlines()))
+        self.assertEqual(self.rsvp.events.to_dict(), self.standby_events())
+
+    def test_one_primary_at_a_time(self):
+        lock = FileLock(self.log_filename + '.primary')
+        self.addCleanup(lock.close)
+        self.assertFalse(lock.acquire(blocking=False))
+        self.rsvp.backend.close()
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+
+class FailoverTest(unittest.TestCase):
+    """Kills a primary bot process and has a standby take over from it."""
+
+    def setUp(self):
+        self.server = FakeZulipServer(streams=['test-stream'], users=[('a@example.com', 'Tester')],
+                                      poll_timeout=0.2).start()
+        self.addCleanup(self.server.stop)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.primary_directory = os.path.join(directory, 'primary')
+        self.standby_directory = os.path.join(directory, 'standby')
+        os.makedirs(self.primary_directory)
+        os.makedirs(self.standby_directory)
+
+    def start_primary(self):
+        env = dict(os.environ, ZULIP_RSVP_EMAIL='bot@example.com', ZULIP_RSVP_KEY='key',
+                   ZULIP_RSVP_SITE=self.server.url, ZULIP_RSVP_REPLICATION_LOG='events.log',
+                   ZULIP_RSVP_USERS_SYNC_INTERVAL='0')
+        env.pop('ZULIP_RSVP_BACKEND', None)
+        with open(os.devnull, 'w') as devnull:
+            primary = subprocess.Popen(
+                [sys.executable, '-c', 'import bot; bot.from_environment(%r).main()' % self.primary_directory],
+                env=env, stderr=devnull)
+        self.addCleanup(lambda: primary.poll() is None and primary.kill())
+
+        deadline = time.time() + 10
+        while not self.server.queues and time.time() < deadline:
+            time.sleep(0.05)
+        return primary
+
+    def test_standby_takes_over_when_the_primary_dies(self):
+        primary = self.start_primary()
+        self.server.send_message('a@example.com', 'test-stream', 'Party', 'rsvp init')
+        self.assertTrue(self.server.wait_for_sent_messages(1, timeout=10))
+
+        standby = replication.Standby(os.path.join(self.primary_directory, 'events.log'),
+                                      FileBackend(os.path.join(self.standby_directory, 'events.json')))
+        self.assertFalse(standby.follow(timeout=0.3))
+        self.assertIn('test-stream/Party', standby.events)
+
+        self.server.send_message('a@example.com', 'test-stream', 'Party', 'rsvp set place Hopper!')
+        self.assertTrue(self.server.wait_for_sent_messages(2, timeout=10))
+        primary.kill()
+        primary.wait()
+
+        died = time.time()
+        self.assertTrue(standby.follow(timeout=5))
+        standby.take_over(self.standby_directory)
+        new_bot = bot.Bot('bot@example.com', 'key', 'rsvp', ['test-stream'], self.server.url,
+                          directory=self.standby_directory)
+        new_bot.connect()
+        self.assertLess(time.time() - died, 5)
+        self.assertEqual('Hopper!', new_bot.rsvp.events['test-stream/Party']['place'])
+
+        # It resumes the primary's queue, without answering its messages again.
+        self.server.send_message('a@example.com', 'test-stream', 'Party', 'rsvp set time 10:30')
+        while len(self.server.sent_messages) < 3:
+            new_bot.poll_events()
+        self.assertEqual(3, len(self.server.sent_messages))
+        self.assertEqual('10:30', new_bot.rsvp.events['test-stream/Party']['time'])
+
+
+class TenantsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeZulipServer(streams=['test-stream'], users=[('a@example.com', 'Tester')],
+                                      poll_timeout=0.2).start()
+        self.addCleanup(self.server.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = patch.object(bot.Bot, 'users_sync_interval', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.runner = tenants.Runner([
+            tenants.Tenant('rc', 'rsvp@example.com', 'key', self.server.url, 'rsvp', ['test-stream']),
+            tenants.Tenant('rc-events', 'events@example.com', 'key', self.server.url, 'event', ['test-stream']),
+        ], self.directory)
+
+    def test_tenants_run_in_one_process_with_their_own_events(self):
+        self.runner.start()
+        self.addCleanup(self.runner.stop)
+        while len(self.server.queues) < 2:
+            time.sleep(0.01)
+
+        with patch.object(self.runner.session, 'request', wraps=self.runner.session.request) as request:
+            self.server.send_message('a@example.com', 'test-stream', 'Party', 'rsvp init')
+            self.server.send_message('a@example.com', 'test-stream', 'Meetup', 'event init')
+            self.server.wait_for_sent_messages(2)
+            # The polls that returned the messages may have started before the patch.
+            deadline = time.time() + 5
+            while request.call_count < 4 and time.time() < deadline:
+                time.sleep(0.01)
+
+        bots = self.runner.bots
+        self.assertEqual(['test-stream/Party'], list(bots['rc'].rsvp.events))
+        self.assertEqual(['test-stream/Meetup'], list(bots['rc-events'].rsvp.events))
+        for name in ('rc', 'rc-events'):
+            self.assertTrue(os.path.exists(os.path.join(self.directory, name, 'events.json')))
+        # Both bots' polls and replies went through the shared pool.
+        self.assertGreaterEqual(request.call_count, 4)
+
+    def test_tenants_of_different_realms_have_their_own_users(self):
+        # The same user ids, for different people.
+        other_server = FakeZulipServer(streams=['test-stream'], users=[('z@example.org', 'Zed')],
+                                       poll_timeout=0.2).start()
+        self.addCleanup(other_server.stop)
+        runner = tenants.Runner([
+            tenants.Tenant('rc', 'rsvp@example.com', 'key', self.server.url, 'rsvp', ['test-stream']),
+            tenants.Tenant('other', 'rsvp@example.com', 'key', other_server.url, 'rsvp', ['test-stream']),
+        ], self.directory)
+        self.assertEqual(self.server.users['a@example.com']['user_id'], other_server.users['z@example.org']['user_id'])
+
+        with patch.object(bot.Bot, 'users_sync_interval', 3600):
+            runner.start()
+            self.addCleanup(runner.stop)
+            filenames = [os.path.join(self.directory, name, 'zulip_users.json.sync') for name in ('rc', 'other')]
+            deadline = time.time() + 5
+            while time.time() < deadline and not (all(os.path.exists(filename) for filename in filenames)
+                                                  and self.server.queues and other_server.queues):
+                time.sleep(0.01)
+
+        self.server.send_message('a@example.com', 'test-stream', 'Party', 'rsvp init\nrsvp ping')
+        other_server.send_message('z@example.org', 'test-stream', 'Party', 'rsvp init\nrsvp ping')
+        self.server.wait_for_sent_messages(1)
+        other_server.wait_for_sent_messages(1)
+
+        self.assertIn('@**Tester|', self.server.sent_messages[0]['content'])
+        self.assertIn('@**Zed|', other_server.sent_messages[0]['content'])
+        self.assertEqual(os.path.join(self.directory, 'other', 'zulip_users.json'),
+                         runner.bots['other'].rsvp.users_filename)
+
+    def test_tenants_share_command_tables(self):
+        other = rsvp.RSVP('event', FileBackend(os.path.join(self.directory, 'other.json')))
+        self.assertIs(other.command_list, self.runner.bots['rc-events'].rsvp.command_list)
+        self.assertIsNot(other.command_list, self.runner.bots['rc'].rsvp.command_list)
+
+    def test_a_crashing_tenant_is_restarted(self):
+        self.runner.restart_delay = 0
+        bot = self.runner.bots['rc']
+        def main():
+            if not main.calls:
+                main.calls += 1
+                raise RuntimeError
+            bot.stop()
+        main.calls = 0
+
+        with patch.object(bot, 'main', side_effect=main) as crashing_main, patch('tenants.logging'):
+            self.runner.run_bot('rc', bot)
+        self.assertEqual(2, crashing_main.call_count)
+
+
+class BotEventQueueTest(FakeZulipBotTest):
+    def test_events_are_processed(self):
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+        self.bot.poll_events()
+
+        self.assertIn('test-stream/Testing', self.bot.rsvp.events)
+        self.assertEqual(1, len(self.server.sent_messages))
+
+    def test_restart_resumes_queue(self):
+        self.bot.poll_events()
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+
+        restarted = self.start_bot()
+
+        self.assertEqual(1, self.requests_to('POST', 'register'))
+        self.assertEqual(1, self.requests_to('POST', 'users/me/subscriptions'))
+        self.assertIn('test-stream/Testing', restarted.rsvp.events)
+
+    def test_restart_with_expired_queue_catches_up_from_history(self):
+        self.bot.poll_events()
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp set time 10:30')
+        self.server.drop_queues()
+
+        restarted = self.start_bot()
+
+        self.assertEqual(2, self.requests_to('POST', 'register'))
+        self.assertEqual('10:30', restarted.rsvp.events['test-stream/Testing']['time'])
+        self.assertEqual(2, len(self.server.sent_messages))
+
+    def test_queue_lost_while_running_is_replaced(self):
+        self.server.drop_queues()
+        self.assertFalse(self.bot.poll_events())
+
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+        self.bot.register()
+        self.bot.poll_events()
+
+        self.assertIn('test-stream/Testing', self.bot.rsvp.events)
+        self.assertEqual(1, len(self.server.sent_messages))
+
+    def test_messages_are_not_replayed_after_catching_up(self):
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+        self.bot.poll_events()
+        self.server.drop_queues()
+
+        restarted = self.start_bot()
+        restarted.poll_events()
+
+        self.assertEqual(1, len(self.server.sent_messages))
+
+
+class BotStreamsTest(FakeZulipBotTest):
+    def setUp(self):
+        super(BotStreamsTest, self).setUp()
+        for name in ('stream-a', 'stream-b', 'stream-c'):
+            self.server.create_stream(name)
+        self.server.drop_queues()
+        self.server.requests[:] = []
+
+    def start_all_streams_bot(self):
+        with patch.object(bot.Bot, 'subscription_chunk_size', 2):
+            return self.start_bot(subscribed_streams=())
+
+    def test_all_streams_are_subscribed_in_chunks(self):
+        self.start_all_streams_bot()
+
+        self.assertEqual(
+            set(['test-stream', 'other-stream', 'stream-a', 'stream-b', 'stream-c']),
+            self.server.subscriptions)
+        # test-stream was already subscribed, the other 4 take 2 requests
+        self.assertEqual(2, self.requests_to('POST', 'users/me/subscriptions'))
+
+    def test_only_new_streams_are_subscribed(self):
+        self.start_all_streams_bot()
+        self.server.drop_queues()
+        self.server.requests[:] = []
+
+        self.start_all_streams_bot()
+        self.assertEqual(0, self.requests_to('POST', 'users/me/subscriptions'))
+
+    def test_stream_list_is_cached(self):
+        all_streams_bot = self.start_all_streams_bot()
+        all_streams_bot.streams
+        all_streams_bot.streams
+
+        self.assertEqual(1, self.requests_to('GET', 'streams'))
+
+    def test_created_and_deleted_streams_are_followed(self):
+        all_streams_bot = self.start_all_streams_bot()
+
+        self.server.create_stream('brand-new')
+        self.server.delete_stream('stream-a')
+        all_streams_bot.poll_events()
+
+        names = [stream['name'] for stream in all_streams_bot.streams]
+        self.assertIn('brand-new', names)
+        self.assertNotIn('stream-a', names)
+        self.assertIn('brand-new', self.server.subscriptions)
+        self.assertEqual(1, self.requests_to('GET', 'streams'))
+
+    def test_explicit_stream_list_ignores_new_streams(self):
+        self.server.create_stream('brand-new')
+        self.bot.poll_events()
+
+        self.assertNotIn('brand-new', self.server.subscriptions)
+        self.assertEqual(['test-stream'], [stream['name'] for stream in self.bot.streams])
+
+
+class UsersSyncTest(FakeZulipBotTest):
+    def setUp(self):
+        super(UsersSyncTest, self).setUp()
+        self.addCleanup(self.remove_users_files)
+
+    def remove_users_files(self):
+        for filename in glob.glob('test_users_file.json*'):
+            os.remove(filename)
+
+    def sync(self):
+        return zulip_users.sync(self.bot.client, 'test_users_file.json')
+
+    def test_only_changes_are_written(self):
+        tester = self.server.users['a@example.com']['user_id']
+        self.assertIn(tester, self.sync())
+        self.assertEqual((u'a@example.com', u'Tester'), ZulipUsers('test_users_file.json').users[tester])
+
+        with patch.object(ZulipUsers, 'save') as save:
+            self.assertEqual({}, self.sync())
+        self.assertFalse(save.called)
+
+        self.server.rename_user('a@example.com', 'Renamed')
+        self.assertEqual({tester: (u'a@example.com', u'Renamed')}, self.sync())
+        self.assertEqual((u'a@example.com', u'Renamed'), ZulipUsers('test_users_file.json').users[tester])
+
+    def test_events_during_a_sync_win(self):
+        tester = self.server.users['a@example.com']['user_id']
+        get_users = self.bot.client.get_users
+
+        def get_users_then_rename():
+            users = get_users()
+            zulip_users.update_zulip_user_dict({'user_id': tester, 'full_name': 'Newer'},
+                                               filename='test_users_file.json')
+            return users
+
+        with patch.object(self.bot.client, 'get_users', side_effect=get_users_then_rename):
+            self.assertNotIn(tester, self.sync())
+        self.assertEqual(u'Newer', ZulipUsers('test_users_file.json').users[tester][1])
+
+    def test_background_sync_starts_from_the_watermark(self):
+        def run_once():
+            stopped = threading.Event()
+            thread = threading.Thread(target=zulip_users.run_sync,
+                                      args=(self.bot.client, 3600, 'test_users_file.json', stopped))
+            thread.start()
+            time.sleep(0.2)
+            stopped.set()
+            thread.join()
+
+        run_once()
+        self.assertEqual(1, self.requests_to('GET', 'users'))
+        self.assertIsNotNone(zulip_users.SyncState('test_users_file.json.sync').synced_at)
+
+        # Restarted within the interval: not due yet.
+        run_once()
+        self.assertEqual(1, self.requests_to('GET', 'users'))
+
+
+class BotNarrowTest(FakeZulipBotTest):
+    def send_chatter_and_commands(self):
+        for i in range(20):
+            self.server.send_message('a@example.com', 'test-stream', 'Testing', 'chatting away %d' % i)
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'rsvp init')
+        self.server.send_message('a@example.com', 'test-stream', 'Testing', 'see you there!\nRSVP yes')
+
+    def test_event_queue_takes_every_message(self):
+        self.send_chatter_and_commands()
+        self.bot.poll_events()
+
+        self.assertEqual([], self.server.queues[self.bot.event_queue.queue_id].narrow)
+        self.assertEqual(22, self.server.events_delivered['message'])
+        self.assertEqual(2, len(self.server.sent_messages))
+
+    def test_event_queue_refuses_search(self):
+        with self.assertRaises(ZulipError):
+            self.server.register(['message'], [['search', 'rsvp']])
+
+    def test_register_backs_off(self):
+        failure = {'result': 'error', 'msg': 'Operator search not supported.'}
+        success = {'result': 'success', 'queue_id': 'queue', 'last_event_id': -1, 'max_message_id': -1}
+        with patch.object(self.bot.client, 'register', side_effect=[failure] * 3 + [success]), \
+                patch('time.sleep') as sleep, patch('logging.warning') as warning:
+            self.bot.register()
+
+        self.assertEqual([call(1), call(2), call(4)], sleep.call_args_list)
+        self.assertEqual(3, warning.call_count)
+        self.assertEqual('queue', self.bot.event_queue.queue_id)
+
+    def test_private_messages_are_received(self):
+        self.server.send_private_message('a@example.com', 'hi there')
+        self.server.send_private_message('a@example.com', 'rsvp help')
+        self.bot.poll_events()
+
+        self.assertEqual(2, self.server.events_delivered['message'])
+        self.assertEqual(1, len(self.server.sent_messages))
+        self.assertEqual('private', self.server.sent_messages[0]['type'])
+
+    def test_catch_up_skips_chatter(self):
+        self.bot.poll_events()
+        self.server.drop_queues()
+        self.send_chatter_and_commands()
+
+        restarted = self.start_bot()
+
+        self.assertIn('test-stream/Testing', restarted.rsvp.events)
+        self.assertEqual(2, len(restarted.processed_messages))
+        self.assertEqual(2, self.server.messages_fetched)
+
+    def test_without_narrow_catch_up_fetches_every_message(self):
+        self.bot.poll_events()
+        self.server.drop_queues()
+        self.send_chatter_and_commands()
+
+        with patch.object(bot.Bot, 'narrow_to_key_word', False):
+            restarted = self.start_bot()
+
+        self.assertIn('test-stream/Testing', restarted.rsvp.events)
+        self.assertEqual(22, self.server.messages_fetched)
+
+
+class EventMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = EventMap({'a/a': {'name': 'a', 'yes': []}, 'b/b': {'name': 'b', 'yes': []}})
+
+    def test_transaction_does_not_change_the_snapshot(self):
+        transaction = self.snapshot.begin()
+        transaction['a/a']['yes'].append('x@example.com')
+        transaction.pop('b/b')
+        transaction['c/c'] = {'name': 'c'}
+        published = transaction.publish(['a/a', 'b/b', 'c/c'])
+
+        self.assertEqual([], self.snapshot['a/a']['yes'])
+        self.assertEqual(['a/a', 'b/b'], sorted(self.snapshot))
+        self.assertEqual(['x@example.com'], published['a/a']['yes'])
+        self.assertEqual(['a/a', 'c/c'], sorted(published))
+        self.assertEqual(2, len(published))
+
+    def test_only_listed_events_are_published(self):
+        transaction = self.snapshot.begin()
+        transaction['a/a']['name'] = 'changed'
+        transaction['b/b']['name'] = 'changed'
+        published = transaction.publish(['a/a'])
+
+        self.assertEqual('changed', published['a/a']['name'])
+        self.assertEqual('b', published['b/b']['name'])
+
+    def test_missing_events(self):
+        transaction = self.snapshot.begin()
+        self.assertEqual(None, transaction.get('z/z'))
+        self.assertNotIn('z/z', transaction)
+        self.assertEqual('default', transaction.pop('z/z', 'default'))
+        with self.assertRaises(KeyError):
+            self.snapshot['z/z']
+
+    def test_versions_stay_consistent_across_compaction(self):
+        versions = [self.snapshot]
+        for i in range(200):
+            transaction = versions[-1].begin()
+            transaction['e/%d' % i] = {'name': str(i)}
+            if i % 2:
+                transaction.pop('e/%d' % (i - 1))
+            versions.append(transaction.publish(['e/%d' % i, 'e/%d' % (i - 1)]))
+
+        self.assertEqual(2, len(self.snapshot))
+        self.assertEqual(['a/a', 'b/b', 'e/0'], sorted(versions[1]))
+        self.assertEqual(102, len(versions[-1]))
+        self.assertEqual(102, len(versions[-1].to_dict()))
+        self.assertNotIn('e/198', versions[-1])
+        self.assertIn('e/199', versions[-1])
+
+
+class FakeCalendarTest(RSVPTest):
+    """Calendar sync against fake_gcal.py, through the real API client."""
+
+    def setUp(self):
+        self.server = FakeCalendarServer(calendars={'rsvpbot@example.com': 'RSVPBot Events'}, seed=41).start()
+        self.addCleanup(self.server.stop)
+        for name, value in (('GOOGLE_CALENDAR_API_URL', self.server.url),
+                            ('GOOGLE_CALENDAR_ID', 'rsvpbot@example.com'),
+                            ('GOOGLE_APPLICATION_CREDENTIALS', None)):
+            patcher = patch.object(calendar_events, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # A later server could get the same port: don't let it reuse this one's connections.
+        self.addCleanup(calendar_events._services.__dict__.clear)
+        self.addCleanup(calendar_events._discovery_cache.documents.clear)
+
+        super(FakeCalendarTest, self).setUp()
+        self.issue_command('rsvp set date 02/25/2100\nrsvp set time 10:30\nrsvp set duration 1h')
+
+    def calendar_event(self):
+        event_id = self.event['calendar_event']['id']
+        return self.server.events['rsvpbot@example.com'][event_id]
+
+    def test_add_to_calendar_and_sync(self):
+        output = self.issue_command('rsvp add to calendar')
+        self.assertIn('RSVPBot Events', output[0]['body'])
+        self.assertEqual('2100-02-25T10:30:00', self.calendar_event()['start']['dateTime'])
+
+        users = ZulipUsers('test_users_file.json')
+        users.add(user_id('a@example.com'), 'a@example.com', 'A')
+        with patch.object(calendar_events, 'ZulipUsers', return_value=users):
+            self.issue_command('rsvp set place Hopper!\nrsvp yes')
+        self.assertEqual('Hopper!', self.calendar_event()['location'])
+        self.assertEqual([{'email': 'a@example.com', 'responseStatus': 'accepted'}],
+                         self.calendar_event()['attendees'])
+        self.assertEqual(['GET', 'POST', 'PATCH'], [method for method, _ in self.server.calls])
+
+    def test_calendar_calls_are_traced(self):
+        self.issue_command('rsvp add to calendar')
+        tracer = tracing.Tracer('test_traces.json', sample_rate=1)
+        self.addCleanup(os.remove, 'test_traces.json')
+        with patch.object(tracing, 'tracer', tracer), tracing.trace('test'):
+            self.issue_command('rsvp set place Hopper!')
+
+        names = [event['name'] for event in tracing.read_events('test_traces.json')]
+        # Built for `add to calendar`, then reused.
+        self.assertNotIn('gcal.build_service', names)
+        self.assertLess(names.index('gcal.events.patch'), names.index('rsvp.sync_calendar'))
+
+    def test_services_are_cached_per_thread(self):
+        service = calendar_events._get_calendar_service()
+        self.assertIs(service, calendar_events._get_calendar_service())
+
+        other_threads = []
+        thread = threading.Thread(target=lambda: other_threads.append(calendar_events._get_calendar_service()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(service, other_threads[0])
+        self.assertEqual(1, self.server.discovery_requests)
+
+    def test_failures_are_retried(self):
+        self.server.calendar.error_rate = 0.5
+        with patch.object(calendar_events, 'GOOGLE_CALENDAR_RETRIES', 10), patch('googleapiclient.http.time.sleep'):
+            self.issue_command('rsvp add to calendar')
+
+        self.assertGreater(self.server.errors_injected, 0)
+        self.assertEqual('2100-02-25T10:30:00', self.calendar_event()['start']['dateTime'])
+
+    def test_failures_without_retries_fail_the_command(self):
+        self.server.calendar.error_rate = 1
+        with patch('rsvp.logging'):
+            output = self.issue_command('rsvp add to calendar')
+
+        self.assertIn('rsvp add to calendar', output[0]['body'])
+        self.assertIsNone(self.event['calendar_event'])
+
+    def test_batch(self):
+        service = calendar_events._get_calendar_service()
+        event = service.events().insert(calendarId='rsvpbot@example.com', body={'summary': 'a'}).execute()
+        responses = []
+        batch = service.new_batch_http_request(callback=lambda request_id, response, error: responses.append(
+            (request_id, response and response['location'], error and error.resp.status)))
+        batch.add(service.events().patch(calendarId='rsvpbot@example.com', eventId=event['id'], body={'location': 'x'}))
+        batch.add(service.events().patch(calendarId='rsvpbot@example.com', eventId='missing', body={}))
+        batch.execute()
+
+        self.assertEqual([('1', 'x', None), ('2', None, 404)], responses)
+        self.assertEqual(2, self.server.http_requests)
+
+
+class RSVPSnapshotTest(RSVPTest):
+    def test_snapshot_is_not_affected_by_later_commands(self):
+        snapshot = self.rsvp.events
+
+        self.issue_command('rsvp set time 10:30\nrsvp yes')
+        self.issue_custom_command('rsvp init', subject='Another')
+
+        self.assertEqual(None, snapshot['test-stream/Testing']['time'])
+        self.assertNotIn('test-stream/Another', snapshot)
+        self.assertEqual('10:30', self.rsvp.events['test-stream/Testing']['time'])
+
+    def test_read_only_commands_do_not_publish(self):
+        snapshot = self.rsvp.events
+        self.issue_command('rsvp summary')
+        self.assertIs(snapshot, self.rsvp.events)
+
+    def test_read_only_commands_do_not_copy_events(self):
+        with patch('event_map.copy.deepcopy') as deepcopy:
+            self.issue_command('rsvp summary\nrsvp ping\nrsvp upcoming')
+        self.assertFalse(deepcopy.called)
+
+    def test_read_only_commands_do_not_wait_for_writers(self):
+        with self.rsvp.write_lock:
+            output = self.issue_command('rsvp summary')
+        self.assertIn('**Testing**', output[0]['body'])
+
+    def test_messages_that_also_write_run_in_a_transaction(self):
+        version = self.event['version']
+        output = self.issue_command('rsvp yes\nrsvp summary')
+
+        # The summary sees the answer, which is committed with it.
+        self.assertIn('YES (1)', output[1]['body'])
+        self.assertEqual(version + 1, self.event['version'])
+
+
+class DbmBackendTest(RSVPTest):
+
+    def setUp(self):
+        self.backend = DbmBackend(filename='test_events.db')
+        self.rsvp = rsvp.RSVP('rsvp', self.backend)
+        self.issue_command('rsvp init')
+
+    def tearDown(self):
+        self.backend.close()
+        for filename in glob.glob('test_events.db*'):
+            os.remove(filename)
+
+    def restart(self):
+        self.backend.close()
+        self.backend = DbmBackend(filename='test_events.db')
+        self.rsvp = rsvp.RSVP('rsvp', self.backend)
+
+    def test_events_survive_a_restart(self):
+        self.issue_command('rsvp yes')
+        self.restart()
+        self.assertEqual([user_id('a@example.com')], self.event['yes'])
+
+    def test_events_are_loaded_on_first_access(self):
+        self.issue_custom_command('rsvp init', subject='Another')
+        self.restart()
+
+        events = self.backend.get_all_events()
+        self.assertEqual({}, events.loaded)
+        self.assertEqual(['test-stream/Another', 'test-stream/Testing'], sorted(events))
+        self.assertEqual({}, events.loaded)
+
+        self.assertEqual('Testing', events['test-stream/Testing']['name'])
+        self.assertEqual(['test-stream/Testing'], list(events.loaded))
+
+    def test_commands_only_write_the_changed_events(self):
+        self.issue_custom_command('rsvp init', subject='Another')
+        with patch.object(self.backend, 'commit_changes', wraps=self.backend.commit_changes) as commit_changes:
+            self.issue_command('rsvp yes')
+
+        (changes,), _ = commit_changes.call_args
+        self.assertEqual(['test-stream/Testing'], list(changes))
+        self.assertEqual(2, self.event['version'])
+
+    def test_move_renames_the_event_in_one_commit(self):
+        with patch.object(self.backend, 'commit_changes', wraps=self.backend.commit_changes) as commit_changes:
+            self.issue_command('rsvp move http://testhost/#narrow/stream/test-move/subject/MovedTo')
+
+        (changes,), _ = commit_changes.call_args
+        self.assertEqual((1, None), changes['test-stream/Testing'])
+        self.assertEqual(None, changes['test-move/MovedTo'][0])
+        self.restart()
+        self.assertEqual(['test-move/MovedTo'], self.backend.event_ids())
+        self.assertEqual('MovedTo', self.rsvp.events['test-move/MovedTo']['name'])
+
+    def test_cancel_deletes_the_key(self):
+        self.issue_command('rsvp cancel')
+        self.restart()
+        self.assertEqual([], self.backend.event_ids())
+        self.assertEqual(0, len(self.rsvp.events))
+
+    def test_snapshots_stay_consistent_across_compaction(self):
+        versions = [self.rsvp.events]
+        for i in range(200):
+            transaction = versions[-1].begin()
+            transaction['e/%d' % i] = {'name': str(i)}
+            versions.append(transaction.publish(['e/%d' % i]))
+
+        self.assertEqual(['test-stream/Testing'], list(versions[0]))
+        self.assertEqual(201, len(versions[-1]))
+        self.assertEqual('199', versions[-1]['e/199']['name'])
+
+    def test_instances_sharing_the_database_see_each_others_writes(self):
+        other = rsvp.RSVP('rsvp', DbmBackend(filename='test_events.db'))
+        self.addCleanup(other.backend.close)
+
+        other.process_message(self.create_input_message('rsvp init', subject='Other'))
+        self.issue_command('rsvp yes')
+        other.process_message(self.create_input_message('rsvp yes', sender_email='b@example.com'))
+
+        self.assertEqual(['test-stream/Other', 'test-stream/Testing'], sorted(self.backend.event_ids()))
+        self.assertEqual([user_id('a@example.com'), user_id('b@example.com')],
+                         self.backend.get_event('test-stream/Testing')['yes'])
+
+    def test_upcoming_builds_the_index_lazily(self):
+        self.restart()
+        self.assertIsNotNone(self.rsvp.index.source)
+
+        output = self.issue_command('rsvp upcoming')
+
+        self.assertIsNone(self.rsvp.index.source)
+        self.assertIn('[Testing]', output[0]['body'])
+
+
+class SharedFileTest(RSVPTest):
+    """A second RSVP writing to the same file, as another process would."""
+
+    def setUp(self):
+        super(SharedFileTest, self).setUp()
+        self.other = rsvp.RSVP('rsvp', FileBackend(filename='test.json'))
+
+    def issue_other_command(self, command, **kwargs):
+        return self.other.process_message(self.create_input_message(content=command, **kwargs))
+
+    def test_writes_to_different_events_both_survive(self):
+        self.issue_other_command('rsvp init', subject='Other')
+        self.issue_command('rsvp yes')
+
+        events = FileBackend('test.json').get_all_events()
+        self.assertEqual(['test-stream/Other', 'test-stream/Testing'], sorted(events))
+        self.assertEqual([user_id('a@example.com')], events['test-stream/Testing']['yes'])
+
+    def test_events_are_not_kept_twice(self):
+        self.issue_custom_command('rsvp init', subject='Other')
+        self.rsvp = rsvp.RSVP('rsvp', FileBackend(filename='test.json'))
+        with patch('backends.serializers.load_items', wraps=serializers.load_items) as load_items:
+            self.issue_command('rsvp yes')
+
+        # Committing merges into the events read at startup, rather than reading them again.
+        self.assertEqual(0, load_items.call_count)
+        self.assertIs(self.rsvp.events['test-stream/Other'], self.rsvp.backend.backend.committed['test-stream/Other'])
+
+    def test_events_created_by_someone_else_are_seen(self):
+        self.issue_other_command('rsvp init', subject='Other')
+        yes = self.issue_custom_command('rsvp yes', subject='Other')
+        summary = self.issue_custom_command('rsvp summary', subject='Other')
+
+        self.assertIn('**You** are attending', yes[0]['body'])
+        self.assertNotIn('is not an RSVPBot event', summary[0]['body'])
+        self.assertEqual([user_id('a@example.com')], self.rsvp.events['test-stream/Other']['yes'])
+        self.assertEqual([user_id('a@example.com')], FileBackend('test.json').get_all_events()['test-stream/Other']['yes'])
+
+    def test_changes_by_someone_else_are_seen(self):
+        self.issue_other_command('rsvp yes', sender_email='b@example.com')
+        self.issue_other_command('rsvp init', subject='Other')
+        self.issue_other_command('rsvp cancel', subject='Other')
+        with patch('rsvp.logging') as logging:
+            self.issue_command('rsvp set place Hopper!')
+
+        self.assertFalse(logging.info.called)  # no conflict to find out from
+        self.assertIn(user_id('b@example.com'), self.event['yes'])
+        self.assertNotIn('test-stream/Other', self.rsvp.events)
+
+    def test_unchanged_store_is_not_read_again(self):
+        with patch('backends.serializers.load_items') as load_items:
+            self.assertEqual({}, self.rsvp.backend.changed_events())
+        self.assertFalse(load_items.called)
+
+    def test_conflicting_writes_are_run_again(self):
+        self.issue_other_command('rsvp yes', sender_email='b@example.com')
+        # As if their write landed after we looked.
+        with patch.object(self.rsvp, 'pull'), patch('rsvp.logging') as logging:
+            output = self.issue_command('rsvp no')
+
+        self.assertTrue(logging.info.called)  # it did run again
+
+        self.assertIn('are **not** attending', output[0]['body'])
+        self.assertEqual([user_id('b@example.com')], self.event['yes'])
+        self.assertEqual([user_id('a@example.com')], self.event['no'])
+        self.assertEqual(self.event, FileBackend('test.json').get_all_events()['test-stream/Testing'])
+
+    @patch('calendar_events.create_event_on_calendar')
+    def test_calendar_events_are_created_once_when_run_again(self, create):
+        create.return_value = {'id': 1, 'htmlLink': 'www.google.com', 'calendar_name': 'Test'}
+        self.issue_command('rsvp set date 02/25/2100\nrsvp set time 10:30\nrsvp set duration 1h')
+        self.issue_other_command('rsvp yes', sender_email='b@example.com')
+        with patch.object(self.rsvp, 'pull'), patch('rsvp.logging') as logging:
+            output = self.issue_command('rsvp set place Hopper!\nrsvp add to calendar')
+
+        self.assertTrue(logging.info.called)  # it did run again
+        self.assertEqual(1, create.call_count)
+        self.assertIn('added to Test Calendar', output[-1]['body'])
+        self.assertEqual({'id': 1, 'html_link': 'www.google.com'}, self.event['calendar_event'])
+        self.assertEqual('Hopper!', FileBackend('test.json').get_all_events()['test-stream/Testing']['place'])
+
+    def test_conflicts_are_given_up_on_eventually(self):
+        with patch.object(self.rsvp.backend, 'commit_changes', side_effect=ConflictError({})) as commit_changes, \
+                patch('rsvp.logging'):
+            output = self.issue_command('rsvp no')
+
+        self.assertEqual(rsvp.RSVP.commit_attempts, commit_changes.call_count)
+        self.assertIn('none of the commands in your message were applied', output[0]['body'])
+        self.assertEqual([], self.event['no'])
+
+
+class FileLockTest(unittest.TestCase):
+
+    def setUp(self):
+        # Two locks on the same file behave like the locks of two processes.
+        self.first = FileLock('test.lock')
+        self.second = FileLock('test.lock')
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        os.remove('test.lock')
+
+    def test_excludes_other_holders(self):
+        acquired = threading.Event()
+
+        def take():
+            with self.second():
+                acquired.set()
+
+        with self.first():
+            thread = threading.Thread(target=take)
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+        thread.join(5)
+        self.assertTrue(acquired.is_set())
+
+    def test_shared_holders_do_not_exclude_each_other(self):
+        with self.first(shared=True), self.second(shared=True):
+            pass
+
+
+class WholeStoreAdapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.file_backend = FileBackend(filename='test.json')
+        self.file_backend.commit_events({'a/a': {'name': 'a'}, 'b/b': {'name': 'b'}})
+        self.backend = WholeStoreAdapter(self.file_backend)
+
+    def tearDown(self):
+        os.remove('test.json')
+        os.remove('test.json.lock')
+
+    def test_writes_go_through_the_whole_store(self):
+        self.backend.put_event('c/c', {'name': 'c'})
+        self.backend.delete_event('a/a')
+
+        self.assertEqual({'b/b': {'name': 'b'}, 'c/c': {'name': 'c'}}, self.file_backend.get_all_events())
+
+    def test_get_all_events_is_a_copy(self):
+        events = self.backend.get_all_events()
+        self.backend.put_event('c/c', {'name': 'c'})
+
+        self.assertNotIn('c/c', events)
+        self.assertEqual({'name': 'c'}, self.backend.get_event('c/c'))
+
+    def test_rsvp_wraps_whole_store_backends(self):
+        self.assertIsInstance(rsvp.RSVP('rsvp', self.file_backend).backend, WholeStoreAdapter)
+
+
+class SerializersTest(unittest.TestCase):
+
+    events = {u'stream/topic': {u'name': u'caf\xe9', u'yes': [u'a@example.com'], u'limit': None, u'duration': 3600}}
+
+    def tearDown(self):
+        for filename in ('test.json', 'test.json.corrupt', 'test.json.lock'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def test_every_format_round_trips(self):
+        for name, serializer in serializers.SERIALIZERS.items():
+            data = serializers.dumps(self.events, serializer)
+            self.assertTrue(data.startswith('RSVPBOT %s ' % name))
+            self.assertEqual(self.events, serializers.loads(data))
+
+    def test_files_without_a_header_are_json(self):
+        self.assertEqual(self.events, serializers.loads(json.dumps(self.events)))
+
+    def test_newer_versions_are_refused(self):
+        data = 'RSVPBOT json %d\n{}' % (serializers.JSONSerializer.version + 1)
+        with self.assertRaises(serializers.SerializerError):
+            serializers.loads(data)
+
+    def test_corrupt_files_raise_value_errors(self):
+        for data in ('RSVPBOT marshal 2\n{', 'RSVPBOT json\n{}', 'RSVPBOT yaml 1\n{}', '{'):
+            with self.assertRaises(ValueError):
+                serializers.loads(data)
+
+    def test_file_backend_reads_any_format(self):
+        FileBackend('test.json', serializers.get_serializer('marshal')).commit_events(self.events)
+        self.assertEqual(self.events, FileBackend('test.json').get_all_events())
+
+        with open('test.json', 'w') as f:
+            json.dump(self.events, f)
+        self.assertEqual(self.events, FileBackend('test.json').get_all_events())
+
+    def write_events(self, count):
+        events = dict(('stream/%d' % i, {'name': 'event %d' % i, 'yes': ['a@example.com']}) for i in range(count))
+        FileBackend('test.json', serializers.get_serializer('json')).commit_events(events)
+        with open('test.json', 'rb') as f:
+            return events, f.read()
+
+    def test_json_items_are_streamed_a_line_at_a_time(self):
+        events, data = self.write_events(3)
+        self.assertEqual(events, json.loads(data.partition('\n')[2]))
+        self.assertEqual(events, dict(serializers.load_items('test.json')))
+        self.assertEqual(['test.json', 'test.json.lock'], sorted(glob.glob('test.json*')))
+
+    def test_truncated_files_keep_every_complete_event(self):
+        events, data = self.write_events(3)
+        with open('test.json', 'wb') as f:
+            f.write(data[:data.rindex('"yes"')])
+
+        backend = FileBackend('test.json')
+        with patch('backends.logging'):
+            loaded = backend.get_all_events()
+        self.assertEqual(2, len(loaded))
+        self.assertTrue(all(events[event_id] == event for event_id, event in loaded.items()))
+        self.assertEqual([5], [line for line, _ in backend.load_errors])
+        with open('test.json.corrupt', 'rb') as f:
+            self.assertEqual(data[:data.rindex('"yes"')], f.read())
+
+    def test_corrupt_events_are_skipped(self):
+        events, data = self.write_events(3)
+        lines = data.split('\n')
+        lines[3] = lines[3].replace(':', '', 1)
+        with open('test.json', 'wb') as f:
+            f.write('\n'.join(lines))
+
+        with patch('backends.logging') as logging:
+            backend = FileBackend('test.json')
+            self.assertEqual(2, len(backend.get_all_events()))
+        self.assertEqual([4], [line for line, _ in backend.load_errors])
+        self.assertTrue(logging.warning.called)
+        with self.assertRaises(serializers.SerializerError):
+            list(serializers.load_items('test.json'))
+
+    def test_corrupt_files_without_a_header_keep_the_events_before_the_damage(self):
+        with open('test.json', 'w') as f:
+            f.write('{"a": {"name": "a"}, "b": {"name": "b"}, "c": {"na')
+
+        backend = FileBackend('test.json')
+        with patch('backends.logging'):
+            self.assertEqual({'a': {'name': 'a'}, 'b': {'name': 'b'}}, backend.get_all_events())
+        self.assertEqual(1, len(backend.load_errors))
+
+    def test_unreadable_files_are_kept(self):
+        with open('test.json', 'w') as f:
+            f.write('RSVPBOT marshal 2\n{')
+
+        backend = FileBackend('test.json')
+        with patch('backends.logging'):
+            self.assertEqual({}, backend.get_all_events())
+        self.assertEqual([None], [line for line, _ in backend.load_errors])
+        self.assertTrue(os.path.exists('test.json.corrupt'))
+
+    def test_default_format_comes_from_the_environment(self):
+        with patch.dict(os.environ, {'ZULIP_RSVP_FORMAT': 'marshal'}):
+            users = ZulipUsers('test.json')
+            users.add(1, u'a@example.com', u'A')
+            users.save()
+
+        with open('test.json', 'rb') as f:
+            self.assertTrue(f.read().startswith('RSVPBOT marshal '))
+        self.assertEqual({1: (u'a@example.com', u'A')}, ZulipUsers('test.json').users)
+
+
+class ZulipUsersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = ZulipUsers('test_users_file.json')
+        self.users.add(1, 'a@example.com', 'A')
+        self.users.legacy = {'a@example.com': 'Old A', 'b@example.com': 'B'}
+
+    def tearDown(self):
+        for filename in glob.glob('test_users_file.json*'):
+            os.remove(filename)
+
+    def test_names_take_ids_and_emails(self):
+        self.assertEqual(['A', 'A', 'B', 'c@example.com', u'2'],
+                         self.users.names([1, 'a@example.com', 'b@example.com', 'c@example.com', 2]))
+
+    def test_mentions_are_by_id_when_there_is_one(self):
+        self.assertEqual(['@**A|1**', '@**A|1**', '@**B**'],
+                         self.users.mentions([1, 'a@example.com', 'b@example.com']))
+
+    def test_emails_leave_out_unknown_ids(self):
+        self.assertEqual(['a@example.com', 'b@example.com'], self.users.emails([1, 'b@example.com', 2]))
+
+    def test_legacy_files_are_read(self):
+        serializers.dump({'a@example.com': 'A', 'b@example.com': 'B'}, 'test_users_file.json')
+        users = ZulipUsers('test_users_file.json')
+        self.assertEqual({}, users.users)
+        self.assertEqual(['A', 'B'], users.names(['a@example.com', 'b@example.com']))
+
+    def test_saving_drops_legacy_entries_the_table_knows(self):
+        self.users.save()
+        users = ZulipUsers('test_users_file.json')
+        self.assertEqual({1: ('a@example.com', 'A')}, users.users)
+        self.assertEqual({'b@example.com': 'B'}, users.legacy)
+
+    def test_realm_user_updates_are_keyed_by_id(self):
+        self.users.save()
+        zulip_users.update_zulip_user_dict({'user_id': 1, 'new_email': 'new-a@example.com'},
+                                           filename='test_users_file.json')
+        zulip_users.update_zulip_user_dict({'user_id': 1, 'full_name': 'New A'}, filename='test_users_file.json')
+        self.assertEqual(('new-a@example.com', 'New A'), ZulipUsers('test_users_file.json').users[1])
+
 
 class RSVPPingTest(RSVPTest):
     def test_ping_yes(self):
@@ -739,11 +2455,10 @@ class RSVPPingTest(RSVPTest):
                 sender_email=sender_email
             )
 
-        users_dict = {email: name for (_, name, email) in users}
-
         # no actual zulip_client in tests, so we have to mock the response
         return_val = ZulipUsers('test_users_file.json')
-        return_val.zulip_users = users_dict
+        for _, name, email in users:
+            return_val.add(user_id(email), email, name)
 
         with patch.object(rsvp_commands.RSVPPingCommand,
                           'get_users_dict',
@@ -752,29 +2467,27 @@ class RSVPPingTest(RSVPTest):
             output = self.issue_command('rsvp ping')
 
         # yeses
-        self.assertIn('@**A**', output[0]['body'])
-        self.assertIn('@**B**', output[0]['body'])
-        self.assertIn('@**C**', output[0]['body'])
-        self.assertIn('@**D**', output[0]['body'])
+        self.assertIn('@**A|', output[0]['body'])
+        self.assertIn('@**B|', output[0]['body'])
+        self.assertIn('@**C|', output[0]['body'])
+        self.assertIn('@**D|', output[0]['body'])
 
         # maybes
-        self.assertIn('@**W**', output[0]['body'])
-        self.assertIn('@**X**', output[0]['body'])
-        self.assertIn('@**Y**', output[0]['body'])
-        self.assertIn('@**Z**', output[0]['body'])
+        self.assertIn('@**W|', output[0]['body'])
+        self.assertIn('@**X|', output[0]['body'])
+        self.assertIn('@**Y|', output[0]['body'])
+        self.assertIn('@**Z|', output[0]['body'])
 
-        self.assertNotIn('@**E**', output[0]['body'])
-        self.assertNotIn('@**F**', output[0]['body'])
-        self.assertNotIn('@**G**', output[0]['body'])
-        self.assertNotIn('@**H**', output[0]['body'])
+        self.assertNotIn('@**E|', output[0]['body'])
+        self.assertNotIn('@**F|', output[0]['body'])
+        self.assertNotIn('@**G|', output[0]['body'])
+        self.assertNotIn('@**H|', output[0]['body'])
 
     def test_ping_message(self):
         self.issue_custom_command('rsvp yes', sender_full_name='A', sender_email='a@example.com')
 
-        users_dict = {'a@example.com': 'A'}
-
         return_val = ZulipUsers('test_users_file.json')
-        return_val.zulip_users = users_dict
+        return_val.add(user_id('a@example.com'), 'a@example.com', 'A')
 
         with patch.object(rsvp_commands.RSVPPingCommand,
                           'get_users_dict',
@@ -782,15 +2495,13 @@ class RSVPPingTest(RSVPTest):
 
             output = self.issue_command('rsvp ping message!!!')
 
-        self.assertIn('@**A**', output[0]['body'])
+        self.assertIn('@**A|%d**' % user_id('a@example.com'), output[0]['body'])
         self.assertIn('message!!!', output[0]['body'])
 
     def test_rsvp_ping_with_yes(self):
         self.issue_custom_command('rsvp yes', sender_full_name='B', sender_email='b@example.com')
-        users_dict = {'b@example.com': 'B'}
-
         return_val = ZulipUsers('test_users_file.json')
-        return_val.zulip_users = users_dict
+        return_val.add(user_id('b@example.com'), 'b@example.com', 'B')
 
         with patch.object(rsvp_commands.RSVPPingCommand,
                           'get_users_dict',
@@ -799,8 +2510,8 @@ class RSVPPingTest(RSVPTest):
 
         self.assertEqual(None, self.event['limit'])
         self.assertNotIn('@**Tester** is attending!', output[0]['body'])
-        self.assertNotIn('a@example.com', self.event['no'])
-        self.assertIn('@**B**', output[0]['body'])
+        self.assertNotIn(user_id('a@example.com'), self.event['no'])
+        self.assertIn('@**B|', output[0]['body'])
         self.assertIn('we\'re all going to the yes concert', output[0]['body'])
 
 
@@ -902,6 +2613,89 @@ rsvp set date 02/25/2099
         )
         self.assertEqual( '2099-02-25', self.event['date'])
 
+    def test_rsvp_multiple_commands_are_committed_once(self):
+        commands = """
+rsvp set date 02/25/2099
+rsvp set time 10:30
+rsvp set place Hopper!
+rsvp set limit 10
+rsvp set duration 1h
+"""
+        with patch.object(self.rsvp.backend, 'commit_changes', wraps=self.rsvp.backend.commit_changes) as commit_changes:
+            self.issue_command(commands)
+
+        self.assertEqual(1, commit_changes.call_count)
+        self.assertEqual(3600, self.get_test_event()['duration'])
+
+    def test_rsvp_commands_that_change_nothing_are_not_committed(self):
+        with patch.object(self.rsvp.backend, 'commit_changes', wraps=self.rsvp.backend.commit_changes) as commit_changes:
+            self.issue_command('rsvp summary\nrsvp help')
+
+        self.assertEqual(0, commit_changes.call_count)
+
+    def test_rsvp_failing_line_rolls_back_the_whole_message(self):
+        commands = """
+rsvp set time 10:30
+rsvp set duration whenever
+"""
+        with patch.object(self.rsvp.backend, 'commit_changes', wraps=self.rsvp.backend.commit_changes) as commit_changes, patch('rsvp.logging'):
+            output = self.issue_command(commands)
+
+        self.assertEqual(0, commit_changes.call_count)
+        self.assertEqual(1, len(output))
+        self.assertIn('none of the commands in your message were applied', output[0]['body'])
+        self.assertEqual(None, self.get_test_event()['time'])
+
+    @patch('calendar_events.create_event_on_calendar')
+    def test_rsvp_failing_line_rolls_back_calendar_creates(self, create):
+        create.return_value = {'id': 1, 'htmlLink': 'www.google.com', 'calendar_name': 'Test'}
+        self.issue_command('rsvp set date 02/25/2100\nrsvp set time 10:30\nrsvp set duration 1h')
+        with patch('rsvp.logging'):
+            output = self.issue_command('rsvp add to calendar\nrsvp set duration whenever')
+
+        self.assertEqual(0, create.call_count)
+        self.assertEqual(1, len(output))
+        self.assertIn('none of the commands in your message were applied', output[0]['body'])
+        self.assertIsNone(self.get_test_event()['calendar_event'])
+
+    def test_rsvp_failing_line_rolls_back_moves(self):
+        commands = """
+rsvp move http://testhost/#narrow/stream/test-move/subject/MovedTo
+rsvp init
+rsvp set duration whenever
+"""
+        with patch('rsvp.logging'):
+            self.issue_command(commands)
+
+        self.assertIn('test-stream/Testing', self.rsvp.events)
+        self.assertNotIn('test-move/MovedTo', self.rsvp.events)
+
+    @patch('calendar_events.update_gcal_event')
+    def test_rsvp_multiple_commands_update_the_calendar_once(self, update):
+        self.get_test_event()['calendar_event'] = {'id': 1, 'html_link': 'www.google.com'}
+        commands = """
+rsvp set time 10:30
+rsvp set place Hopper!
+rsvp yes
+"""
+        self.issue_command(commands)
+
+        update.assert_called_once_with(self.get_test_event(), 'test-stream/Testing', 'zulip_users.json')
+
+    @patch('calendar_events.update_gcal_event')
+    @patch('calendar_events.create_event_on_calendar')
+    def test_rsvp_add_to_calendar_includes_earlier_lines(self, create, update):
+        create.return_value = {'id': 1, 'htmlLink': 'www.google.com', 'calendar_name': 'Test'}
+        commands = """
+rsvp set time 10:30
+rsvp set duration 1h
+rsvp add to calendar
+"""
+        self.issue_command(commands)
+
+        self.assertEqual(1, create.call_count)
+        self.assertEqual(0, update.call_count)
+
     def test_rsvp_multiple_commands_with_other_text(self):
         commands = """
 rsvp set time 10:30
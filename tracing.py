@@ -0,0 +1,291 @@
+"""
+Lightweight tracing of where the time handling an inbound message goes:
+`Bot.process` starts a trace, and the stages it goes through (command dispatch,
+the command itself, saving the events, Google Calendar calls, sending replies)
+record spans inside it.
+
+    with tracing.trace('bot.process', event='message'):
+        ...
+        with tracing.span('gcal.events.patch'):
+            ...
+
+A fraction ZULIP_RSVP_TRACE_RATE (0 to 1, 0 by default, meaning off) of the
+traces is kept. The decision is made when the trace starts; spans outside a
+kept trace cost a thread-local lookup.
+
+Kept traces are appended to ZULIP_RSVP_TRACE_FILE (traces.json) in the Chrome
+trace event format, one complete ("X") event per span, which chrome://tracing,
+Perfetto and speedscope open directly. Each trace is written in one go when it
+ends. The file is rotated like logging's RotatingFileHandler once it would grow
+past ZULIP_RSVP_TRACE_MAX_BYTES, keeping ZULIP_RSVP_TRACE_BACKUPS old files.
+
+To list the slowest traces, and the time spent in each stage over all of them:
+
+    python tracing.py [--top 10] [traces.json]
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+TRACE_FILE = os.getenv('ZULIP_RSVP_TRACE_FILE', 'traces.json')
+TRACE_SAMPLE_RATE = float(os.getenv('ZULIP_RSVP_TRACE_RATE', 0))
+TRACE_MAX_BYTES = int(os.getenv('ZULIP_RSVP_TRACE_MAX_BYTES', 10 * 1024 * 1024))
+TRACE_BACKUPS = int(os.getenv('ZULIP_RSVP_TRACE_BACKUPS', 3))
+
+
+class NullSpan(object):
+    """What spans are when there's no kept trace to record them in."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+    def annotate(self, **args):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+        self.span_id = next(trace.span_ids)
+        self.parent_id = None
+        self.start = self.end = None
+
+    def __enter__(self):
+        if self.trace.stack:
+            self.parent_id = self.trace.stack[-1].span_id
+        self.trace.stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.end = time.time()
+        if type is not None:
+            self.args['error'] = type.__name__
+        self.trace.stack.pop()
+        self.trace.spans.append(self)
+        if not self.trace.stack:
+            self.trace.tracer.end(self.trace)
+        return False
+
+    def annotate(self, **args):
+        """Adds arguments only known once the span has started."""
+        self.args.update(args)
+
+    def event(self):
+        """The span as a Chrome trace "complete" event."""
+        args = dict(self.args, trace_id=self.trace.trace_id, span_id=self.span_id, parent_id=self.parent_id)
+        return {
+            'name': self.name,
+            'cat': self.name.partition('.')[0],
+            'ph': 'X',
+            'ts': self.start * 1e6,
+            'dur': (self.end - self.start) * 1e6,
+            'pid': self.trace.pid,
+            'tid': self.trace.tid,
+            'args': args,
+        }
+
+
+class Trace(object):
+
+    def __init__(self, tracer, trace_id):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.pid = os.getpid()
+        self.tid = threading.current_thread().ident
+        self.span_ids = itertools.count(1)
+        self.stack = []
+        self.spans = []
+
+
+class Tracer(object):
+    """Samples traces and writes the kept ones to a rotating file. Each thread
+    has its own current trace."""
+
+    def __init__(self, filename=TRACE_FILE, sample_rate=TRACE_SAMPLE_RATE, max_bytes=TRACE_MAX_BYTES,
+                 backup_count=TRACE_BACKUPS):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.random = random.Random()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    def trace(self, name, **args):
+        """Starts a trace with a root span called `name`, if this one is
+        sampled. Inside another trace, it's just a span of that one."""
+        if self.current() is not None:
+            return self.span(name, **args)
+        if not self.sample_rate or self.random.random() >= self.sample_rate:
+            return NULL_SPAN
+
+        trace = Trace(self, '%016x' % self.random.getrandbits(64))
+        self.local.trace = trace
+        return Span(trace, name, args)
+
+    def span(self, name, **args):
+        trace = self.current()
+        if trace is None:
+            return NULL_SPAN
+        return Span(trace, name, args)
+
+    def end(self, trace):
+        self.local.trace = None
+        data = ''.join(json.dumps(span.event()) + ',\n' for span in trace.spans)
+        with self.lock:
+            self.write(data)
+
+    def counter(self, name, ts=None, **values):
+        """Writes a counter event: chrome://tracing plots each of `values`
+        (numbers) over time under `name`. Counters aren't sampled."""
+        event = {
+            'name': name,
+            'cat': name.partition('.')[0],
+            'ph': 'C',
+            'ts': (ts or time.time()) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': values,
+        }
+        with self.lock:
+            self.write(json.dumps(event) + ',\n')
+
+    def write(self, data):
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        if size and size + len(data) > self.max_bytes:
+            self.rotate()
+            size = 0
+
+        with open(self.filename, 'ab') as f:
+            if not size:
+                # The array is never closed: the format allows that, so the
+                # file stays valid while it's appended to.
+                f.write('[\n')
+            f.write(data)
+
+    def rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.filename, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.filename, i + 1))
+        if self.backup_count:
+            os.rename(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+
+
+tracer = Tracer()
+
+
+def trace(name, **args):
+    return tracer.trace(name, **args)
+
+
+def span(name, **args):
+    return tracer.span(name, **args)
+
+
+def counter(name, ts=None, **values):
+    return tracer.counter(name, ts, **values)
+
+
+def read_events(filename):
+    """The events in a trace file and its backups, oldest first. Lines that
+    were cut short by a crash are skipped."""
+    directory, base = os.path.split(filename)
+    backups = sorted(
+        (name for name in os.listdir(directory or '.')
+         if name.startswith(base + '.') and name.rpartition('.')[2].isdigit()),
+        key=lambda name: -int(name.rpartition('.')[2]))
+    for name in [os.path.join(directory, backup) for backup in backups] + [filename]:
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                line = line.strip().rstrip(',')
+                if line in ('', '[', ']'):
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize(events, top=10):
+    """Formats the `top` slowest traces as trees of spans, followed by the time
+    spent in each kind of span over all the traces."""
+    traces = collections.OrderedDict()
+    for event in events:
+        # Counters (see memory.py) aren't part of any trace.
+        if event.get('ph') != 'X':
+            continue
+        traces.setdefault(event['args']['trace_id'], []).append(event)
+
+    roots = []
+    for spans in traces.values():
+        root = [span for span in spans if span['args']['parent_id'] is None]
+        if root:
+            roots.append((root[0], spans))
+    roots.sort(key=lambda (root, spans): -root['dur'])
+
+    lines = ['Slowest %d of %d traces:' % (min(top, len(roots)), len(roots))]
+    for root, spans in roots[:top]:
+        children = collections.defaultdict(list)
+        for span in spans:
+            children[span['args']['parent_id']].append(span)
+
+        def add(span, depth):
+            args = ' '.join('%s=%s' % (key, value) for key, value in sorted(span['args'].items())
+                            if key not in ('trace_id', 'span_id', 'parent_id'))
+            lines.append(('%s%9.1fms  %s  %s' % ('  ' * depth, span['dur'] / 1000.0, span['name'], args)).rstrip())
+            for child in sorted(children[span['args']['span_id']], key=lambda child: child['ts']):
+                add(child, depth + 1)
+
+        lines.append('')
+        lines.append('trace %s at %s' % (
+            root['args']['trace_id'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(root['ts'] / 1e6))))
+        add(root, 0)
+
+    stages = collections.defaultdict(list)
+    for _, spans in roots:
+        for span in spans:
+            stages[span['name']].append(span['dur'] / 1000.0)
+
+    lines.append('')
+    lines.append('%-28s %7s %11s %9s %9s' % ('span', 'count', 'total', 'mean', 'max'))
+    for name, durations in sorted(stages.items(), key=lambda (name, durations): -sum(durations)):
+        lines.append('%-28s %7d %9.1fms %7.1fms %7.1fms' % (
+            name, len(durations), sum(durations), sum(durations) / len(durations), max(durations)))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarizes the slowest traces RSVPBot recorded.')
+    parser.add_argument('filename', nargs='?', default=TRACE_FILE)
+    parser.add_argument('--top', type=int, default=10, help='how many of the slowest traces to show')
+    args = parser.parse_args()
+    print summarize(read_events(args.filename), args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,44 @@
 """
-Manages a dictionary of email address to name mappings in a json
-file. This script can be run with `python zulip_users.py` to update
-all entries, or `update_zulip_user_dict` can be called with the data
-included with zulip's `realm_user` event to update one user at a time.
+Manages the directory of the realm's users in a json file: a table indexed by
+Zulip user id, `{"<user_id>": ["<email>", "<full name>"], ...}`. It's kept up
+to date two ways:
+
+* `update_zulip_user_dict` is called with the data included with zulip's
+  `realm_user` events, to update one user at a time.
+* `sync` fetches the whole directory, compares it with the table and writes
+  only if some entry changed, which catches whatever events were missed. The
+  bot runs it in the background every ZULIP_RSVP_USERS_SYNC_INTERVAL seconds
+  (6 hours by default, 0 turns it off), and `python zulip_users.py` runs it
+  once (or, with `--every SECONDS`, in a loop).
+
+When the table was last synced (its watermark), and which users events have
+updated since, is kept in `<table>.sync`: the interval counts from there, so a
+restarted bot doesn't sync again right away, and a sync never overwrites an
+entry with the directory it fetched if an event updated it meanwhile. Both
+files are written under a lock on `<table>.lock`.
+
+Event attendees are user ids. Events from before that list emails instead,
+until each attendee answers again (see RSVPConfirmCommand), so every lookup
+here takes either. Files from before the table, which mapped emails to names,
+are still read: their entries answer for emails the table doesn't know.
 """
 
+import argparse
+import contextlib
 import json
+import logging
 import os
+import sys
+import threading
+import time
 
 import zulip
 
+import serializers
+from file_lock import FileLock
+
+USERS_SYNC_INTERVAL = int(os.getenv('ZULIP_RSVP_USERS_SYNC_INTERVAL', 6 * 60 * 60))
+
 
 def _get_zulip_client():
     username = os.environ['ZULIP_RSVP_EMAIL']
@@ -21,52 +50,239 @@ def _get_zulip_client():
     return client
 
 
+@contextlib.contextmanager
+def locked(filename):
+    """Holds the lock on a users table while it's read, changed and written."""
+    lock = FileLock(filename + '.lock')
+    try:
+        with lock():
+            yield
+    finally:
+        lock.close()
+
+
+def is_email(attendee):
+    """Whether an attendee is the email of one not migrated to their user id yet."""
+    return isinstance(attendee, basestring) and '@' in attendee
+
+
 class ZulipUsers(object):
-    def __init__(self, filename='zulip_users.json'):
+    def __init__(self, filename='zulip_users.json', serializer=None):
         self.filename = filename
+        self.serializer = serializer
+        # user id -> (email, full name)
+        self.users = {}
+        # email -> full name, from a file written before users had ids.
+        self.legacy = {}
+        self._ids_by_email = None
 
         try:
-            with open(self.filename, 'r') as users_file:
-                self.zulip_users = json.load(users_file)
+            table = serializers.load(self.filename)
         except (IOError, ValueError):
-            self.zulip_users = {}
+            table = {}
+        for key, value in table.items():
+            if isinstance(value, basestring):
+                self.legacy[key] = value
+            else:
+                self.users[int(key)] = tuple(value)
+
+    def save(self):
+        """Write the whole users table to the filename file."""
+        table = dict((email, name) for email, name in self.legacy.items() if email not in self.ids_by_email)
+        table.update((str(user_id), list(user)) for user_id, user in self.users.items())
+        serializers.dump(table, self.filename, self.serializer)
+
+    def add(self, user_id, email, full_name):
+        self.users[int(user_id)] = (email, full_name)
+        self._ids_by_email = None
+
+    def diff(self, members):
+        """The members (as listed by Zulip's /users endpoint) missing from the
+        table or different in it: {user_id: (email, full name)}."""
+        changed = {}
+        for member in members:
+            user = (member['email'], member['full_name'])
+            if self.users.get(member['user_id']) != user:
+                changed[member['user_id']] = user
+        return changed
+
+    @property
+    def ids_by_email(self):
+        if self._ids_by_email is None:
+            self._ids_by_email = dict((email, user_id) for user_id, (email, _) in self.users.items())
+        return self._ids_by_email
+
+    def _lookup(self, attendee):
+        """(email, full name) of an attendee, each None if unknown."""
+        if is_email(attendee):
+            user_id = self.ids_by_email.get(attendee)
+            if user_id is None:
+                return attendee, self.legacy.get(attendee)
+            attendee = user_id
+        try:
+            return self.users.get(int(attendee), (None, None))
+        except ValueError:
+            return None, None
+
+    def names(self, attendees):
+        """The names of a list of attendees, all at once. Unknown ones are
+        shown as their email or id."""
+        names = []
+        for attendee in attendees:
+            _, name = self._lookup(attendee)
+            names.append(name or unicode(attendee))
+        return names
+
+    def mentions(self, attendees):
+        """Zulip mentions of a list of attendees: by id (`@**name|id**`), which
+        doesn't break when people change their names, for those we have one."""
+        mentions = []
+        for attendee, name in zip(attendees, self.names(attendees)):
+            if is_email(attendee):
+                user_id = self.ids_by_email.get(attendee)
+                mentions.append('@**%s**' % name if user_id is None else '@**%s|%d**' % (name, user_id))
+            else:
+                mentions.append('@**%s|%s**' % (name, attendee))
+        return mentions
+
+    def emails(self, attendees):
+        """The emails of a list of attendees, leaving out the ones we don't know."""
+        emails = []
+        for attendee in attendees:
+            email, _ = self._lookup(attendee)
+            if email:
+                emails.append(email)
+        return emails
+
+
+class SyncState(object):
+    """The watermark of a users table, and the users updated since."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+
+        # When the directory the table was last synced with was fetched.
+        self.synced_at = state.get('synced_at')
+        # user id -> when a `realm_user` event last updated them
+        self.updated = dict((int(user_id), at) for user_id, at in state.get('updated', {}).items())
 
     def save(self):
-        """Write the whole users dictionary to the filename file."""
         with open(self.filename, 'w+') as f:
-            json.dump(self.zulip_users, f)
+            json.dump({'synced_at': self.synced_at, 'updated': self.updated}, f)
 
-    def convert_email_to_pingable_name(self, email):
-        """Looks up email address and returns the user's "pingable name" if they exist
-        in the dict, otherwise, just returns the email address."""
-        user = self.zulip_users.get(email)
-        return user or email
+    def seconds_until_due(self, interval, now):
+        if self.synced_at is None:
+            return 0
+        return max(self.synced_at + interval - now, 0)
 
 
-def update_zulip_user_dict(updated_info=None, zulip_client=None):
+def update_zulip_user_dict(updated_info=None, zulip_client=None, filename='zulip_users.json'):
     """Updates the `zulip_users.json` file.
 
-    If `updated_info` is not provided, it'll make a call to Zulip's /users
-    endpoint to get all users and update them all.
+    If `updated_info` is not provided, it'll sync the whole directory, see `sync`.
 
     If `updated_info` is provided, it should be the person dict returned by the
-    Zulip API in a `realm_user` event. The required keys are `email` and `full_name`.
+    Zulip API in a `realm_user` event. The required key is `user_id`; `email`
+    (`new_email` when it changed) and `full_name` are updated if present.
     """
-    zusers = ZulipUsers()
-    if updated_info:
-        new_entry = {updated_info['email']: updated_info['full_name']}
-        zusers.zulip_users.update(new_entry)
-    else:
-        client = zulip_client or _get_zulip_client()
-        users_response = client.get_users()
-        if users_response['result'] == 'success':
-            users_from_zulip_api = users_response['members']
-            for user in users_from_zulip_api:
-                new_entry = {user['email']: user['full_name']}
-                zusers.zulip_users.update(new_entry)
-    zusers.save()
+    if not updated_info:
+        sync(zulip_client, filename)
+        return ZulipUsers(filename)
+
+    with locked(filename):
+        zusers = ZulipUsers(filename)
+        user_id = int(updated_info['user_id'])
+        email, full_name = zusers.users.get(user_id, (None, None))
+        zusers.add(
+            user_id,
+            updated_info.get('new_email', updated_info.get('email', email)),
+            updated_info.get('full_name', full_name))
+        zusers.save()
+
+        state = SyncState(filename + '.sync')
+        state.updated[user_id] = time.time()
+        state.save()
     return zusers
 
 
+def sync(zulip_client=None, filename='zulip_users.json'):
+    """
+    Brings the table up to date with the realm's directory. Users who are no
+    longer listed are kept, since past events still name them.
+
+    Returns the entries it changed ({user_id: (email, full name)}), or None if
+    the directory couldn't be fetched.
+    """
+    client = zulip_client or _get_zulip_client()
+    fetched_at = time.time()
+    response = client.get_users()
+    if response['result'] != 'success':
+        logging.warning('Could not fetch the users directory: %s', response.get('msg'))
+        return None
+
+    # Fetching takes a while on a big realm, so only lock for the comparison.
+    with locked(filename):
+        zusers = ZulipUsers(filename)
+        state = SyncState(filename + '.sync')
+        changed = zusers.diff(response['members'])
+        for user_id in changed.keys():
+            # An event since the fetch knows better than the directory.
+            if state.updated.get(user_id, 0) >= fetched_at:
+                del changed[user_id]
+
+        for user_id, (email, full_name) in changed.items():
+            zusers.add(user_id, email, full_name)
+        if changed:
+            zusers.save()
+
+        state.synced_at = fetched_at
+        state.updated = dict((user_id, at) for user_id, at in state.updated.items() if at >= fetched_at)
+        state.save()
+    return changed
+
+
+def run_sync(zulip_client, interval=USERS_SYNC_INTERVAL, filename='zulip_users.json', stopped=None):
+    """Blocking call that syncs every `interval` seconds, counting from the
+    watermark, until `stopped` (a threading.Event) is set."""
+    stopped = stopped or threading.Event()
+    while not stopped.is_set():
+        wait = SyncState(filename + '.sync').seconds_until_due(interval, time.time())
+        if wait:
+            stopped.wait(wait)
+            continue
+
+        try:
+            changed = sync(zulip_client, filename)
+        except Exception:
+            logging.exception('Syncing the users directory failed.')
+            changed = None
+        if changed is None:
+            # The watermark didn't move: try again next interval.
+            stopped.wait(interval)
+        elif changed:
+            logging.info('Synced the users directory: %d users changed.', len(changed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Brings zulip_users.json up to date with the realm.')
+    parser.add_argument('--every', type=int, metavar='SECONDS', help='keep syncing, this often')
+    parser.add_argument('--filename', default='zulip_users.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.every:
+        run_sync(_get_zulip_client(), args.every, args.filename)
+    else:
+        changed = sync(filename=args.filename)
+        if changed is None:
+            sys.exit(1)
+        logging.info('%d users changed.', len(changed))
+
+
 if __name__ == '__main__':
-    update_zulip_user_dict()
+    main()